@@ -0,0 +1,435 @@
+# Offline benchmark of every stage, so a change can be measured before it is merged:
+#
+#   python benchmark/benchmark.py --dataset mixed --count 64 --output before.json
+#   ... change something ...
+#   python benchmark/benchmark.py --dataset mixed --count 64 --compare before.json
+#
+# The models and services are replaced by the stand-ins of stand_ins.py, so it runs on a CPU-only
+# machine without downloads or network access. Every case runs in its own process, with the python of
+# its stage's venv when that exists (like run.sh and pipeline.py), and reports images/s, latency
+# percentiles and the peak RSS of that process:
+#
+#   preprocess_image  wd14 preprocessing of one image, decode included
+#   run_model         wd14 single-image tagging, preprocessing and tag lookup included
+#   wd14              a full wd14 pass with batching and prefetching; latency is per inference batch
+#   blip2             gen_caps_for_dir with the tiny captioner; latency is per generate batch
+#   open_flamingo     a full Open Flamingo pass with the small random model, loading included; latency is
+#                     per generate batch, and the load phase of the results holds the startup time
+#   summarize_llama   a full llama summarizer pass on the fake llama; latency is per summary, and it also reports prompt and completion tokens/s
+#   summarize_gpt     a full GPT summarizer pass against the mock endpoint; latency is per request
+#
+# The dataset and stand-in models are kept in --work_dir and reused while their settings don't change.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BASE_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+sys.path.append(BASE_DIRECTORY)
+from pipeline import CAPTION_STAGES, SUMMARIZE_STAGES, venv_python
+from common.trace import percentiles, peak_rss_mb, tracer_from_args
+import stand_ins
+
+# case: (stage it runs in, phase whose latency is reported)
+CASES = {
+    'preprocess_image': ('wd14', None),
+    'run_model': ('wd14', None),
+    'wd14': ('wd14', 'inference'),
+    'blip2': ('blip2', 'generate'),
+    'open_flamingo': ('open_flamingo', 'generate'),
+    'summarize_llama': ('summarize_llama', 'generate'),
+    'summarize_gpt': ('summarize_gpt', 'api'),
+}
+# the dataset and the stand-in models are made with the blip2 venv: it has torch (through lavis), PIL and
+# numpy, while the wd14 venv runs its models on onnxruntime and has no torch to export the stand-in tagger
+PREPARE_STAGE = 'blip2'
+DATASET_VERSION = 2
+
+
+def stage_python(args, stage):
+    if args.python:
+        return args.python
+    stage_directory, venv, _ = {**CAPTION_STAGES, **SUMMARIZE_STAGES}[stage]
+    return venv_python(os.path.join(BASE_DIRECTORY, stage_directory), venv)
+
+
+def run_child(args, case, python):
+    """Run one case (or the preparation) in a fresh process and return what it reported"""
+    stage = CASES[case][0] if case in CASES else PREPARE_STAGE
+    stage_directory = os.path.join(BASE_DIRECTORY, {**CAPTION_STAGES, **SUMMARIZE_STAGES}[stage][0])
+    result_path = os.path.join(args.work_dir, f"{case}.result.json")
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    # stages are run from their own directory, where their relative default paths point
+    completed = subprocess.run([python, '-u', os.path.abspath(__file__), '--child', case, '--work_dir', args.work_dir],
+                               cwd=stage_directory)
+    if completed.returncode != 0 or not os.path.exists(result_path):
+        print(f"{case} failed with exit code {completed.returncode}")
+        return None
+    with open(result_path) as f:
+        return json.load(f)
+
+
+def dataset_spec(settings):
+    return {'version': DATASET_VERSION, 'sizes': settings['sizes'], 'count': settings['count'],
+            'alpha_fraction': settings['alpha_fraction'], 'seed': settings['seed']}
+
+
+# The preparation and the cases run in the child processes, with the settings the parent saved.
+
+
+def prepare(settings, work_dir):
+    spec_path = os.path.join(work_dir, 'dataset.json')
+    spec = dataset_spec(settings)
+    previous = None
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            previous = json.load(f)
+    if previous != spec:
+        for directory in ('images', 'captions', 'wd14_model', 'ort_cache', 'flamingo_model', 'flamingo_cache'):
+            shutil.rmtree(os.path.join(work_dir, directory), ignore_errors=True)
+        start_time = time.time()
+        stand_ins.make_dataset(os.path.join(work_dir, 'images'), spec['count'], spec['sizes'], spec['alpha_fraction'],
+                               spec['seed'])
+        stand_ins.make_caption_fixtures(os.path.join(work_dir, 'captions'), spec['count'], spec['seed'])
+        stand_ins.make_wd14_model(os.path.join(work_dir, 'wd14_model'), seed=spec['seed'])
+        with open(os.path.join(work_dir, 'llama_model.bin'), 'wb') as f:
+            f.write(b'stand-in')
+        with open(spec_path, 'w') as f:
+            json.dump(spec, f)
+        print(f"Prepared {spec['count']} image(s) and the stand-in models in {time.time() - start_time:.1f} seconds")
+    return {}
+
+
+def timed_calls(function, items):
+    """Call function(item) for every item after one untimed warm-up call, returning the result fields"""
+    function(items[0])
+    samples = []
+    start_time = time.perf_counter()
+    for item in items:
+        call_start = time.perf_counter()
+        function(item)
+        samples.append(time.perf_counter() - call_start)
+    seconds = time.perf_counter() - start_time
+    return {'images': len(items), 'seconds': round(seconds, 3), 'images_per_s': round(len(items) / seconds, 3),
+            'latency_ms': percentiles(samples), 'peak_rss_mb': peak_rss_mb()}
+
+
+def traced_result(summary, phase):
+    return {'images': summary['images'], 'seconds': summary['elapsed_s'], 'images_per_s': summary['images_per_s'],
+            'latency_ms': summary['phases'].get(phase, {}).get('latency_ms'),
+            'peak_rss_mb': summary['peak_rss_mb'], 'peak_child_rss_mb': summary['peak_child_rss_mb'],
+            'phases': summary['phases']}
+
+
+def last_summary(trace_path):
+    summary = None
+    with open(trace_path) as f:
+        for line in f:
+            event = json.loads(line)
+            if event['type'] == 'summary':
+                summary = event
+    return summary
+
+
+def start_tracer(work_dir, stage):
+    trace_path = os.path.join(work_dir, f"{stage}.trace.jsonl")
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    return tracer_from_args(argparse.Namespace(trace=trace_path, trace_summary_interval=float('inf')), stage)
+
+
+def image_paths(work_dir):
+    from common.scan import scan_images
+    return list(scan_images(os.path.join(work_dir, 'images')))
+
+
+def wd14_model(work_dir):
+    directory = os.path.join(work_dir, 'wd14_model')
+    return os.path.join(directory, 'model.onnx'), os.path.join(directory, 'selected_tags.csv')
+
+
+def case_preprocess_image(settings, work_dir):
+    from PIL import Image
+    import caption_wd14
+
+    def preprocess(image_path):
+        with Image.open(image_path) as image:
+            caption_wd14.preprocess_image(image)
+
+    return timed_calls(preprocess, image_paths(work_dir))
+
+
+def case_run_model(settings, work_dir):
+    import caption_wd14
+    from ort_sessions import create_session, quantized_model, session_options
+
+    model_path, tags_path = wd14_model(work_dir)
+    if settings['quantize']:
+        model_path = quantized_model(model_path, os.path.join(work_dir, 'ort_cache'), 'stand-in/wd14')
+    session = create_session(model_path, session_options(settings['ort_preset'], settings['num_threads']),
+                             ['CPUExecutionProvider'], name='stand-in/wd14')
+    return timed_calls(lambda image_path: caption_wd14.run_model(image_path, model_path, tags_path, session,
+                                                                 settings['threshold'], []),
+                       image_paths(work_dir))
+
+
+def case_wd14(settings, work_dir):
+    import caption_wd14
+
+    model_path, tags_path = wd14_model(work_dir)
+    caption_wd14.download_model_files = lambda model_repo_id: (model_path, tags_path)
+    arguments = ['--input_directory', os.path.join(work_dir, 'images'), '--model_repo_id', 'stand-in/wd14',
+                 '--threshold', str(settings['threshold']), '--filter', '--batch_size', str(settings['batch_size']),
+                 '--loader_workers', str(settings['loader_workers']), '--quiet', '--ort_preset', settings['ort_preset'],
+                 '--ort_cache_dir', os.path.join(work_dir, 'ort_cache')]
+    if settings['num_threads']:
+        arguments += ['--num_threads', str(settings['num_threads'])]
+    if settings['quantize']:
+        arguments += ['--quantize', settings['quantize']]
+    tracer = start_tracer(work_dir, 'wd14')
+    caption_wd14.main(caption_wd14.parse_args(arguments))
+    return traced_result(tracer.close(), CASES['wd14'][1])
+
+
+def case_blip2(settings, work_dir):
+    stand_ins.install_lavis()
+    import caption_blip2
+    from common.prefetch import Prefetcher
+    from common.torch_inference import compute_dtype, configure_threads
+
+    configure_threads(settings['num_threads'])
+    blip = caption_blip2.BLIP2(device='cpu', model_name='blip2_t5/pretrain_flant5xxl', generate_kwargs={
+        'use_nucleus_sampling': False, 'num_beams': settings['num_beams'], 'max_length': settings['max_length'],
+        'min_length': 1, 'top_p': 1.0}, dtype=compute_dtype('cpu', settings['bf16'], settings['quantize']),
+        quantize=settings['quantize'])
+    args = caption_blip2.parse_args(['--dir', os.path.join(work_dir, 'images'), '--device', 'cpu',
+                                     '--batch_size', str(settings['batch_size']), '--quiet'])
+    tracer = start_tracer(work_dir, 'blip2')
+    caption_blip2.gen_caps_for_dir(blip, args, Prefetcher(settings['loader_workers']))
+    return traced_result(tracer.close(), CASES['blip2'][1])
+
+
+def case_open_flamingo(settings, work_dir):
+    import runpy
+
+    # made on first use, in the stage's venv, which has open_flamingo and transformers
+    model_directory = os.path.join(work_dir, 'flamingo_model')
+    if not os.path.exists(os.path.join(model_directory, 'checkpoint.pt')):
+        stand_ins.make_flamingo_model(model_directory, settings['seed'])
+    examples = stand_ins.install_flamingo(model_directory)
+    trace_path = os.path.join(work_dir, 'open_flamingo.trace.jsonl')
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    arguments = ['--img_dir', os.path.join(work_dir, 'images'), '--example_img_dir', examples,
+                 '--model', stand_ins.FLAMINGO_MODEL, '--device', 'cpu', '--batch_size', str(settings['batch_size']),
+                 '--num_beams', str(settings['num_beams']), '--max_new_tokens', str(settings['max_length']),
+                 '--min_new_tokens', str(settings['max_length']), '--loader_workers', str(settings['loader_workers']),
+                 '--bf16', settings['bf16'], '--quiet', '--trace', trace_path, '--trace_summary_interval', 'inf']
+    if settings['num_threads']:
+        arguments += ['--num_threads', str(settings['num_threads'])]
+    if settings['quantize']:
+        arguments += ['--quantize', settings['quantize']]
+    if settings['no_prefix_cache']:
+        arguments += ['--no_prefix_cache']
+    if settings['weights_cache']:
+        arguments += ['--weights_cache_dir', os.path.join(work_dir, 'flamingo_cache')]
+    run_main(lambda: runpy.run_path('caption_flamingo.py', run_name='__main__'), arguments)
+    return traced_result(last_summary(trace_path), CASES['open_flamingo'][1])
+
+
+def run_main(main, arguments):
+    saved_argv, saved_cwd = sys.argv, os.getcwd()
+    sys.argv = [main.__module__] + arguments
+    try:
+        main()
+    finally:
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+
+
+def summarizer_arguments(settings, work_dir, stage):
+    trace_path = os.path.join(work_dir, f"{stage}.trace.jsonl")
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    return trace_path, ['--input_dir', os.path.join(work_dir, 'captions'), '--max_tokens', str(settings['max_tokens']),
+                        '--quiet', '--trace', trace_path, '--trace_summary_interval', 'inf']
+
+
+def case_summarize_llama(settings, work_dir):
+    stand_ins.install_llama(settings['llama_prompt_ms'], settings['llama_token_ms'])
+    import summarize_with_llama
+
+    model_path = os.path.join(work_dir, 'llama_model.bin')
+    summarize_with_llama.hf_hub_download = lambda repo_id, filename: model_path
+    trace_path, arguments = summarizer_arguments(settings, work_dir, 'summarize_llama')
+    arguments += ['--n_threads', str(settings['num_threads'] or 4)]
+    if settings['no_prompt_cache']:
+        arguments += ['--no_prompt_cache']
+    run_main(summarize_with_llama.main, arguments)
+    result = traced_result(last_summary(trace_path), CASES['summarize_llama'][1])
+    # prompt and completion tokens per second, reused ones included, like the summarizer's effective tokens/sec
+    result['tokens_per_s'] = round(stand_ins.FakeLlama.tokens / result['seconds'], 1)
+    return result
+
+
+def case_summarize_gpt(settings, work_dir):
+    stand_ins.install_tiktoken()
+    import summarize_with_gpt
+
+    trace_path, arguments = summarizer_arguments(settings, work_dir, 'summarize_gpt')
+    with stand_ins.MockChatServer(settings['api_latency_ms']) as server:
+        run_main(summarize_with_gpt.main, arguments + ['--api_base', server.url, '--api_key', 'benchmark',
+                                                       '--concurrency', str(settings['concurrency'])])
+    return traced_result(last_summary(trace_path), CASES['summarize_gpt'][1])
+
+
+def run_case(case, work_dir):
+    with open(os.path.join(work_dir, 'settings.json')) as f:
+        settings = json.load(f)
+    # the stage's own directory is the working directory, and its modules import each other from there
+    sys.path.insert(0, os.getcwd())
+    result = globals()[f"case_{case}"](settings, work_dir) if case in CASES else prepare(settings, work_dir)
+    result['python'] = platform.python_version()
+    with open(os.path.join(work_dir, f"{case}.result.json"), 'w') as f:
+        json.dump(result, f)
+
+
+def format_latency(result):
+    latency = result.get('latency_ms')
+    if not latency:
+        return f"{'-':>9} {'-':>9} {'-':>9}"
+    return f"{latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9}"
+
+
+def change(new, old):
+    if new is None or not old:
+        return '-'
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def print_report(results, settings, baseline=None):
+    print(f"\n{'case':<17} {'images':>6} {'images/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak RSS MB':>11}")
+    for case, result in results.items():
+        if result is None:
+            print(f"{case:<17} failed")
+            continue
+        print(f"{case:<17} {result['images']:>6} {result['images_per_s'] or 0:>9.2f} {format_latency(result)} "
+              f"{result['peak_rss_mb'] or '-':>11}")
+    for case, result in results.items():
+        if result is not None and result.get('tokens_per_s'):
+            print(f"{case}: {result['tokens_per_s']} tokens/s")
+    if baseline is None:
+        return
+    print(f"\nChange against the baseline ({baseline['created']}):")
+    print(f"{'case':<17} {'images/s':>9} {'p50':>9} {'p95':>9} {'peak RSS':>9}")
+    for case, result in results.items():
+        old = baseline['results'].get(case)
+        if result is None or old is None:
+            continue
+        new_latency, old_latency = result.get('latency_ms') or {}, old.get('latency_ms') or {}
+        print(f"{case:<17} {change(result['images_per_s'], old['images_per_s']):>9} "
+              f"{change(new_latency.get('p50'), old_latency.get('p50')):>9} "
+              f"{change(new_latency.get('p95'), old_latency.get('p95')):>9} "
+              f"{change(result['peak_rss_mb'], old['peak_rss_mb']):>9}")
+        if result.get('tokens_per_s') and old.get('tokens_per_s'):
+            print(f"{case}: tokens/s {change(result['tokens_per_s'], old['tokens_per_s'])}")
+    if dataset_spec(baseline['settings']) != dataset_spec(settings):
+        print("The baseline was measured on a different dataset, the numbers aren't comparable")
+
+
+def median_run(runs):
+    runs = sorted(runs, key=lambda result: result['images_per_s'] or 0)
+    return runs[len(runs) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage offline with stand-in models")
+    parser.add_argument('--work_dir', default=os.path.join(tempfile.gettempdir(), 'captionfusionator_benchmark'),
+                        help="Where the dataset, stand-in models and outputs are kept between runs")
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES), help="Cases to run, default all")
+    parser.add_argument('--dataset', choices=list(stand_ins.DATASETS), default='mixed',
+                        help="Preset image sizes: small (512x512), mixed aspect ratios, or large (up to 3000x2000)")
+    parser.add_argument('--sizes', nargs='+', default=None, help="Image sizes as WIDTHxHEIGHT, instead of --dataset")
+    parser.add_argument('--count', type=int, default=64, help="Number of images")
+    parser.add_argument('--alpha_fraction', type=float, default=0.25, help="Fraction of the images that are PNGs with alpha")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help="Run every case this many times and report the median run")
+    parser.add_argument('--python', default=None, help="Run every case with this python instead of the stage venvs")
+    parser.add_argument('--batch_size', type=int, default=8, help="Batch size of the wd14, blip2 and open_flamingo cases")
+    parser.add_argument('--loader_workers', type=int, default=4,
+                        help="Prefetch workers of the wd14, blip2 and open_flamingo cases")
+    parser.add_argument('--num_threads', type=int, default=None, help="CPU threads of the models, default their own")
+    parser.add_argument('--threshold', type=float, default=0.35, help="wd14 tag threshold")
+    parser.add_argument('--ort_preset', default='throughput', help="onnxruntime session preset of the wd14 cases")
+    parser.add_argument('--quantize', choices=['int8'], default=None,
+                        help="Run the wd14 cases on the quantized model and the blip2 and open_flamingo cases with an "
+                             "int8 language model")
+    parser.add_argument('--bf16', choices=['auto', 'on', 'off'], default='auto',
+                        help="bfloat16 autocast of the blip2 and open_flamingo cases")
+    parser.add_argument('--num_beams', type=int, default=10, help="blip2 and open_flamingo beams")
+    parser.add_argument('--max_length', type=int, default=48, help="blip2 and open_flamingo caption length in tokens")
+    parser.add_argument('--no_prefix_cache', action='store_true',
+                        help="Encode the open_flamingo few-shot examples for every batch instead of once")
+    parser.add_argument('--weights_cache', action='store_true',
+                        help="Load the open_flamingo checkpoints from converted safetensors copies kept in --work_dir")
+    parser.add_argument('--max_tokens', type=int, default=75, help="Summary length in tokens")
+    parser.add_argument('--llama_prompt_ms', type=float, default=0.5, help="Fake llama time per evaluated prompt token")
+    parser.add_argument('--llama_token_ms', type=float, default=5.0, help="Fake llama time per generated token")
+    parser.add_argument('--no_prompt_cache', action='store_true',
+                        help="Run the summarize_llama case without the evaluated system prompt state")
+    parser.add_argument('--api_latency_ms', type=float, default=300, help="Mock chat endpoint time per request")
+    parser.add_argument('--concurrency', type=int, default=8, help="GPT summarizer requests in flight")
+    parser.add_argument('--output', default=None, help="Write the report to this JSON file")
+    parser.add_argument('--compare', default=None, help="Print the change against a report written with --output")
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.work_dir = os.path.abspath(args.work_dir)
+
+    if args.child:
+        run_case(args.child, args.work_dir)
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    settings = {key: value for key, value in vars(args).items() if key not in ('child', 'compare', 'output', 'work_dir')}
+    settings['sizes'] = args.sizes or stand_ins.DATASETS[args.dataset]
+    os.makedirs(args.work_dir, exist_ok=True)
+    with open(os.path.join(args.work_dir, 'settings.json'), 'w') as f:
+        json.dump(settings, f)
+
+    if run_child(args, 'prepare', stage_python(args, PREPARE_STAGE)) is None:
+        sys.exit(1)
+    results = {}
+    for case in args.cases:
+        python = stage_python(args, CASES[case][0])
+        runs = []
+        for run in range(args.repeat):
+            print(f"Running {case} ({run + 1}/{args.repeat}) with {python}")
+            result = run_child(args, case, python)
+            if result is None:
+                break
+            runs.append(result)
+        results[case] = median_run(runs) if len(runs) == args.repeat else None
+
+    print_report(results, settings, baseline)
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'platform': platform.platform(),
+              'cpu_count': os.cpu_count(), 'settings': settings, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+    if any(result is None for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+# Stand-ins for the datasets, models and services the stages normally need, so the benchmark runs on
+# any CPU-only machine without downloads or network access:
+#
+#   - synthetic image datasets in several sizes and aspect ratios, some with an alpha channel
+#   - a random ONNX model with the real WD14 input/output shapes and tag vocabulary
+#   - a tiny torch captioner behind a fake `lavis.models.load_model_and_preprocess` for BLIP-2
+#   - a small random Open Flamingo, a CLIP ViT and a GPT-NeoX language model saved like the real
+#     checkpoints, with a few precaptioned examples
+#   - a fake `llama_cpp.Llama` whose prompt evaluation and generation cost a fixed time per token
+#   - a local OpenAI compatible chat completions endpoint answering after a fixed latency, and a fake
+#     `tiktoken` for counting its prompt tokens
+#
+# The stand-ins keep the shapes and call patterns of the real thing, so the stage code around them does
+# the same work it does in production; only the model compute itself is replaced. Heavy libraries are
+# imported where they are used, so every stage's venv can import this module.
+import os
+import re
+import csv
+import sys
+import json
+import time
+import inspect
+import types
+import zlib
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WD14_TAGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wd14', 'tags.csv')
+WD14_IMAGE_SIZE = 448
+BLIP2_IMAGE_SIZE = 224
+FLAMINGO_MODEL = 'stand-in/open_flamingo'
+FLAMINGO_VISION = 'stand-in-ViT'
+WORDS = ('a', 'the', 'girl', 'cat', 'standing', 'sitting', 'in', 'on', 'front', 'of', 'house', 'field', 'with',
+         'red', 'blue', 'hair', 'dress', 'sky', 'tree', 'water', 'holding', 'umbrella', 'smiling', 'city', 'night')
+
+DATASETS = {
+    'small': ['512x512'],
+    'mixed': ['512x512', '768x1152', '1216x832', '1920x1080', '640x1600'],
+    'large': ['3000x2000', '2048x2048', '2000x3000'],
+}
+
+
+def parse_size(size):
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+def _sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+def make_dataset(directory, count, sizes, alpha_fraction=0.25, seed=0):
+    """Write `count` images cycling through `sizes`; that fraction of them are PNGs with alpha, the rest JPEGs"""
+    import numpy as np
+    from PIL import Image
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for index in range(count):
+        width, height = parse_size(sizes[index % len(sizes)])
+        # smooth noise upscaled from a coarse grid compresses and decodes like a photo, unlike static
+        coarse = rng.integers(0, 256, (max(2, height // 64), max(2, width // 64), 3), dtype=np.uint8)
+        pixels = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+        pixels += rng.integers(-12, 13, pixels.shape, dtype=np.int16)
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        # spread the alpha images evenly so every size gets some
+        if int((index + 1) * alpha_fraction) > int(index * alpha_fraction):
+            y, x = np.ogrid[:height, :width]
+            distance = np.hypot((x - width / 2) / width, (y - height / 2) / height)
+            image.putalpha(Image.fromarray(np.clip(255 - distance * 400, 0, 255).astype(np.uint8)))
+            path = os.path.join(directory, f"{index:05d}_{width}x{height}.png")
+            image.save(path)
+        else:
+            path = os.path.join(directory, f"{index:05d}_{width}x{height}.jpg")
+            image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def make_caption_fixtures(directory, count, seed=0, tags_path=WD14_TAGS):
+    """
+    Write what the captioning stages leave behind for `count` images: an empty placeholder image and
+    .b2cap, .flamcap and .wd14cap captions in the stages' formats. The summarizers never open the
+    images, so their benchmarks don't depend on the captioning benchmarks or on the image sizes.
+    """
+    with open(tags_path, newline='') as f:
+        names = [row['name'] for row in csv.DictReader(f) if row['category'] != '9']
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    for index in range(count):
+        base = os.path.join(directory, f"{index:05d}")
+        open(f"{base}.jpg", 'w').close()
+        with open(f"{base}.b2cap", 'w') as f:
+            f.write(_sentence(rng, rng.randint(6, 14)))
+        with open(f"{base}.flamcap", 'w') as f:
+            f.write(f"An image of {_sentence(rng, rng.randint(10, 24))}.")
+        scores = sorted((rng.uniform(0.35, 1.0) for _ in range(rng.randint(15, 40))), reverse=True)
+        with open(f"{base}.wd14cap", 'w') as f:
+            f.write(''.join(f"[{name}: {score:.2f}], " for name, score in zip(rng.sample(names, len(scores)), scores)))
+
+
+def make_wd14_model(directory, tags_path=WD14_TAGS, seed=0):
+    """
+    Export a random tagger with the WD14 interface: float32 BGR NHWC [batch, 448, 448, 3] in, one sigmoid
+    score per tag of selected_tags.csv out. Its biases keep a few dozen tags above the usual thresholds,
+    so captions have realistic lengths. Returns the model and tags paths.
+    """
+    import torch
+    import shutil
+
+    class Tagger(torch.nn.Module):
+        def __init__(self, num_tags, hidden=256):
+            super().__init__()
+            self.features = torch.nn.Conv2d(3, hidden, kernel_size=16, stride=16)
+            # MatMul and Add rather than Gemm, like the dense layers of the Keras exports
+            self.mixer = torch.nn.Parameter(torch.randn(hidden, hidden) / hidden ** 0.5)
+            self.weight = torch.nn.Parameter(torch.randn(hidden, num_tags) * 2 / hidden ** 0.5)
+            self.bias = torch.nn.Parameter(torch.randn(num_tags) - 3.5)
+
+        def forward(self, images):
+            tokens = self.features(images.permute(0, 3, 1, 2) / 255.0).flatten(2).transpose(1, 2)
+            features = torch.relu(torch.matmul(tokens, self.mixer)).mean(dim=1)
+            return torch.sigmoid(torch.matmul(features, self.weight) + self.bias)
+
+    with open(tags_path, newline='') as f:
+        num_tags = sum(1 for _ in csv.DictReader(f))
+    torch.manual_seed(seed)
+    os.makedirs(directory, exist_ok=True)
+    model_path = os.path.join(directory, 'model.onnx')
+    # torch 2.9 and later export with dynamo by default, which needs onnxscript; the TorchScript exporter
+    # needs nothing beyond torch
+    exporter = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(Tagger(num_tags).eval(), torch.zeros(1, WD14_IMAGE_SIZE, WD14_IMAGE_SIZE, 3), model_path,
+                      input_names=['input_1:0'], output_names=['predictions_sigmoid'],
+                      dynamic_axes={'input_1:0': {0: 'batch'}, 'predictions_sigmoid': {0: 'batch'}}, **exporter)
+    selected_tags = os.path.join(directory, 'selected_tags.csv')
+    shutil.copyfile(tags_path, selected_tags)
+    return model_path, selected_tags
+
+
+def install_lavis():
+    """
+    Make `from lavis.models import load_model_and_preprocess` return a tiny captioner: a strided conv
+    encoder and an MLP decoder that runs one step per output token and beam, so batch size, num_beams
+    and max_length change the cost the way they do for BLIP-2. The decoder sits where BLIP-2 keeps its
+    language model, so --quantize int8 quantizes it.
+    """
+    import numpy as np
+    import torch
+
+    class TinyCaptioner(torch.nn.Module):
+        def __init__(self, hidden=512, vocab=1024):
+            super().__init__()
+            self.encoder = torch.nn.Conv2d(3, hidden, kernel_size=16, stride=16)
+            self.embedding = torch.nn.Embedding(vocab, hidden)
+            self.t5_model = torch.nn.ModuleDict({
+                'step': torch.nn.Sequential(torch.nn.Linear(2 * hidden, 4 * hidden), torch.nn.GELU(),
+                                            torch.nn.Linear(4 * hidden, hidden), torch.nn.Tanh()),
+                'head': torch.nn.Linear(hidden, vocab),
+            })
+
+        @torch.no_grad()
+        def generate(self, samples, use_nucleus_sampling=False, num_beams=1, max_length=30, min_length=1,
+                     top_p=0.9, **kwargs):
+            images = samples["image"]
+            state = self.encoder(images).flatten(2).mean(dim=2).repeat_interleave(num_beams, dim=0)
+            token = torch.zeros(state.shape[0], dtype=torch.long, device=images.device)
+            tokens = []
+            for _ in range(max_length):
+                state = self.t5_model['step'](torch.cat([self.embedding(token).to(state.dtype), state], dim=1))
+                token = self.t5_model['head'](state).argmax(dim=1)
+                tokens.append(token)
+            best = torch.stack(tokens, dim=1)[::num_beams].tolist()
+            return [' '.join(WORDS[token % len(WORDS)] for token in row[:max(min_length, 8)]) for row in best]
+
+    mean = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+    std = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+    def eval_processor(image):
+        from PIL import Image
+        pixels = np.asarray(image.convert('RGB').resize((BLIP2_IMAGE_SIZE, BLIP2_IMAGE_SIZE), Image.BICUBIC),
+                            dtype=np.float32) / 255.0
+        return torch.from_numpy(((pixels - mean) / std).transpose(2, 0, 1).copy())
+
+    def load_model_and_preprocess(name, model_type, is_eval=False, device='cpu'):
+        torch.manual_seed(0)
+        model = TinyCaptioner().to(device)
+        return model.eval() if is_eval else model, {"eval": eval_processor}, {}
+
+    lavis = types.ModuleType('lavis')
+    models = types.ModuleType('lavis.models')
+    models.load_model_and_preprocess = load_model_and_preprocess
+    lavis.models = models
+    sys.modules['lavis'] = lavis
+    sys.modules['lavis.models'] = models
+
+
+def _flamingo_paths(directory):
+    return (os.path.join(directory, f"{FLAMINGO_VISION}.json"), os.path.join(directory, 'lm'),
+            os.path.join(directory, 'checkpoint.pt'), os.path.join(directory, 'examples'))
+
+
+def make_flamingo_model(directory, seed=0, examples=2):
+    """
+    Save a random Open Flamingo the way the real one is published: an open_clip config for its vision
+    encoder, a GPT-NeoX language model and tokenizer in a transformers directory, with pickled weights like
+    most of the hub's language models, and a checkpoint.pt with the perceiver, the cross attention layers
+    and the resized embeddings. The language model is big enough (about 30M parameters) for loading and
+    prefix reuse to show up in the timings. Also writes `examples` precaptioned images for the prompt.
+    Returns the directory.
+    """
+    import numpy as np
+    import torch
+    import open_clip
+    from PIL import Image
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, PreTrainedTokenizerFast
+    from open_flamingo import create_model_and_transforms
+
+    config_path, lm_path, checkpoint_path, examples_path = _flamingo_paths(directory)
+    os.makedirs(examples_path, exist_ok=True)
+    with open(config_path, 'w') as f:
+        json.dump({'embed_dim': 256, 'vision_cfg': {'image_size': 224, 'layers': 4, 'width': 256, 'patch_size': 32},
+                   'text_cfg': {'context_length': 77, 'vocab_size': 1024, 'width': 128, 'heads': 2, 'layers': 1}}, f)
+    open_clip.add_model_config(config_path)
+
+    vocab = {'<unk>': 0, '<|endoftext|>': 1}
+    for word in WORDS + ('Output', ':', '.', ','):
+        vocab.setdefault(word, len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.WhitespaceSplit(), pre_tokenizers.Punctuation()])
+    tokenizer.decoder = decoders.WordPiece(prefix='##')
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token='<unk>', eos_token='<|endoftext|>',
+                            bos_token='<|endoftext|>').save_pretrained(lm_path)
+    torch.manual_seed(seed)
+    GPTNeoXForCausalLM(GPTNeoXConfig(vocab_size=len(vocab), hidden_size=512, num_hidden_layers=8, num_attention_heads=8,
+                                     intermediate_size=2048, max_position_embeddings=512, eos_token_id=1,
+                                     bos_token_id=1)).save_pretrained(lm_path, safe_serialization=False)
+
+    flamingo, _, _ = create_model_and_transforms(FLAMINGO_VISION, None, lm_path, lm_path, cross_attn_every_n_layers=2,
+                                                 decoder_layers_attr_name='gpt_neox.layers')
+    # the gates start closed, which would leave the images out of the captions
+    for name, parameter in flamingo.named_parameters():
+        if name.endswith('attn_gate') or name.endswith('ff_gate'):
+            parameter.data.fill_(0.5)
+    # like the released checkpoints, only what Flamingo trains on top of the frozen models
+    torch.save({name: parameter for name, parameter in flamingo.named_parameters() if parameter.requires_grad},
+               checkpoint_path)
+
+    rng = random.Random(seed)
+    pixels = np.random.default_rng(seed).integers(0, 256, (examples, 224, 224, 3), dtype=np.uint8)
+    for index in range(examples):
+        Image.fromarray(pixels[index]).save(os.path.join(examples_path, f"example{index}.jpg"))
+        with open(os.path.join(examples_path, f"example{index}.txt"), 'w') as f:
+            f.write(_sentence(rng, 12))
+    return directory
+
+
+def install_flamingo(directory):
+    """
+    Make the Open Flamingo stage load the model make_flamingo_model saved in directory as FLAMINGO_MODEL.
+    Must run in the stage's directory, where its model_loading module is imported from. Returns the
+    directory of the precaptioned examples.
+    """
+    import open_clip
+    import model_loading
+
+    config_path, lm_path, checkpoint_path, examples_path = _flamingo_paths(directory)
+    open_clip.add_model_config(config_path)
+    model_loading.MODELS[FLAMINGO_MODEL] = (FLAMINGO_VISION, None, lm_path, 'gpt_neox.layers', 2)
+    model_loading.hf_hub_download = lambda repo_id, filename: checkpoint_path
+    return examples_path
+
+
+def _token_id(piece):
+    return zlib.crc32(piece) % 32000 + 3
+
+
+class FakeLlama:
+    """
+    The parts of llama_cpp.Llama the llama summarizer uses. Every evaluated prompt token costs
+    prompt_ms and every generated token token_ms, and the context keeps its tokens, so prompt length
+    and prefix reuse show up in the timings as they do with a real model. `tokens` counts the prompt and
+    completion tokens of every call, evaluated or reused, across all instances.
+    """
+    prompt_ms = 0.5
+    token_ms = 5.0
+    tokens = 0
+
+    def __init__(self, model_path, n_ctx=512, **kwargs):
+        import numpy as np
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True):
+        # about one token per word or punctuation mark
+        tokens = [_token_id(piece) for piece in re.findall(rb'\w+|[^\w\s]', text)]
+        return [1] + tokens if add_bos else tokens
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens, seconds_per_token=None):
+        tokens = list(tokens)
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError(f"Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}")
+        time.sleep(len(tokens) * (self.prompt_ms / 1000 if seconds_per_token is None else seconds_per_token))
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+
+    def save_state(self):
+        return self.input_ids[:self.n_tokens].copy(), self.n_tokens
+
+    def load_state(self, state):
+        tokens, self.n_tokens = state
+        self.input_ids[:self.n_tokens] = tokens
+
+    @staticmethod
+    def longest_token_prefix(a, b):
+        length = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            length += 1
+        return length
+
+    def __call__(self, prompt, max_tokens=16, **kwargs):
+        tokens = self.tokenize(b" " + prompt.encode("utf-8"))
+        # like llama-cpp, reuse the common prefix with the context but always evaluate the last token
+        self.n_tokens = min(self.longest_token_prefix(self.input_ids[:self.n_tokens].tolist(), tokens[:-1]),
+                            len(tokens) - 1)
+        self.eval(tokens[self.n_tokens:])
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        words = [rng.choice(WORDS) for _ in range(min(max_tokens, self._n_ctx - self.n_tokens))]
+        self.eval([_token_id(word.encode()) for word in words], self.token_ms / 1000)
+        FakeLlama.tokens += len(tokens) + len(words)
+        return {'choices': [{'text': ' '.join(words), 'finish_reason': 'length'}],
+                'usage': {'prompt_tokens': len(tokens), 'completion_tokens': len(words),
+                          'total_tokens': len(tokens) + len(words)}}
+
+
+def install_llama(prompt_ms=0.5, token_ms=5.0):
+    """Make `from llama_cpp import Llama` return FakeLlama with these per-token costs"""
+    FakeLlama.prompt_ms = prompt_ms
+    FakeLlama.token_ms = token_ms
+    llama_cpp = types.ModuleType('llama_cpp')
+    llama_cpp.Llama = FakeLlama
+    sys.modules['llama_cpp'] = llama_cpp
+
+
+class FakeEncoding:
+    """tiktoken's Encoding.encode, with about one token per word or punctuation mark like FakeLlama"""
+
+    def encode(self, text):
+        return [_token_id(piece.encode()) for piece in re.findall(r'\w+|[^\w\s]', text)]
+
+
+def install_tiktoken():
+    """Make `import tiktoken` return encodings that need no download"""
+    tiktoken = types.ModuleType('tiktoken')
+    tiktoken.encoding_for_model = lambda model: FakeEncoding()
+    tiktoken.get_encoding = lambda name: FakeEncoding()
+    sys.modules['tiktoken'] = tiktoken
+
+
+class _ChatHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections when the client opens its whole pool at once, and
+    # their retried SYNs would add a second to some requests
+    request_queue_size = 128
+
+
+class MockChatServer:
+    """
+    OpenAI compatible /v1/chat/completions on localhost. Every request is answered after latency_ms
+    with max_tokens words and a usage block, on its own thread, so client concurrency pays off as it
+    does against the real API.
+    """
+
+    def __init__(self, latency_ms=300):
+        latency = latency_ms / 1000
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                time.sleep(latency)
+                prompt = json.dumps(payload['messages'])
+                rng = random.Random(zlib.crc32(prompt.encode('utf-8')))
+                words = [rng.choice(WORDS) for _ in range(payload.get('max_tokens') or 16)]
+                # about four characters per token, like the client's own estimate
+                usage = {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(words)}
+                usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+                body = json.dumps({
+                    'id': 'chatcmpl-benchmark', 'object': 'chat.completion', 'model': payload.get('model'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)},
+                                 'finish_reason': 'length'}],
+                    'usage': usage}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ChatHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
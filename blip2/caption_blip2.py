@@ -1,31 +1,71 @@
 import os
+import sys
 import time
 import gc
 import torch
+from functools import partial
 from lavis.models import load_model_and_preprocess
 import argparse
 from PIL import Image
-from glob import glob
 
-ALLOWED_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.prefetch import Prefetcher, add_prefetch_args, prefetcher_from_args
+from common.manifest import add_manifest_args, manifest_from_args
+from common.stream import add_stream_args, stream_from_args
+from common.caption_store import add_caption_store_args, caption_store_from_args, caption_exists, write_caption
+from common.daemon import add_daemon_args, daemon_from_args
+from common.scan import add_scan_args, scan_images
+from common.shard import add_shard_args, sharding_from_args
+from common.trace import add_trace_args, tracer_from_args, span
+from common.dedup import add_dedup_args, dedup_from_args
+from common.torch_inference import add_inference_args, compute_dtype, configure_threads, default_device, \
+    inference_context, quantize_linears
+
+# where the lavis BLIP-2 models keep their language model
+LANGUAGE_MODEL_ATTRIBUTES = ('t5_model', 'opt_model', 'llm_model')
+
+
+def str2bool(value):
+    if isinstance(value, bool):
+        return value
+    return value.lower() in ('true', '1', 'yes', 'y')
+
 
 class BLIP2:
     device = None
     max_length: int
 
-    def __init__(self, device, model_name: str = None, max_length=0) -> None:
+    def __init__(self, device, model_name: str = None, max_length=0, generate_kwargs: dict = None,
+                 dtype=torch.float32, quantize=None) -> None:
         if model_name is not None:
             self.model_name = model_name
         self.device = device
+        self.dtype = dtype
         self.max_length = max_length
+        # use_nucleus_sampling, num_beams, max_length, min_length, top_p, ... passed to model.generate
+        self.generate_kwargs = generate_kwargs or {}
         name, model_type = self.model_name.split('/')
         self.model, self.processor, _ = load_model_and_preprocess(
             name=name, model_type=model_type, is_eval=True, device=device
         )
+        if quantize is not None:
+            quantize_linears(self.language_model())
+
+    def language_model(self):
+        for attribute in LANGUAGE_MODEL_ATTRIBUTES:
+            if hasattr(self.model, attribute):
+                return getattr(self.model, attribute)
+        raise ValueError(f"{self.model_name} has no language model to quantize")
 
     def caption(self, img: Image) -> str:
-        image = self.processor["eval"](img).unsqueeze(0).to(self.device)
-        return self.model.generate({"image": image})[0]
+        return self.caption_batch([img])[0]
+
+    def caption_batch(self, images) -> list:
+        # accepts PIL images or tensors that already went through the eval processor
+        images = [img if torch.is_tensor(img) else self.processor["eval"](img) for img in images]
+        batch = torch.stack(images).to(self.device)
+        with inference_context(self.device, self.dtype):
+            return self.model.generate({"image": batch}, **self.generate_kwargs)
 
     def unload(self):
         del self.model
@@ -35,49 +75,151 @@ class BLIP2:
         gc.collect()
 
 
-def gen_caps_for_dir(caption_model, directory):
-    images = glob(os.path.join(directory, '*'))  # finds all files in the directory
+def load_image(img_path, processor):
+    with Image.open(img_path) as img:
+        with span('decode'):
+            img = img.convert('RGB')
+        with span('preprocess'):
+            return processor(img)
 
-    for img_path in images:
-        _, ext = os.path.splitext(img_path)
-        ext = ext.lower()
 
-        if ext not in ALLOWED_IMAGE_EXTENSIONS:
-            continue  # Skip non-image files
+def caption_path(img_path, output_file_extension):
+    name, _ = os.path.splitext(os.path.basename(img_path))
+    return os.path.join(os.path.dirname(img_path), f"{name}.{output_file_extension.lstrip('.')}")
 
-        img = Image.open(img_path).convert('RGB')
 
-        start_time = time.time()
-        caption = caption_model.caption(img)
+def gen_caps_for_dir(caption_model, args, prefetcher=None, manifest=None, store=None, sharding=None):
+    """Caption the images of args.dir with the settings of parse_args"""
+    dedup = dedup_from_args(args)
+    images = scan_images(args.dir, args.scan_index)
+    if dedup is not None:
+        images = dedup.representatives(images)
+    if prefetcher is None:
+        prefetcher = Prefetcher()
+    if sharding is None:
+        gen_caps_for_images(caption_model, images, args, prefetcher, manifest, store)
+    else:
+        sharding.run(partial(gen_caps_for_images, caption_model, args=args, prefetcher=prefetcher, manifest=manifest,
+                             store=store), images)
 
-        elapsed_time = time.time() - start_time
-        print(f"Time taken for '{img_path}': {elapsed_time:.2f} seconds")
+    prefetcher.report()
+    if manifest is not None:
+        manifest.close()
+    if store is not None:
+        store.close()
+    if dedup is not None:
+        dedup.close()
 
-        base = os.path.basename(img_path)
-        name, _ = os.path.splitext(base)
-        output_file_extension = args.output_file_extension.lstrip('.')
-        output_path = os.path.join(os.path.dirname(img_path), f"{name}.{output_file_extension}")
 
-        with open(output_path, "w") as file:
-            print(output_path)
-            print(caption)
-            file.write(caption)
+def gen_caps_for_images(caption_model, images, args, prefetcher, manifest=None, store=None):
+    batch_size, output_file_extension, quiet = args.batch_size, args.output_file_extension, args.quiet
+    if manifest is not None:
+        images = manifest.pending(images)
 
+    # decode and run the processor on background workers so the model never waits on disk
+    load = partial(load_image, processor=caption_model.processor["eval"])
 
-if __name__ == "__main__":
-    print('****STARTING BLIP2 PASS****')
+    def write_batch(batch_paths, batch_images):
+        start_time = time.time()
+        with span('generate', images=len(batch_paths)):
+            captions = caption_model.caption_batch(batch_images)
+
+        if not quiet:
+            elapsed_time = time.time() - start_time
+            print(f"Time taken for {len(batch_paths)} image(s): {elapsed_time:.2f} seconds")
+
+        for img_path, caption in zip(batch_paths, captions):
+            output_path = caption_path(img_path, output_file_extension)
+
+            if not quiet:
+                print(output_path)
+                print(caption)
+            write_caption(store, output_path, caption)
+            if manifest is not None:
+                manifest.record(img_path, output_path)
+
+    batch_paths, batch_images = [], []
+    for img_path, img in prefetcher.run(load, images):
+        batch_paths.append(img_path)
+        batch_images.append(img)
+        if len(batch_paths) == batch_size:
+            write_batch(batch_paths, batch_images)
+            batch_paths, batch_images = [], []
+    if batch_paths:
+        write_batch(batch_paths, batch_images)
+    if store is not None:
+        store.flush()
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='Generate captions for images in a directory')
-    parser.add_argument('--dir', required=True, help='Directory of images')
+    parser.add_argument('--dir', help='Directory of images. Not needed with --stream or --serve')
     parser.add_argument('--model', default="blip2_t5/pretrain_flant5xxl", help='Model name and type, separated by "/"')
-    parser.add_argument('--use_nucleus_sampling', default=False, help='whether or not to use nucleus sampling. Defaults to false')
-    parser.add_argument('--max_length', default=48, help='max blip2 caption length')
-    parser.add_argument('--min_length', default=False, help='min blip2 caption length')
-    parser.add_argument('--top_p', default=1.0)
-    parser.add_argument('--num_beams', default=10, help='number of beams')
+    parser.add_argument('--use_nucleus_sampling', type=str2bool, default=False, help='whether or not to use nucleus sampling. Defaults to false')
+    parser.add_argument('--max_length', type=int, default=48, help='max blip2 caption length')
+    parser.add_argument('--min_length', type=int, default=1, help='min blip2 caption length')
+    parser.add_argument('--top_p', type=float, default=1.0)
+    parser.add_argument('--num_beams', type=int, default=10, help='number of beams')
     parser.add_argument('--output_file_extension', default='b2cap',help='extension that caption files will be saved with')
+    parser.add_argument('--batch_size', type=int, default=1, help='number of images captioned per generate call')
+
+    add_inference_args(parser)
+    add_prefetch_args(parser)
+    add_manifest_args(parser)
+    add_stream_args(parser)
+    add_daemon_args(parser)
+    add_caption_store_args(parser)
+    add_scan_args(parser)
+    add_shard_args(parser)
+    add_trace_args(parser)
+    add_dedup_args(parser)
+
+    args = parser.parse_args(argv)
+    if not (args.dir or args.stream or args.serve):
+        parser.error('--dir is required')
+    if args.quantize and (args.device or default_device()) != 'cpu':
+        parser.error('--quantize only runs on the cpu')
+    return args
 
-    args = parser.parse_args()
 
-    blip = BLIP2(device='cuda', model_name=args.model)
-    gen_caps_for_dir(blip, args.dir)
+if __name__ == "__main__":
+    print('****STARTING BLIP2 PASS****')
+    args = parse_args()
+    configure_threads(args.num_threads, args.interop_threads)
+    device = args.device or default_device()
+    stream = stream_from_args(args)
+    tracer = tracer_from_args(args, 'blip2')
+
+    store = caption_store_from_args(args, 'blip2')
+    manifest = manifest_from_args(args, 'blip2', {
+        'model': args.model, 'use_nucleus_sampling': args.use_nucleus_sampling, 'max_length': args.max_length,
+        'min_length': args.min_length, 'top_p': args.top_p, 'num_beams': args.num_beams,
+        'output_file_extension': args.output_file_extension, **({'quantize': args.quantize} if args.quantize else {})},
+        store)
+    worker = stream or daemon_from_args(args, manifest)
+    sharding = sharding_from_args(args, args.dir, 'blip2') if worker is None else None
+
+    # lavis autocasts on the GPU itself
+    dtype = compute_dtype(device, args.bf16, args.quantize) if device == 'cpu' else torch.float32
+    print(f"Running BLIP2 on {device}" + (f" in {dtype}" if device == 'cpu' else "") +
+          (f" with {args.quantize} language model" if args.quantize else ""))
+
+    generate_kwargs = {
+        'use_nucleus_sampling': args.use_nucleus_sampling, 'num_beams': args.num_beams, 'max_length': args.max_length,
+        'min_length': args.min_length, 'top_p': args.top_p}
+    blip = BLIP2(device=device, model_name=args.model, generate_kwargs=generate_kwargs, dtype=dtype, quantize=args.quantize)
+    if worker is None:
+        gen_caps_for_dir(blip, args, prefetcher_from_args(args), manifest, store, sharding)
+    else:
+        prefetcher = prefetcher_from_args(args)
+        worker.run(partial(gen_caps_for_images, blip, args=args, prefetcher=prefetcher, manifest=manifest, store=store),
+                   partial(caption_path, output_file_extension=args.output_file_extension),
+                   partial(caption_exists, store))
+        prefetcher.report()
+        if manifest is not None:
+            manifest.close()
+        if store is not None:
+            store.close()
     blip.unload()
+    if tracer is not None:
+        tracer.close()
@@ -0,0 +1,3 @@
+# Code shared by the stages. Every stage runs in its own venv with its own dependencies, so these modules
+# only use the standard library and any stage can import them. The exceptions say so in their header:
+# torch_inference needs torch, and the hashing in dedup needs PIL and numpy.
@@ -0,0 +1,198 @@
+# Single-file caption store used instead of one small sidecar file per image and stage. On network
+# filesystems every sidecar costs a create, and every summarizer read costs a stat and an open, so
+# metadata latency ends up dominating large runs. Backed by SQLite, so all stages can share one store.
+#
+# Captions are keyed by the sidecar path they would otherwise be written to (e.g. /data/0001.wd14cap),
+# so naming, the manifest and `export` work exactly as with files. The table is append-only: a rewrite
+# adds a row and readers take the newest row per path; `compact` drops the superseded ones. Writes are
+# buffered and committed in bulk, and summarizers read a whole batch's captions with a few queries.
+#
+#   python -m common.caption_store export STORE [--ext wd14cap b2cap] [--skip_existing]
+#   python -m common.caption_store compact STORE
+import os
+import sys
+import time
+import hashlib
+import sqlite3
+import argparse
+
+from common.trace import span
+
+COMMIT_INTERVAL = 2.0
+COMMIT_ROWS = 1000
+# stays under SQLite's default limit of 999 bound parameters per statement
+QUERY_CHUNK = 500
+
+
+class CaptionStore:
+    def __init__(self, path, stage=None):
+        self.path = path
+        self.stage = stage
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS captions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, text TEXT, stage TEXT, created REAL);
+            CREATE INDEX IF NOT EXISTS captions_path ON captions (path, id);
+        ''')
+        self.buffer = {}
+        self.cache = {}
+        self.last_commit = time.monotonic()
+
+    def write(self, path, text):
+        path = os.path.abspath(path)
+        self.buffer[path] = text
+        if path in self.cache:
+            self.cache[path] = text
+        if len(self.buffer) >= COMMIT_ROWS or time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            now = time.time()
+            self.connection.executemany('INSERT INTO captions (path, text, stage, created) VALUES (?, ?, ?, ?)',
+                                        [(path, text, self.stage, now) for path, text in self.buffer.items()])
+            self.buffer.clear()
+        self.connection.commit()
+        self.last_commit = time.monotonic()
+
+    def _latest(self, paths):
+        found = {}
+        for start in range(0, len(paths), QUERY_CHUNK):
+            chunk = paths[start:start + QUERY_CHUNK]
+            # SQLite takes the bare `text` column from the row holding MAX(id)
+            rows = self.connection.execute(
+                f'SELECT path, text, MAX(id) FROM captions WHERE path IN ({",".join("?" * len(chunk))}) GROUP BY path',
+                chunk)
+            found.update((path, text) for path, text, _ in rows)
+        return found
+
+    def preload(self, paths):
+        """Read many captions at once; later reads of these paths are served from memory until the next preload"""
+        paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+        self.cache = dict.fromkeys(paths)
+        self.cache.update(self._latest(paths))
+        self.cache.update((path, text) for path, text in self.buffer.items() if path in self.cache)
+
+    def cached(self, paths):
+        return all(os.path.abspath(path) in self.cache or os.path.abspath(path) in self.buffer for path in paths)
+
+    def read(self, path):
+        path = os.path.abspath(path)
+        if path in self.buffer:
+            return self.buffer[path]
+        if path in self.cache:
+            return self.cache[path]
+        return self._latest([path]).get(path)
+
+    def exists(self, path):
+        return self.read(path) is not None
+
+    def content_hash(self, path):
+        text = self.read(path)
+        if text is None:
+            return None
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def items(self, extensions=None):
+        """Yield the newest (path, text) of every caption, optionally only for some extensions"""
+        for path, text, _ in self.connection.execute('SELECT path, text, MAX(id) FROM captions GROUP BY path'):
+            if extensions is None or os.path.splitext(path)[1].lstrip('.') in extensions:
+                yield path, text
+
+    def compact(self):
+        self.flush()
+        removed = self.connection.execute(
+            'DELETE FROM captions WHERE id NOT IN (SELECT MAX(id) FROM captions GROUP BY path)').rowcount
+        self.connection.commit()
+        self.connection.execute('VACUUM')
+        return removed
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+# Stages call these with store=None when no store is configured, which keeps the plain sidecar files.
+
+def write_caption(store, path, text):
+    with span('write', image=path):
+        if store is None:
+            with open(path, 'w') as f:
+                f.write(text)
+        else:
+            store.write(path, text)
+
+
+def read_captions(store, paths):
+    """Map every path that has a caption to its text"""
+    captions = {}
+    with span('read', images=0):
+        if store is not None:
+            if not store.cached(paths):
+                store.preload(paths)
+            for path in paths:
+                text = store.read(path)
+                if text is not None:
+                    captions[path] = text
+            return captions
+        for path in paths:
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    captions[path] = f.read()
+    return captions
+
+
+def caption_exists(store, path):
+    return os.path.exists(path) if store is None else store.exists(path)
+
+
+def add_caption_store_args(parser):
+    parser.add_argument("--caption_store", type=str, default=None,
+                        help="Path to a shared caption database to write captions to and read them from, instead of "
+                             "one sidecar file per image. `python -m common.caption_store export` writes the files.")
+
+
+def caption_store_from_args(args, stage):
+    if not args.caption_store:
+        return None
+    return CaptionStore(args.caption_store, stage)
+
+
+def export(store, extensions=None, skip_existing=False):
+    written = skipped = 0
+    for path, text in store.items(extensions):
+        if skip_existing and os.path.exists(path):
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        written += 1
+    print(f"Wrote {written} caption file(s), skipped {skipped} that already existed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or compact a caption store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help="Write every caption to its sidecar file")
+    export_parser.add_argument('store', help="Path to the caption store")
+    export_parser.add_argument('--ext', nargs='+', default=None,
+                               help="Only export these extensions, e.g. wd14cap txt. Defaults to all")
+    export_parser.add_argument('--skip_existing', action='store_true', help="Leave sidecar files that already exist alone")
+    compact_parser = subparsers.add_parser('compact', help="Drop captions that were superseded by a newer write")
+    compact_parser.add_argument('store', help="Path to the caption store")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.store):
+        print(f"{args.store} does not exist.")
+        sys.exit(1)
+    store = CaptionStore(args.store)
+    if args.command == 'export':
+        export(store, args.ext, args.skip_existing)
+    else:
+        print(f"Removed {store.compact()} superseded caption(s)")
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# Long-running captioning service: the stage loads its model once and then captions images sent to a
+# local HTTP endpoint, on TCP or on a Unix socket, instead of scanning a directory and exiting.
+#
+#   POST /caption  {"images": ["/abs/path.jpg", ...]}  ->  {"results": [{"image", "output", "ok"}, ...]}
+#   GET  /stats    queue depth, batch sizes and latency percentiles
+#
+# Requests that arrive close together are merged into one micro-batch: the model thread takes the
+# oldest request and keeps adding queued ones until the batch holds --max_batch_size images or the
+# oldest request has waited --max_wait_ms. The model only ever runs on the thread that called run(),
+# so stages keep their single-threaded model and manifest handling.
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+import socketserver
+import http.client
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.trace import percentiles
+
+LATENCY_SAMPLES = 1000
+
+
+def add_daemon_args(parser):
+    parser.add_argument('--serve', type=str, default=None, metavar='ADDRESS',
+                        help='Keep the model loaded and caption images sent to ADDRESS, either HOST:PORT or '
+                             'unix:/path/to.sock, instead of processing the input directory.')
+    parser.add_argument('--max_batch_size', type=int, default=16,
+                        help='With --serve, max images merged from concurrent requests into one batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=50,
+                        help='With --serve, max time a request waits for others to share its batch.')
+
+
+def daemon_from_args(args, manifest=None):
+    if not args.serve:
+        return None
+    return CaptionDaemon(args.serve, args.max_batch_size, args.max_wait_ms, manifest)
+
+
+class _Request:
+    def __init__(self, images):
+        self.images = images
+        self.arrived = time.monotonic()
+        self.started = None
+        self.finished = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.caption_daemon.stats())
+        else:
+            self._reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/caption':
+            self._reply(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            images = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['images']
+            if not isinstance(images, list) or not all(isinstance(image, str) for image in images):
+                raise TypeError
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'error': 'expected a JSON body like {"images": ["/abs/path.jpg"]}'})
+            return
+        # the daemon runs in its stage's directory, so relative paths would point somewhere else
+        relative = [image for image in images if not os.path.isabs(image)]
+        if relative:
+            self._reply(400, {'error': f'image paths must be absolute: {relative}'})
+            return
+
+        request = self.server.caption_daemon.submit(images)
+        request.finished.wait()
+        self._reply(200 if request.error is None else 500, {
+            'results': request.results, 'error': request.error,
+            'queue_ms': round((request.started - request.arrived) * 1000, 1),
+            'total_ms': round((time.monotonic() - request.arrived) * 1000, 1)})
+
+    def log_message(self, format, *args):
+        # one line per request would drown the stage's own output
+        pass
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            # BaseHTTPRequestHandler expects a (host, port) style client address
+            connection, _ = super().get_request()
+            return connection, ('unix', 0)
+
+
+class CaptionDaemon:
+    def __init__(self, address, max_batch_size=16, max_wait_ms=50, manifest=None):
+        self.address = address
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.manifest = manifest
+        self.queue = deque()
+        self.queued_images = 0
+        self.condition = threading.Condition()
+        self.busy = 0
+        self.started = time.monotonic()
+        self.batches = 0
+        self.images = 0
+        self.failed_batches = 0
+        self.queue_latency = deque(maxlen=LATENCY_SAMPLES)
+        self.total_latency = deque(maxlen=LATENCY_SAMPLES)
+        self.batch_latency = deque(maxlen=LATENCY_SAMPLES)
+
+    def _server(self):
+        if self.address.startswith('unix:'):
+            path = self.address[len('unix:'):]
+            if os.path.exists(path):
+                os.remove(path)  # left behind by a daemon that didn't shut down cleanly
+            server = _UnixHTTPServer(path, _Handler)
+        else:
+            host, _, port = self.address.rpartition(':')
+            server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), _Handler)
+            server.daemon_threads = True
+        server.caption_daemon = self
+        return server
+
+    def submit(self, images):
+        request = _Request(images)
+        with self.condition:
+            self.queue.append(request)
+            self.queued_images += len(images)
+            self.condition.notify()
+        return request
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.queue:
+                # wake up now and then so Ctrl+C is handled while idle
+                self.condition.wait(1)
+            batch = [self.queue.popleft()]
+            count = len(batch[0].images)
+            # the wait is counted from the oldest request, so one that queued behind a busy model goes straight away
+            deadline = batch[0].arrived + self.max_wait
+            while count < self.max_batch_size:
+                if self.queue:
+                    if count + len(self.queue[0].images) > self.max_batch_size:
+                        break
+                    request = self.queue.popleft()
+                    batch.append(request)
+                    count += len(request.images)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            self.queued_images -= sum(len(request.images) for request in batch)
+            self.busy = count
+            return batch
+
+    def run(self, process, output_path, exists=os.path.exists):
+        """Serve until interrupted, calling process(images) for every micro-batch on this thread.
+        output_path(image) is where the stage writes an image's result; it decides whether the image is done."""
+        server = self._server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving on {self.address}, micro-batches of up to {self.max_batch_size} image(s), "
+              f"waiting at most {self.max_wait * 1000:.0f}ms")
+        try:
+            while True:
+                batch = self._next_batch()
+                start = time.monotonic()
+                for request in batch:
+                    request.started = start
+                # the same image asked for by two requests is only captioned once
+                images = list(dict.fromkeys(image for request in batch for image in request.images))
+                error = None
+                try:
+                    process(images)
+                except Exception as e:
+                    traceback.print_exc()
+                    error = f"{type(e).__name__}: {e}"
+                    self.failed_batches += 1
+                if self.manifest is not None:
+                    self.manifest.commit()
+
+                done = time.monotonic()
+                self.batches += 1
+                self.images += len(images)
+                self.batch_latency.append(done - start)
+                for request in batch:
+                    request.results = []
+                    for image in request.images:
+                        path = str(output_path(image))
+                        request.results.append({'image': image, 'output': path,
+                                                'ok': error is None and exists(path)})
+                    request.error = error
+                    self.queue_latency.append(start - request.arrived)
+                    self.total_latency.append(done - request.arrived)
+                    request.finished.set()
+                self.busy = 0
+        except KeyboardInterrupt:
+            print("Shutting down")
+        finally:
+            server.shutdown()
+            server.server_close()
+            if self.address.startswith('unix:') and os.path.exists(self.address[len('unix:'):]):
+                os.remove(self.address[len('unix:'):])
+
+    def stats(self):
+        with self.condition:
+            queued_requests, queued_images = len(self.queue), self.queued_images
+        uptime = time.monotonic() - self.started
+        return {
+            'uptime_s': round(uptime, 1),
+            'queued_requests': queued_requests,
+            'queued_images': queued_images,
+            'images_in_batch': self.busy,
+            'batches': self.batches,
+            'images': self.images,
+            'failed_batches': self.failed_batches,
+            'mean_batch_size': round(self.images / self.batches, 2) if self.batches else None,
+            'images_per_s': round(self.images / uptime, 3) if uptime else None,
+            'latency_ms': {'queue': percentiles(self.queue_latency), 'batch': percentiles(self.batch_latency),
+                           'total': percentiles(self.total_latency)},
+        }
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def _connect(address, timeout):
+    if address.startswith('unix:'):
+        return _UnixHTTPConnection(address[len('unix:'):], timeout)
+    host, _, port = address.rpartition(':')
+    return http.client.HTTPConnection(host or '127.0.0.1', int(port), timeout=timeout)
+
+
+def request(address, method, path, body=None, timeout=None):
+    """Minimal client, e.g. request('unix:/tmp/wd14.sock', 'POST', '/caption', {'images': [...]})"""
+    connection = _connect(address, timeout)
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, body=data, headers={'Content-Type': 'application/json'} if data else {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
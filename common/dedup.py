@@ -0,0 +1,331 @@
+# Duplicate detection, so reposts, resized copies and re-encodes of an image are only captioned once.
+#
+#   python -m common.dedup index DIR --dedup_index PATH [--threshold 4]
+#   ... run the stages with --dedup_index PATH ...
+#   python -m common.dedup copy --dedup_index PATH --ext wd14cap b2cap flamcap txt
+#
+# `index` hashes every image twice: a content hash of the file for exact copies, and a 64-bit
+# perceptual hash (64 low frequencies of a 32x32 DCT of the grayscale image, above or below their
+# median) for copies that were resized or re-encoded. Images with the same content hash form one group.
+# Every other image joins the group of the nearest representative within --threshold bits of Hamming
+# distance, or starts a group of its own. Members are always compared with the representative, never
+# with each other, so a chain of small edits can't pull unrelated images into one group. Images are
+# visited largest first, so the representative is the copy with the most pixels.
+#
+# Representatives are looked up with multi-index hashing: the 64 bits are split into m chunks of about
+# log2(images) bits (at least 16), each with its own table. Two hashes within d bits of each other
+# differ in at most d // m bits in one of the chunks, so a query only reads the buckets within that
+# distance of each of its chunks, and most of those are empty, even with millions of images. Hashes are
+# cached by file size and mtime, so a rerun only hashes new or changed images.
+#
+# Stages given --dedup_index skip every image that isn't a representative, and `copy` writes the
+# representatives' captions (any extension, including the summaries) for their duplicates afterwards.
+# The hashing needs PIL and numpy, which every captioning venv has.
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from itertools import combinations
+from collections import defaultdict
+
+from common.hashing import file_digest
+from common.prefetch import Prefetcher
+from common.scan import scan_images
+from common.caption_store import CaptionStore, read_captions, write_caption
+
+HASH_SIZE = 8
+# bumped whenever perceptual_hash changes, since hashes of different versions can't be compared
+HASH_VERSION = 2
+DCT_SIZE = 32
+MIN_CHUNK_BITS = 16
+COMMIT_ROWS = 1000
+QUERY_CHUNK = 500
+LARGEST_GROUPS = 5
+
+
+def add_dedup_args(parser):
+    parser.add_argument("--dedup_index", type=str, default=None,
+                        help="Path to a duplicate index made with `python -m common.dedup index`. Only one image of every "
+                             "group of duplicates is processed; `python -m common.dedup copy` copies its outputs to the others.")
+
+
+def dedup_from_args(args):
+    if not args.dedup_index:
+        return None
+    return DedupIndex(args.dedup_index)
+
+
+def _dct_matrix():
+    import numpy as np
+    n = np.arange(DCT_SIZE)
+    return np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * DCT_SIZE))
+
+
+def perceptual_hash(path, dct=None):
+    """64-bit DCT hash of the image at path, and its pixel count"""
+    import numpy as np
+    from PIL import Image
+
+    dct = _dct_matrix() if dct is None else dct
+    with Image.open(path) as image:
+        pixels = image.width * image.height
+        # JPEGs are decoded at a fraction of their size, which is plenty for 32x32
+        image.draft('L', (DCT_SIZE * 4, DCT_SIZE * 4))
+        gray = np.asarray(image.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    coefficients = dct @ gray @ dct.T
+    # the DC term only carries the brightness and is above the median in almost every image, so it would
+    # be a constant bit; the next horizontal frequency takes its place to keep 64 informative bits
+    low = np.append(coefficients[:HASH_SIZE, :HASH_SIZE].flatten()[1:], coefficients[0, HASH_SIZE])
+    bits = low > np.median(low)
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big'), pixels
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count() if hasattr(int, 'bit_count') else bin(a ^ b).count('1')
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class MultiIndexHash:
+    """64-bit hashes in chunk tables, searchable by Hamming distance"""
+
+    def __init__(self, threshold, size):
+        # chunks about log2(size) bits wide leave most buckets empty, so a lookup reads next to nothing;
+        # more than threshold + 1 chunks can't narrow the search any further
+        count = max(1, min(threshold + 1, 64 // max(MIN_CHUNK_BITS, size.bit_length())))
+        self.threshold = threshold
+        self.bounds = [(64 * i // count, 64 * (i + 1) // count) for i in range(count)]
+        radius = threshold // count
+        self.flips = [[sum(1 << bit for bit in bits) for distance in range(radius + 1)
+                       for bits in combinations(range(end - start), distance)] for start, end in self.bounds]
+        self.tables = [defaultdict(list) for _ in self.bounds]
+
+    def _chunks(self, value):
+        return [(value >> start) & ((1 << (end - start)) - 1) for start, end in self.bounds]
+
+    def add(self, value, item):
+        for table, chunk in zip(self.tables, self._chunks(value)):
+            table[chunk].append((value, item))
+
+    def nearest(self, value):
+        """The (distance, item) of the nearest stored hash within the threshold, or None"""
+        best = None
+        for table, flips, chunk in zip(self.tables, self.flips, self._chunks(value)):
+            for flip in flips:
+                for stored, item in table.get(chunk ^ flip, ()):
+                    distance = hamming(value, stored)
+                    if distance <= self.threshold and (best is None or distance < best[0]):
+                        best = (distance, item)
+        return best
+
+
+def group_images(rows, threshold):
+    """
+    Map every path of rows (path, digest, phash, pixels, size) to its representative, and count the exact
+    and near duplicates
+    """
+    rows = sorted(rows, key=lambda row: (-row[3], -row[4], row[0]))
+    representatives = {}
+    by_digest = {}
+    index = MultiIndexHash(threshold, len(rows))
+    exact = near = 0
+    for path, digest, phash, pixels, size in rows:
+        if digest in by_digest:
+            representatives[path] = by_digest[digest]
+            exact += 1
+            continue
+        found = index.nearest(phash) if threshold >= 0 else None
+        if found is None:
+            representative = path
+            index.add(phash, path)
+        else:
+            representative = found[1]
+            near += 1
+        by_digest[digest] = representative
+        representatives[path] = representative
+    return representatives, exact, near
+
+
+class DedupIndex:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT, phash INTEGER, pixels INTEGER,
+                representative TEXT);
+            CREATE INDEX IF NOT EXISTS images_representative ON images (representative);
+        ''')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != HASH_VERSION:
+            # an index made by another version of the hash is hashed again from scratch
+            self.connection.execute('DELETE FROM images')
+            self.connection.execute(f'PRAGMA user_version = {HASH_VERSION}')
+            self.connection.commit()
+        self._duplicates = None
+
+    def update(self, images, num_workers=None):
+        """Hash the new and changed images, forget the ones that are gone; returns the number hashed"""
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.connection.execute('SELECT path, size, mtime_ns FROM images')}
+        seen = set()
+        stale = []
+        for image in images:
+            path = os.path.abspath(image)
+            seen.add(path)
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                stale.append((path, stat.st_size, stat.st_mtime_ns))
+        gone = [path for path in known if path not in seen]
+        for start in range(0, len(gone), QUERY_CHUNK):
+            chunk = gone[start:start + QUERY_CHUNK]
+            self.connection.execute(f'DELETE FROM images WHERE path IN ({",".join("?" * len(chunk))})', chunk)
+
+        dct = _dct_matrix()
+        stats = {path: (size, mtime_ns) for path, size, mtime_ns in stale}
+
+        def load(path):
+            phash, pixels = perceptual_hash(path, dct)
+            return file_digest(path), phash, pixels
+
+        prefetcher = Prefetcher(num_workers or os.cpu_count() or 1)
+        rows = []
+        for path, (digest, phash, pixels) in prefetcher.run(load, list(stats)):
+            size, mtime_ns = stats[path]
+            rows.append((path, size, mtime_ns, digest, _to_signed(phash), pixels))
+            if len(rows) >= COMMIT_ROWS:
+                self._put(rows)
+                rows = []
+        self._put(rows)
+        prefetcher.report()
+        return len(stale) - len(prefetcher.failures)
+
+    def _put(self, rows):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO images (path, size, mtime_ns, digest, phash, pixels) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def group(self, threshold):
+        """Pick the representative of every image; returns a summary of the groups"""
+        rows = [(path, digest, _to_unsigned(phash), pixels, size) for path, digest, phash, pixels, size in
+                self.connection.execute('SELECT path, digest, phash, pixels, size FROM images')]
+        representatives, exact, near = group_images(rows, threshold)
+        self.connection.executemany('UPDATE images SET representative = ? WHERE path = ?',
+                                    [(representative, path) for path, representative in representatives.items()])
+        self.connection.commit()
+        sizes = defaultdict(int)
+        for representative in representatives.values():
+            sizes[representative] += 1
+        largest = sorted(sizes.items(), key=lambda item: -item[1])[:LARGEST_GROUPS]
+        return {'images': len(rows), 'groups': len(sizes), 'exact': exact, 'near': near,
+                'largest': [(path, size) for path, size in largest if size > 1]}
+
+    def duplicates(self):
+        if self._duplicates is None:
+            self._duplicates = {path for path, in self.connection.execute(
+                'SELECT path FROM images WHERE representative IS NOT NULL AND representative != path')}
+        return self._duplicates
+
+    def representatives(self, images):
+        """Yield the images that aren't a duplicate of another"""
+        duplicates = self.duplicates()
+        skipped = 0
+        for image in images:
+            if os.path.abspath(image) in duplicates:
+                skipped += 1
+                continue
+            yield image
+        print(f"Skipped {skipped} duplicate image(s) listed in {self.path}")
+
+    def pairs(self):
+        """Yield (duplicate, representative) for every duplicate"""
+        yield from self.connection.execute(
+            'SELECT path, representative FROM images WHERE representative IS NOT NULL AND representative != path')
+
+    def close(self):
+        self.connection.close()
+
+
+def sidecar_path(image_path, extension):
+    return f"{os.path.splitext(image_path)[0]}.{extension.lstrip('.')}"
+
+
+def copy_captions(index, extensions, store=None):
+    """Write the representatives' captions for their duplicates; returns the number written"""
+    pairs = list(index.pairs())
+    written = 0
+    for start in range(0, len(pairs), QUERY_CHUNK):
+        chunk = pairs[start:start + QUERY_CHUNK]
+        sources = [sidecar_path(representative, extension) for _, representative in chunk for extension in extensions]
+        targets = [sidecar_path(duplicate, extension) for duplicate, _ in chunk for extension in extensions]
+        captions = read_captions(store, sources)
+        existing = read_captions(store, targets)
+        for source, target in zip(sources, targets):
+            if source in captions and existing.get(target) != captions[source]:
+                write_caption(store, target, captions[source])
+                written += 1
+    if store is not None:
+        store.flush()
+    return written
+
+
+def report(summary, hashed, seconds):
+    images, groups = summary['images'], summary['groups']
+    duplicates = images - groups
+    print(f"Hashed {hashed} new or changed image(s) in {seconds:.1f} seconds")
+    print(f"{images} image(s) in {groups} group(s): {summary['exact']} exact and {summary['near']} near duplicate(s)")
+    if images:
+        print(f"The stages run on {groups} image(s) instead of {images}, {duplicates / images:.1%} less work for "
+              f"every model and summarizer")
+    for path, size in summary['largest']:
+        print(f"  {size} copies of {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find duplicate images, or copy captions to them")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help="Hash the images and group the duplicates")
+    index_parser.add_argument('directory', help="Image directory")
+    index_parser.add_argument('--dedup_index', required=True, help="Path to the duplicate index")
+    index_parser.add_argument('--threshold', type=int, default=4,
+                              help="Max Hamming distance between the perceptual hashes of near duplicates, out of 64. "
+                                   "0 only groups images that look identical, -1 only exact copies. Default: 4")
+    index_parser.add_argument('--workers', type=int, default=None, help="Hashing threads. Defaults to the CPU count")
+    index_parser.add_argument('--scan_index', default=None, help="Directory index to scan with, see common/scan.py")
+    copy_parser = subparsers.add_parser('copy', help="Copy the captions of every representative to its duplicates")
+    copy_parser.add_argument('--dedup_index', required=True, help="Path to the duplicate index")
+    copy_parser.add_argument('--ext', nargs='+', required=True, help="Caption extensions to copy, e.g. wd14cap b2cap txt")
+    copy_parser.add_argument('--caption_store', default=None, help="Caption store the stages wrote to, see common/caption_store.py")
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        if not os.path.isdir(args.directory):
+            print(f"{args.directory} does not exist.")
+            sys.exit(1)
+        index = DedupIndex(args.dedup_index)
+        start_time = time.time()
+        hashed = index.update(scan_images(args.directory, args.scan_index), args.workers)
+        report(index.group(args.threshold), hashed, time.time() - start_time)
+        index.close()
+        return
+
+    if not os.path.isfile(args.dedup_index):
+        print(f"{args.dedup_index} does not exist.")
+        sys.exit(1)
+    index = DedupIndex(args.dedup_index)
+    store = CaptionStore(args.caption_store) if args.caption_store else None
+    print(f"Copied {copy_captions(index, args.ext, store)} caption(s) to duplicate images")
+    if store is not None:
+        store.close()
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+# Content hashing shared by the stages, so the same image gets the same key everywhere.
+import hashlib
+
+CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
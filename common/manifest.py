@@ -0,0 +1,106 @@
+# Per-image, per-stage record of finished work, so reruns only process new or changed images and a
+# crashed run resumes where it stopped. Backed by SQLite, so several stages can share one
+# manifest file.
+#
+# An entry is current when the image's content hash, the stage's parameters (model and generation
+# settings) and the hashes of any extra inputs (e.g. the caption files a summarizer reads) all match
+# what was recorded, and the recorded output file still exists. Content hashes are cached by file
+# size and mtime so unchanged files are not re-read on every run. With a caption store (see
+# common/caption_store.py) outputs and caption inputs are looked up in the store instead of on disk.
+import os
+import json
+import time
+import sqlite3
+
+from common.hashing import file_digest
+
+COMMIT_INTERVAL = 2.0
+
+
+class Manifest:
+    def __init__(self, path, stage, params, store=None):
+        self.path = path
+        self.stage = stage
+        self.store = store
+        self.params = json.dumps(params, sort_keys=True, default=str)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash TEXT);
+            CREATE TABLE IF NOT EXISTS entries (
+                image_path TEXT, stage TEXT, content_hash TEXT, params TEXT, output_path TEXT, updated REAL,
+                PRIMARY KEY (image_path, stage));
+        ''')
+        self.last_commit = time.monotonic()
+        self.skipped = 0
+
+    def digest(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.connection.execute('SELECT size, mtime_ns, content_hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        content_hash = file_digest(path)
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                (path, stat.st_size, stat.st_mtime_ns, content_hash))
+        return content_hash
+
+    def _key(self, image_path, inputs):
+        content_hash = self.digest(image_path)
+        for input_path in inputs or []:
+            if self.store is not None:
+                input_hash = self.store.content_hash(input_path)
+                if input_hash is not None:
+                    content_hash += ':' + input_hash
+            elif os.path.isfile(input_path):
+                content_hash += ':' + self.digest(input_path)
+        return content_hash
+
+    def is_done(self, image_path, inputs=None):
+        row = self.connection.execute('SELECT content_hash, params, output_path FROM entries WHERE image_path = ? AND stage = ?',
+                                      (os.path.abspath(image_path), self.stage)).fetchone()
+        exists = os.path.exists if self.store is None else self.store.exists
+        if row is None or row[1] != self.params or not exists(row[2]):
+            return False
+        return row[0] == self._key(image_path, inputs)
+
+    def pending(self, image_paths, inputs=None):
+        """Yield the images of image_paths that still need processing, checking them as they are consumed"""
+        # `inputs` maps an image path to the extra files its result depends on
+        for image_path in image_paths:
+            if self.is_done(image_path, inputs(image_path) if inputs else None):
+                self.skipped += 1
+            else:
+                yield image_path
+            self._commit_if_due()
+        self.commit()
+        if self.skipped:
+            print(f"Manifest: skipping {self.skipped} image(s) already processed by {self.stage}")
+
+    def record(self, image_path, output_path, inputs=None):
+        self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                                (os.path.abspath(image_path), self.stage, self._key(image_path, inputs), self.params,
+                                 os.path.abspath(output_path), time.time()))
+        self._commit_if_due()
+
+    def _commit_if_due(self):
+        if time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def add_manifest_args(parser):
+    parser.add_argument("--manifest", type=str, default=None, help="Path to a shared manifest database. Images already processed with the same settings are skipped.")
+
+
+def manifest_from_args(args, stage, params, store=None):
+    if not args.manifest:
+        return None
+    return Manifest(args.manifest, stage, params, store)
@@ -0,0 +1,90 @@
+# Background image loading shared by the captioning stages.
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from common.trace import enabled as tracing, record_collected, span, traced_call
+
+_DONE = object()
+
+
+class Prefetcher:
+    # run() calls `load(path)` on a pool of workers ahead of the consumer and yields (path, result) in
+    # input order. At most `queue_size` loads are queued or in flight, so memory stays bounded when the
+    # model is slower than the disk. Files that fail to load are skipped and collected in `failures`.
+    # Process workers need `load` to be picklable (a module level function or functools.partial).
+
+    def __init__(self, num_workers=4, queue_size=None, use_processes=False):
+        self.num_workers = num_workers
+        self.queue_size = queue_size or max(1, num_workers) * 2
+        self.use_processes = use_processes
+        self.failures = []
+
+    def run(self, load, paths):
+        if not tracing():
+            yield from self._run(load, paths)
+            return
+        # spans inside `load` are collected on the worker and recorded here, next to the image they belong to
+        for path, (result, collected) in self._run(partial(traced_call, load), paths):
+            record_collected(collected, path)
+            yield path, result
+
+    def _run(self, load, paths):
+        if self.num_workers <= 0:
+            yield from self._load_inline(load, paths)
+            return
+
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        executor = executor_class(max_workers=self.num_workers)
+        paths = iter(paths)
+        pending = deque()
+        try:
+            for path in paths:
+                pending.append((path, executor.submit(load, path)))
+                if len(pending) >= self.queue_size:
+                    break
+            while pending:
+                path, future = pending.popleft()
+                next_path = next(paths, _DONE)
+                if next_path is not _DONE:
+                    pending.append((next_path, executor.submit(load, next_path)))
+                try:
+                    # time the model spends waiting for the loaders
+                    with span('load_wait', image=path):
+                        result = future.result()
+                except Exception as e:
+                    self._skip(path, e)
+                    continue
+                yield path, result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _load_inline(self, load, paths):
+        for path in paths:
+            try:
+                result = load(path)
+            except Exception as e:
+                self._skip(path, e)
+                continue
+            yield path, result
+
+    def _skip(self, path, error):
+        print(f"Skipping unreadable image '{path}': {error}")
+        self.failures.append((path, error))
+
+    def report(self):
+        if not self.failures:
+            return
+        print(f"Skipped {len(self.failures)} unreadable image(s):")
+        for path, error in self.failures:
+            print(f"  {path}: {error}")
+
+
+def add_prefetch_args(parser):
+    parser.add_argument("--loader_workers", type=int, default=4, help="Background workers decoding images ahead of the model. 0 loads inline.")
+    parser.add_argument("--loader_queue_size", type=int, default=None, help="Max images decoded ahead of the model. Defaults to twice the worker count.")
+    parser.add_argument("--loader_processes", action='store_true', help="Use worker processes instead of threads for image loading.")
+
+
+def prefetcher_from_args(args):
+    return Prefetcher(args.loader_workers, args.loader_queue_size, args.loader_processes)
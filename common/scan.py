@@ -0,0 +1,122 @@
+# Image discovery shared by every stage, so they all see the same images: the input directory and its
+# subdirectories are walked with os.scandir, extensions are matched case-insensitively, and paths are
+# yielded as they are found, so a stage can start on the first images while the rest of a large tree
+# is still being listed.
+#
+# With --scan_index the image names of every directory are kept in a small SQLite database. A later
+# scan stats each directory and only lists the ones whose mtime changed since (a file was added,
+# removed or renamed in it); everything else comes from the index.
+import os
+import json
+import time
+import sqlite3
+
+from common.trace import span
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+COMMIT_ROWS = 1000
+# a directory changed within this many seconds of the scan could change again without its mtime
+# moving on filesystems with coarse timestamps, so it is listed again next time
+RACY_SECONDS = 2
+
+
+def add_scan_args(parser):
+    parser.add_argument("--scan_index", type=str, default=None,
+                        help="Path to a shared directory index. Later scans only list directories that changed since, "
+                             "which saves most of the walk over large or network-mounted datasets.")
+
+
+def is_image(name, extensions=IMAGE_EXTENSIONS):
+    return os.path.splitext(name)[1].lower() in extensions
+
+
+class ScanIndex:
+    def __init__(self, path, extensions=IMAGE_EXTENSIONS):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, images TEXT, subdirectories TEXT);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        # the index only holds image names, so it is useless once the extensions change
+        extensions = json.dumps(sorted(extensions))
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'extensions'").fetchone()
+        if row is None or row[0] != extensions:
+            self.connection.execute('DELETE FROM directories')
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('extensions', ?)", (extensions,))
+            self.connection.commit()
+        self.updates = []
+        self.listed = 0
+        self.reused = 0
+
+    def get(self, path, mtime_ns):
+        row = self.connection.execute('SELECT mtime_ns, images, subdirectories FROM directories WHERE path = ?',
+                                      (path,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            return None
+        self.reused += 1
+        return json.loads(row[1]), json.loads(row[2])
+
+    def put(self, path, mtime_ns, images, subdirectories):
+        self.listed += 1
+        if time.time() - mtime_ns / 1e9 < RACY_SECONDS:
+            mtime_ns = -1
+        self.updates.append((path, mtime_ns, json.dumps(images), json.dumps(subdirectories)))
+        if len(self.updates) >= COMMIT_ROWS:
+            self.commit()
+
+    def commit(self):
+        if self.updates:
+            self.connection.executemany('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)', self.updates)
+            self.updates = []
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+        print(f"Scan index: listed {self.listed} changed directory(s), reused {self.reused} from {self.path}")
+
+
+def _list_directory(path, extensions):
+    images, subdirectories = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                # symlinked directories are not followed, which also rules out cycles
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.name)
+                elif is_image(entry.name, extensions) and entry.is_file():
+                    images.append(entry.name)
+            except OSError:
+                continue
+    return sorted(images), sorted(subdirectories)
+
+
+def scan_images(directory, index_path=None, extensions=IMAGE_EXTENSIONS, recursive=True):
+    """Yield the path of every image under `directory`, in a stable order"""
+    index = ScanIndex(index_path, extensions) if index_path else None
+    try:
+        stack = [os.path.abspath(directory)]
+        while stack:
+            path = stack.pop()
+            try:
+                with span('scan', images=0):
+                    mtime_ns = os.stat(path).st_mtime_ns
+                    cached = index.get(path, mtime_ns) if index is not None else None
+                    if cached is None:
+                        images, subdirectories = _list_directory(path, extensions)
+                        if index is not None:
+                            index.put(path, mtime_ns, images, subdirectories)
+                    else:
+                        images, subdirectories = cached
+            except OSError as e:
+                # a directory that vanished or can't be read mid-scan shouldn't end the whole run
+                print(f"Skipping {path}: {e}")
+                continue
+            for name in images:
+                yield os.path.join(path, name)
+            if recursive:
+                stack.extend(os.path.join(path, name) for name in reversed(subdirectories))
+    finally:
+        if index is not None:
+            index.close()
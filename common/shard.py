@@ -0,0 +1,244 @@
+# Splitting one dataset between several machines that share its directory.
+#
+# Static: --num_shards N --shard_index I keeps the images whose path, relative to the input directory,
+# hashes to I. The split only depends on the paths, so it is the same on every run and on every machine,
+# even when they mount the dataset at different places.
+#
+# Dynamic: with --lease_dir every image is hashed into one of --lease_chunks chunks and workers claim
+# chunks one at a time by creating a lease file in the shared directory, so fast machines simply take
+# more chunks. A worker touches its lease while it works and marks the chunk done when it finishes. A
+# lease that hasn't been touched for --lease_ttl seconds belongs to a worker that died, and the next
+# idle worker takes the chunk over. Staleness is judged on the observing worker's own clock, so clock
+# skew between machines doesn't matter. Use a fresh lease directory for every run.
+#
+#   python -m common.shard verify INPUT_DIR --ext wd14cap b2cap [--caption_store DB] [--lease_dir DIR]
+#
+# reports the images that have no output for any of the extensions, and the chunks not marked done.
+import os
+import sys
+import time
+import socket
+import hashlib
+import argparse
+import threading
+
+from common.scan import scan_images
+from common.caption_store import CaptionStore
+
+POLL_INTERVAL = 5.0
+
+
+def add_shard_args(parser):
+    parser.add_argument("--num_shards", type=int, default=1,
+                        help="Split the images into this many fixed shards by path hash and only process one of them.")
+    parser.add_argument("--shard_index", type=int, default=0, help="The shard to process, from 0 to --num_shards - 1.")
+    parser.add_argument("--lease_dir", type=str, default=None,
+                        help="Shared directory through which workers on several machines claim chunks of images as "
+                             "they go. Use a new directory for every run.")
+    parser.add_argument("--lease_chunks", type=int, default=256, help="Number of chunks the images are split into with --lease_dir.")
+    parser.add_argument("--lease_ttl", type=float, default=600,
+                        help="Seconds after which a chunk whose lease hasn't been renewed is taken over by another worker.")
+
+
+def path_bucket(root, path, buckets):
+    relative = os.path.relpath(os.path.abspath(path), root).replace(os.sep, '/')
+    return int.from_bytes(hashlib.blake2b(relative.encode('utf-8'), digest_size=8).digest(), 'big') % buckets
+
+
+class Sharding:
+    def __init__(self, root, stage, num_shards=1, shard_index=0, lease_dir=None, lease_chunks=256, lease_ttl=600):
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(f"--shard_index must be between 0 and {num_shards - 1}")
+        if num_shards > 1 and lease_dir:
+            raise ValueError("--num_shards and --lease_dir can't be combined")
+        self.root = os.path.abspath(root)
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        # stages share the lease directory but claim their chunks separately
+        self.lease_dir = os.path.join(lease_dir, stage) if lease_dir else None
+        self.lease_chunks = lease_chunks
+        self.lease_ttl = lease_ttl
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    def select(self, images):
+        """Yield the images of this worker's static shard"""
+        for image in images:
+            if path_bucket(self.root, image, self.num_shards) == self.shard_index:
+                yield image
+
+    def run(self, process, images):
+        """Call process(images) on this worker's share: its static shard, or chunk by chunk with leases"""
+        if self.lease_dir is None:
+            print(f"Processing shard {self.shard_index} of {self.num_shards}")
+            process(self.select(images))
+            return
+
+        os.makedirs(self.lease_dir, exist_ok=True)
+        chunks = {}
+        for image in images:
+            chunks.setdefault(path_bucket(self.root, image, self.lease_chunks), []).append(image)
+        claimed = 0
+        for chunk in self._claim(sorted(chunks)):
+            print(f"Processing chunk {chunk} ({len(chunks[chunk])} image(s)) as {self.worker_id}")
+            with _Heartbeat(self._path(chunk, 'lease'), self.lease_ttl / 3):
+                process(chunks[chunk])
+            with open(self._path(chunk, 'done'), 'w') as f:
+                f.write(self.worker_id)
+            _remove(self._path(chunk, 'lease'))
+            claimed += 1
+        print(f"Processed {claimed} chunk(s), every chunk is done")
+
+    def _path(self, chunk, kind):
+        return os.path.join(self.lease_dir, f"chunk-{chunk:05d}.{kind}")
+
+    def _claim(self, chunks):
+        # start at a different chunk on every worker so they don't all race for the same lease files
+        start = int.from_bytes(hashlib.blake2b(self.worker_id.encode(), digest_size=4).digest(), 'big')
+        offset = start % len(chunks) if chunks else 0
+        remaining = chunks[offset:] + chunks[:offset]
+        observed = {}
+        while remaining:
+            waiting = []
+            for chunk in remaining:
+                if os.path.exists(self._path(chunk, 'done')):
+                    continue
+                if self._acquire(chunk, observed):
+                    yield chunk
+                else:
+                    waiting.append(chunk)
+            remaining = waiting
+            if remaining:
+                # everything left is leased by other workers; wait for them to finish or go stale
+                time.sleep(POLL_INTERVAL)
+
+    def _acquire(self, chunk, observed):
+        lease = self._path(chunk, 'lease')
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._stale(lease, observed):
+                return False
+            # only the worker whose rename succeeds takes the chunk over
+            try:
+                os.rename(lease, f"{lease}.expired-{self.worker_id.replace(':', '-')}")
+            except FileNotFoundError:
+                return False
+            print(f"Taking over chunk {chunk}, its lease expired")
+            return self._acquire(chunk, {})
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.worker_id)
+        # another worker may have finished it between our check and the lease
+        if os.path.exists(self._path(chunk, 'done')):
+            _remove(lease)
+            return False
+        return True
+
+    def _stale(self, lease, observed):
+        try:
+            mtime = os.stat(lease).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        now = time.monotonic()
+        if observed.get(lease, (None,))[0] != mtime:
+            observed[lease] = (mtime, now)
+            return False
+        return now - observed[lease][1] > self.lease_ttl
+
+
+class _Heartbeat:
+    # touches the lease file from a background thread while its chunk is processed
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def _beat(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                print(f"Lost the lease {self.path}, another worker may be processing the same chunk")
+                return
+
+    def __enter__(self):
+        threading.Thread(target=self._beat, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sharding_from_args(args, directory, stage):
+    if args.num_shards == 1 and not args.lease_dir:
+        return None
+    try:
+        return Sharding(directory, stage, args.num_shards, args.shard_index, args.lease_dir, args.lease_chunks,
+                        args.lease_ttl)
+    except ValueError as e:
+        sys.exit(str(e))
+
+
+def verify(directory, extensions, store=None, lease_dir=None, scan_index=None):
+    images = 0
+    missing = {extension: [] for extension in extensions}
+    for image in scan_images(directory, scan_index):
+        images += 1
+        base_name = os.path.splitext(image)[0]
+        for extension in extensions:
+            output = f"{base_name}.{extension}"
+            if not (store.exists(output) if store is not None else os.path.exists(output)):
+                missing[extension].append(image)
+
+    complete = True
+    for extension, paths in missing.items():
+        print(f".{extension}: {images - len(paths)}/{images} image(s) covered")
+        for path in paths:
+            print(f"  missing {path}")
+        complete = complete and not paths
+
+    if lease_dir is not None and os.path.isdir(lease_dir):
+        for stage in sorted(os.listdir(lease_dir)):
+            stage_dir = os.path.join(lease_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            leased = sorted(name[:-len('.lease')] for name in os.listdir(stage_dir) if name.endswith('.lease'))
+            done = sum(name.endswith('.done') for name in os.listdir(stage_dir))
+            print(f"{stage}: {done} chunk(s) done, {len(leased)} still leased")
+            for name in leased:
+                print(f"  {name} was not finished")
+            complete = complete and not leased
+    return complete
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that every image was processed after a sharded run")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    verify_parser = subparsers.add_parser('verify', help="Report images without outputs and chunks not finished")
+    verify_parser.add_argument('input_directory', help="The input directory of the run")
+    verify_parser.add_argument('--ext', nargs='+', required=True, help="Output extensions every image should have, e.g. wd14cap txt")
+    verify_parser.add_argument('--caption_store', default=None, help="Look the outputs up in this caption store")
+    verify_parser.add_argument('--lease_dir', default=None, help="Also report chunks of this lease directory that weren't finished")
+    verify_parser.add_argument('--scan_index', default=None, help="Directory index to scan with")
+    args = parser.parse_args()
+
+    store = None
+    if args.caption_store:
+        store = CaptionStore(args.caption_store)
+    complete = verify(args.input_directory, [extension.lstrip('.') for extension in args.ext], store, args.lease_dir,
+                      args.scan_index)
+    if store is not None:
+        store.close()
+    print("Every image is covered" if complete else "Some images are not covered")
+    sys.exit(0 if complete else 1)
+
+
+if __name__ == '__main__':
+    main()
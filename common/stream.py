@@ -0,0 +1,50 @@
+# Line protocol for running a stage as a long-lived worker of pipeline.py instead of one pass over a
+# directory. The pipeline writes {"images": [...]} lines to the stage's stdin and the stage answers every
+# batch with one {"done": [...]} line once its outputs are written. The model stays loaded between
+# batches, and the stage exits when stdin is closed.
+import os
+import sys
+import json
+
+
+def add_stream_args(parser):
+    parser.add_argument('--stream', action='store_true',
+                        help='Run as a pipeline.py worker: read batches of image paths from stdin and report each '
+                             'finished batch on stdout instead of processing the input directory.')
+
+
+class StreamChannel:
+    # Keeps the real stdout for protocol messages and points both sys.stdout and file descriptor 1 at
+    # stderr, so prints from the stage and from native libraries can't end up in the protocol stream.
+    # Create it before loading any model.
+
+    def __init__(self):
+        sys.stdout.flush()
+        self.output = os.fdopen(os.dup(1), 'w', buffering=1)
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+
+    def batches(self):
+        for line in sys.stdin:
+            if line.strip():
+                yield json.loads(line)['images']
+
+    def done(self, images, output_path, exists=os.path.exists):
+        # output_path(image) is where the stage writes the image's result; an image counts as done when
+        # that file exists, which also covers images the manifest skipped as already up to date
+        results = []
+        for image in images:
+            path = str(output_path(image))
+            results.append({'image': str(image), 'output': path, 'ok': exists(path)})
+        self.output.write(json.dumps({'done': results}) + '\n')
+        self.output.flush()
+
+    def run(self, process, output_path, exists=os.path.exists):
+        """Call process(images) for every batch until stdin is closed"""
+        for images in self.batches():
+            process(images)
+            self.done(images, output_path, exists)
+
+
+def stream_from_args(args):
+    return StreamChannel() if args.stream else None
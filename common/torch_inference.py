@@ -0,0 +1,87 @@
+# Device, precision and thread settings shared by the torch captioners (BLIP-2 and Open Flamingo).
+# This needs torch, so only those stages import it.
+#
+# Without a GPU the captioners run on the CPU. There they compute in bfloat16 autocast when the CPU has
+# bf16 support (--bf16 auto, the default), and in float32 otherwise. --quantize int8 replaces the
+# language model's Linear layers with dynamically quantized ones: int8 weights, with the activations
+# quantized on the fly for every call. Those layers carry almost all of a captioner's compute and
+# memory, so this is usually the fastest CPU mode, at a small cost in caption quality. Quantized layers
+# take float32 inputs, so --quantize turns bf16 autocast off. Compare the modes on your CPU with
+#
+#   python benchmark/benchmark.py --cases blip2 [--quantize int8] [--bf16 off]
+#
+# Inference runs under torch.inference_mode, which skips the autograd bookkeeping that no_grad still
+# does. --num_threads and --interop_threads set torch's intra-op and inter-op thread pools.
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+# AVX512-BF16 and AMX on x86-64, BF16 on arm64
+BF16_CPU_FLAGS = {'avx512_bf16', 'amx_bf16', 'bf16'}
+
+
+def add_inference_args(parser):
+    parser.add_argument('--device', default=None, help='torch device to run on. Defaults to cuda when available, otherwise cpu')
+    parser.add_argument('--num_threads', type=int, default=None, help='torch CPU threads. Defaults to torch\'s own setting')
+    parser.add_argument('--interop_threads', type=int, default=None,
+                        help='torch inter-op threads, which run independent operators side by side. Defaults to torch\'s own setting')
+    parser.add_argument('--bf16', choices=['auto', 'on', 'off'], default='auto',
+                        help='bfloat16 autocast on the CPU. auto uses it when the CPU supports bf16')
+    parser.add_argument('--quantize', choices=['int8'], default=None,
+                        help='Run the language model with dynamically quantized int8 Linear layers. CPU only')
+
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def configure_threads(num_threads=None, interop_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        # torch only takes this before its inter-op pool starts, so call it before running anything
+        torch.set_num_interop_threads(interop_threads)
+
+
+def cpu_supports_bf16():
+    """True when the CPU has bf16 instructions, without which bf16 is slower than float32"""
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                # `flags` on x86-64, `Features` on arm64
+                if line.startswith(('flags', 'Features')):
+                    return bool(BF16_CPU_FLAGS & set(line.split(':', 1)[1].split()))
+    except OSError:
+        pass
+    cpu = getattr(torch._C, '_cpu', None)
+    if hasattr(cpu, '_is_avx512_bf16_supported'):
+        return cpu._is_avx512_bf16_supported() or cpu._is_amx_tile_supported()
+    return False
+
+
+def compute_dtype(device, bf16='auto', quantize=None):
+    """The dtype a captioner computes in on device"""
+    if torch.device(device).type == 'cuda':
+        return torch.bfloat16 if torch.cuda.get_device_capability(device)[0] >= 8 else torch.float16
+    if quantize is None and (bf16 == 'on' or bf16 == 'auto' and cpu_supports_bf16()):
+        return torch.bfloat16
+    return torch.float32
+
+
+@contextmanager
+def inference_context(device, dtype):
+    """inference_mode, with autocast to dtype unless that is float32"""
+    # torch.autocast rejects float32 on the CPU even when it's disabled
+    autocast = nullcontext() if dtype == torch.float32 else torch.autocast(torch.device(device).type, dtype=dtype)
+    with torch.inference_mode(), autocast:
+        yield
+
+
+def quantize_linears(module):
+    """Replace the Linear layers of module with dynamically quantized int8 ones, in place"""
+    start_time = time.time()
+    count = sum(isinstance(layer, torch.nn.Linear) for layer in module.modules())
+    torch.ao.quantization.quantize_dynamic(module.float(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    print(f"Quantized {count} Linear layers to int8 in {time.time() - start_time:.1f} seconds")
+    return module
@@ -0,0 +1,183 @@
+# Lightweight timing instrumentation shared by every stage. Code marks its phases with
+#
+#   with span('inference', images=len(batch)):
+#       ...
+#
+# which costs next to nothing until a stage is run with --trace PATH. Then every span is appended to
+# PATH as one JSON line ({"type": "span", "stage", "phase", "seconds", "images", "image"}), and every
+# --trace_summary_interval seconds, and once at the end, a summary line with the throughput, the
+# p50/p95/p99 latency of every phase and the peak RSS is written and printed.
+#
+# Spans inside image loaders run on prefetch workers; the Prefetcher collects them per image with
+# traced_call(), which also works in loader processes, and records them in the stage's process.
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+LATENCY_SAMPLES = 10000
+WRITE_LINES = 256
+
+_active = None
+_local = threading.local()
+
+
+def add_trace_args(parser):
+    parser.add_argument("--trace", type=str, default=None,
+                        help="Append per-image timing spans and periodic summaries as JSON lines to this file.")
+    parser.add_argument("--trace_summary_interval", type=float, default=60,
+                        help="Seconds between the throughput/latency summaries written with --trace.")
+    parser.add_argument("--quiet", action='store_true',
+                        help="Don't print every caption or summary; progress, errors and trace summaries still show.")
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {f'p{p}': round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 1)
+            for p in (50, 95, 99)}
+
+
+def peak_rss_mb(who=None):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class _Phase:
+    def __init__(self):
+        self.count = 0
+        self.images = 0
+        self.seconds = 0.0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+
+class Tracer:
+    def __init__(self, path, stage, summary_interval=60):
+        self.stage = stage
+        self.summary_interval = summary_interval
+        self.pid = os.getpid()
+        # one write() per flush on an O_APPEND descriptor, so stages can share a trace file
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.lines = []
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_summary = self.started
+
+    def record(self, phase, seconds, images=1, image=None):
+        event = {'type': 'span', 'stage': self.stage, 'phase': phase, 'time': round(time.time(), 3),
+                 'seconds': round(seconds, 6), 'images': images}
+        if image is not None:
+            event['image'] = str(image)
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = _Phase()
+            stats.count += 1
+            stats.images += images
+            stats.seconds += seconds
+            stats.samples.append(seconds)
+            self.lines.append(json.dumps(event))
+            if len(self.lines) >= WRITE_LINES:
+                self._flush()
+            due = time.monotonic() - self.last_summary >= self.summary_interval
+        if due:
+            self.summary()
+
+    def _flush(self):
+        if self.lines:
+            os.write(self.fd, ('\n'.join(self.lines) + '\n').encode())
+            self.lines = []
+
+    def summary(self):
+        with self.lock:
+            now = time.monotonic()
+            self.last_summary = now
+            elapsed = now - self.started
+            # every stage writes each finished image once, so writes count the images done
+            done = self.phases['write'].images if 'write' in self.phases else 0
+            summary = {
+                'type': 'summary', 'stage': self.stage, 'time': round(time.time(), 3), 'elapsed_s': round(elapsed, 1),
+                'images': done, 'images_per_s': round(done / elapsed, 3) if elapsed else None,
+                'peak_rss_mb': peak_rss_mb(),
+                'peak_child_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource is not None else None,
+                'phases': {name: {'count': stats.count, 'images': stats.images, 'total_s': round(stats.seconds, 3),
+                                  'latency_ms': percentiles(stats.samples)}
+                           for name, stats in self.phases.items()},
+            }
+            self.lines.append(json.dumps(summary))
+            self._flush()
+        phases = ', '.join(f"{name} p50 {stats['latency_ms']['p50']}ms p95 {stats['latency_ms']['p95']}ms "
+                           f"p99 {stats['latency_ms']['p99']}ms"
+                           for name, stats in summary['phases'].items())
+        print(f"[trace] {self.stage}: {done} image(s) in {elapsed:.0f}s, {summary['images_per_s'] or 0:.2f} images/s, "
+              f"peak RSS {summary['peak_rss_mb']}MB. {phases}", file=sys.stderr)
+        return summary
+
+    def close(self):
+        """Write the final summary and return it"""
+        global _active
+        summary = self.summary()
+        os.close(self.fd)
+        if _active is self:
+            _active = None
+        return summary
+
+
+def tracer_from_args(args, stage):
+    """Start tracing the stage when --trace is given; spans anywhere in the process are then recorded"""
+    global _active
+    if not args.trace:
+        return None
+    _active = Tracer(args.trace, stage, args.trace_summary_interval)
+    return _active
+
+
+def enabled():
+    return _active is not None and _active.pid == os.getpid()
+
+
+@contextmanager
+def span(phase, images=1, image=None):
+    collected = getattr(_local, 'collected', None)
+    # forked loader processes inherit the tracer but must not write to its file
+    tracer = _active if _active is not None and _active.pid == os.getpid() else None
+    if collected is None and tracer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if collected is not None:
+            collected.append((phase, seconds))
+        else:
+            tracer.record(phase, seconds, images, image)
+
+
+def traced_call(function, argument):
+    """Run function(argument), returning its result and the (phase, seconds) of the spans inside it"""
+    _local.collected = []
+    try:
+        return function(argument), _local.collected
+    finally:
+        _local.collected = None
+
+
+def record_collected(collected, image=None):
+    if enabled():
+        for phase, seconds in collected:
+            _active.record(phase, seconds, 1, image)
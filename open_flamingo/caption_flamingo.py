@@ -1,46 +1,148 @@
 import os
+import sys
 import torch
+from functools import partial
 from PIL import Image
 import argparse
 import requests
 from transformers import Blip2Processor, Blip2ForConditionalGeneration, GitProcessor, GitForCausalLM, AutoModel, \
     AutoProcessor
-from huggingface_hub import hf_hub_download
-from open_flamingo import create_model_and_transforms
 import time
 
-EXTENSIONS = [".jpg", ".png", ".jpeg"]
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.prefetch import add_prefetch_args, prefetcher_from_args
+from common.manifest import add_manifest_args, manifest_from_args
+from common.stream import add_stream_args, stream_from_args
+from common.caption_store import add_caption_store_args, caption_store_from_args, caption_exists, write_caption
+from common.daemon import add_daemon_args, daemon_from_args
+from common.scan import add_scan_args, scan_images
+from common.shard import add_shard_args, sharding_from_args
+from common.trace import add_trace_args, tracer_from_args, span
+from common.dedup import add_dedup_args, dedup_from_args
+from common.torch_inference import add_inference_args, compute_dtype, configure_threads, default_device, \
+    inference_context, quantize_linears
+from model_loading import load_flamingo
 
 
 def get_examples(example_img_dir, image_processor):
     examples = []
-    for root, dirs, files in os.walk(example_img_dir):
-        for file in files:
-            ext = os.path.splitext(file)[-1].lower()
-            if ext in EXTENSIONS:
-                txt_file = os.path.splitext(file)[0] + ".txt"
-                with open(os.path.join(root, txt_file), 'r') as f:
-                    caption = f.read()
-                image = Image.open(os.path.join(root, file))
-                vision_x = [image_processor(image).unsqueeze(0)]
-                examples.append((caption, vision_x))
+    for image_path in scan_images(example_img_dir):
+        with open(os.path.splitext(image_path)[0] + ".txt", 'r') as f:
+            caption = f.read()
+        image = Image.open(image_path)
+        vision_x = [image_processor(image).unsqueeze(0)]
+        examples.append((caption, vision_x))
     for x in examples:
         print(f" ** Example: {x[0]}")
     return examples
 
 
-def get_dtype_for_cuda_device(device):
-    compute_capability = torch.cuda.get_device_capability()
-    if compute_capability[0] >= 8:
-        dtype = torch.bfloat16
-    else:
-        dtype = torch.float16
-    return dtype
+def load_image(path, image_processor):
+    with Image.open(path) as image:
+        with span('decode'):
+            image.load()
+        with span('preprocess'):
+            return image_processor(image).unsqueeze(0)
+
+
+def encode_vision(model, vision_x):
+    """Run vision_x (B, T_img, 1, C, H, W) through the vision encoder and perceiver without conditioning the LM"""
+    b, T, F = vision_x.shape[:3]
+    vision_x = vision_x.flatten(0, 2)
+    with torch.inference_mode():
+        vision_x = model.vision_encoder(vision_x)[1]
+    vision_x = vision_x.reshape(b, T, F, *vision_x.shape[1:])
+    return model.perceiver(vision_x)
+
+
+def condition_vision(model, vision_features):
+    for layer in model.lang_encoder._get_decoder_layers():
+        layer.condition_vis_x(vision_features)
+
+
+class PrefixCache:
+    """
+    Few-shot prompt state shared by every query image.
+
+    The tokenized prompt, the example images' vision features and the language model's past key/values for
+    everything before the final <image> are computed once. Flamingo text only attends to the image right before
+    it, so the prefix never sees the query image and reusing its keys/values matches encoding the full prompt.
+    """
+
+    def __init__(self, model, tokenizer, examples, prompt, device, dtype):
+        self.model = model
+        self.input_ids = tokenizer([prompt], return_tensors="pt")["input_ids"].to(device)
+        self.split = int((self.input_ids[0] == model.lang_encoder.media_token_id).nonzero()[-1])
+        self.past_key_values = None
+
+        if self.split > 0:
+            vision_x = torch.cat([vx[1][0] for vx in examples], dim=0)
+            vision_x = vision_x.unsqueeze(1).unsqueeze(0).to(device, dtype=dtype)
+            self.example_features = encode_vision(model, vision_x)
+            condition_vision(model, self.example_features)
+            prefix_ids = self.input_ids[:, :self.split]
+            output = model.lang_encoder(input_ids=prefix_ids, attention_mask=torch.ones_like(prefix_ids),
+                                        use_cache=True)
+            self.past_key_values = output.past_key_values
+            model.lang_encoder.clear_conditioned_layers()
+
+    def generate(self, image_x, num_beams=1, **generate_kwargs):
+        """
+        Same as model.generate on the full prompt for each image in image_x (B, C, H, W), but only encodes the
+        query images and the tokens after the prefix
+        """
+        model = self.model
+        lang_encoder = model.lang_encoder
+        rows = image_x.shape[0] * num_beams
+        features = encode_vision(model, image_x[:, None, None])
+
+        lang_encoder._use_cached_vision_x = True
+        condition_vision(model, features.repeat_interleave(num_beams, dim=0))
+
+        # encode the "<image> Output:" suffix up to its last token, generate() feeds that one itself.
+        # generate() expands input_ids to one row per beam, so the cached state is expanded to match
+        past_key_values = self.past_key_values
+        if past_key_values is not None:
+            past_key_values = tuple(tuple(t.expand(rows, *t.shape[1:]) for t in layer) for layer in past_key_values)
+        suffix_ids = self.input_ids[:, self.split:-1].expand(rows, -1)
+        if suffix_ids.shape[1] > 0:
+            attention_mask = torch.ones_like(self.input_ids[:, :-1]).expand(rows, -1)
+            past_key_values = lang_encoder(input_ids=suffix_ids, attention_mask=attention_mask,
+                                           past_key_values=past_key_values, use_cache=True).past_key_values
+
+        input_ids = self.input_ids.expand(image_x.shape[0], -1)
+        # defaults model.generate passes through to the language model
+        generate_kwargs = {'no_repeat_ngram_size': 0, 'length_penalty': 1.0, 'num_return_sequences': 1,
+                           'do_sample': False, 'early_stopping': False, **generate_kwargs}
+        output = lang_encoder.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            eos_token_id=model.eoc_token_id,
+            num_beams=num_beams,
+            **generate_kwargs,
+        )
+
+        lang_encoder.clear_conditioned_layers()
+        lang_encoder._use_cached_vision_x = False
+        return output
+
+
+def caption_path(image_path):
+    return f"{os.path.splitext(image_path)[0]}.flamcap"
 
 
 def main(args):
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    dtype = get_dtype_for_cuda_device(device) if device == "cuda" else torch.float32
+    stream = stream_from_args(args)
+    tracer = tracer_from_args(args, 'open_flamingo')
+    sharding = None if stream or args.serve else sharding_from_args(args, args.img_dir, 'open_flamingo')
+    configure_threads(args.num_threads, args.interop_threads)
+    device = args.device or default_device()
+    if args.quantize and device != 'cpu':
+        print("--quantize only runs on the cpu. Exiting.")
+        return
+    dtype = compute_dtype(device, args.bf16, args.quantize)
+    print(f"Running Open Flamingo on {device} in {dtype}" + (f" with {args.quantize} language model" if args.quantize else ""))
 
     if args.prompt:
         prompt = args.prompt
@@ -48,43 +150,12 @@ def main(args):
         prompt = "<image>: "
     print(f" using prompt:  {prompt}")
 
-    if "openflamingo/OpenFlamingo-9B-vitl-mpt7b" in args.model:
-        lang_encoder_path = "anas-awadalla/mpt-7b"
-        tokenizer_path = "anas-awadalla/mpt-7b"
-        model, image_processor, tokenizer = create_model_and_transforms(
-            clip_vision_encoder_path="ViT-L-14",
-            clip_vision_encoder_pretrained="openai",
-            lang_encoder_path=lang_encoder_path,
-            tokenizer_path=tokenizer_path,
-            cross_attn_every_n_layers=4,
-        )
-    elif "openflamingo/OpenFlamingo-3B-vitl-mpt1b" in args.model:
-        lang_encoder_path = "anas-awadalla/mpt-1b-redpajama-200b"
-        tokenizer_path = "anas-awadalla/mpt-1b-redpajama-200b"
-        model, image_processor, tokenizer = create_model_and_transforms(
-            clip_vision_encoder_path="ViT-L-14",
-            clip_vision_encoder_pretrained="openai",
-            lang_encoder_path=lang_encoder_path,
-            tokenizer_path=tokenizer_path,
-            cross_attn_every_n_layers=1,
-        )
-    elif "openflamingo/OpenFlamingo-4B-vitl-rpj3b" in args.model:
-        lang_encoder_path = "togethercomputer/RedPajama-INCITE-Base-3B-v1"
-        tokenizer_path = "togethercomputer/RedPajama-INCITE-Base-3B-v1"
-        model, image_processor, tokenizer = create_model_and_transforms(
-            clip_vision_encoder_path="ViT-L-14",
-            clip_vision_encoder_pretrained="openai",
-            lang_encoder_path=lang_encoder_path,
-            tokenizer_path=tokenizer_path,
-            cross_attn_every_n_layers=2,
-        )
-
+    with span('load', images=0):
+        model, image_processor, tokenizer = load_flamingo(args.model, device, dtype, args.weights_cache_dir)
+        if args.quantize:
+            quantize_linears(model.lang_encoder)
     tokenizer.padding_side = "left"
 
-    checkpoint_path = hf_hub_download(args.model, "checkpoint.pt")
-    model.load_state_dict(torch.load(checkpoint_path), strict=False)
-    model.to(0, dtype=dtype)
-
     examples = get_examples(args.example_img_dir, image_processor)
 
     prompt = ""
@@ -97,57 +168,120 @@ def main(args):
     prompt = prompt.replace("\n", "")
     print(f" \n** Final full prompt with example pairs: {prompt}")
 
-    for root, dirs, files in os.walk(args.img_dir):
-        for file in files:
-            ext = os.path.splitext(file)[1]
-            if ext.lower() in EXTENSIONS:
-                start_time = time.time()
-
-                full_file_path = os.path.join(root, file)
-                image = Image.open(full_file_path)
-
-                vision_x = [vx[1][0] for vx in examples]
-                vision_x.append(image_processor(image).unsqueeze(0))
-                vision_x = torch.cat(vision_x, dim=0)
-                vision_x = vision_x.unsqueeze(1).unsqueeze(0)
-                vision_x = vision_x.to(device, dtype=dtype)
-
-                lang_x = tokenizer(
-                    [prompt],
-                    return_tensors="pt",
-                )
-                lang_x.to(device)
-
-                input_ids = lang_x["input_ids"].to(device)
-
-                with torch.cuda.amp.autocast(dtype=dtype), torch.no_grad():
-                    generated_text = model.generate(
-                        vision_x=vision_x,
-                        lang_x=input_ids,
-                        attention_mask=lang_x["attention_mask"],
-                        max_new_tokens=args.max_new_tokens,
-                        min_new_tokens=args.min_new_tokens,
-                        num_beams=args.num_beams,
-                        temperature=args.temperature,
-                        top_k=args.top_k,
-                        top_p=args.top_p,
-                        repetition_penalty=args.repetition_penalty,
-                    )
-                del vision_x
-                del lang_x
-
-                generated_text = tokenizer.decode(generated_text[0][len(input_ids[0]):], skip_special_tokens=True)
-                generated_text = generated_text.split(output_prompt)[0]
+    store = caption_store_from_args(args, 'open_flamingo')
+    manifest = manifest_from_args(args, 'open_flamingo', {
+        'model': args.model, 'prompt': prompt, 'min_new_tokens': args.min_new_tokens, 'max_new_tokens': args.max_new_tokens,
+        'num_beams': args.num_beams, 'temperature': args.temperature, 'top_k': args.top_k, 'top_p': args.top_p,
+        'repetition_penalty': args.repetition_penalty, **({'quantize': args.quantize} if args.quantize else {})}, store)
+    worker = stream or daemon_from_args(args, manifest)
+
+    # decode and transform the query images on background workers while the model generates
+    prefetcher = prefetcher_from_args(args)
+    load = partial(load_image, image_processor=image_processor)
+
+    generate_kwargs = {
+        'max_new_tokens': args.max_new_tokens,
+        'min_new_tokens': args.min_new_tokens,
+        'num_beams': args.num_beams,
+        'temperature': args.temperature,
+        'top_k': args.top_k,
+        'top_p': args.top_p,
+        'repetition_penalty': args.repetition_penalty,
+    }
+
+    prefix_cache = None
+    if not args.no_prefix_cache:
+        with inference_context(device, dtype):
+            prefix_cache = PrefixCache(model, tokenizer, examples, prompt, device, dtype)
+
+    def generate_batch(batch_images):
+        image_x = torch.cat(batch_images, dim=0).to(device, dtype=dtype)
+
+        if prefix_cache is not None:
+            with inference_context(device, dtype):
+                generated = prefix_cache.generate(image_x, **generate_kwargs)
+            return generated, prefix_cache.input_ids
+
+        # every row gets the same examples followed by its own query image
+        vision_x = [vx[1][0].to(device, dtype=dtype) for vx in examples]
+        vision_x = torch.stack([torch.cat(vision_x + [image], dim=0) for image in image_x.unsqueeze(1)])
+        vision_x = vision_x.unsqueeze(2)
+
+        lang_x = tokenizer(
+            [prompt] * len(batch_images),
+            return_tensors="pt",
+            padding=True,
+        )
+        lang_x.to(device)
+
+        input_ids = lang_x["input_ids"].to(device)
+
+        with inference_context(device, dtype):
+            generated = model.generate(
+                vision_x=vision_x,
+                lang_x=input_ids,
+                attention_mask=lang_x["attention_mask"],
+                **generate_kwargs,
+            )
+        return generated, input_ids
+
+    def caption_batch(batch_paths, batch_images):
+        start_time = time.time()
+        with span('generate', images=len(batch_paths)):
+            generated, input_ids = generate_batch(batch_images)
+
+        if not args.quiet:
+            exec_time = time.time() - start_time
+            print(f"{exec_time}")
 
-                exec_time = time.time() - start_time
+        for full_file_path, row in zip(batch_paths, generated):
+            with span('postprocess', image=full_file_path):
+                generated_text = tokenizer.decode(row[len(input_ids[0]):], skip_special_tokens=True)
+                generated_text = generated_text.split(output_prompt)[0]
+            if not args.quiet:
                 print(f"Caption:  {generated_text}")
 
-                print(f"{exec_time}")
+            write_caption(store, caption_path(full_file_path), generated_text)
+            if manifest is not None:
+                manifest.record(full_file_path, caption_path(full_file_path))
+
+    def caption_images(image_paths):
+        if manifest is not None:
+            image_paths = manifest.pending(image_paths)
+
+        batch_paths, batch_images = [], []
+        for full_file_path, image_x in prefetcher.run(load, image_paths):
+            batch_paths.append(full_file_path)
+            batch_images.append(image_x)
+            if len(batch_paths) == args.batch_size:
+                caption_batch(batch_paths, batch_images)
+                batch_paths, batch_images = [], []
+        if batch_paths:
+            caption_batch(batch_paths, batch_images)
+        if store is not None:
+            store.flush()
+
+    if worker is None:
+        images = scan_images(args.img_dir, args.scan_index)
+        dedup = dedup_from_args(args)
+        if dedup is not None:
+            images = dedup.representatives(images)
+        if sharding is None:
+            caption_images(images)
+        else:
+            sharding.run(caption_images, images)
+        if dedup is not None:
+            dedup.close()
+    else:
+        worker.run(caption_images, caption_path, partial(caption_exists, store))
 
-                name = os.path.splitext(full_file_path)[0]
-                if not os.path.exists(name):
-                    with open(f"{name}.flamcap", "w") as f:
-                        f.write(generated_text)
+    prefetcher.report()
+    if manifest is not None:
+        manifest.close()
+    if store is not None:
+        store.close()
+    if tracer is not None:
+        tracer.close()
     print("Done!")
 
 
@@ -168,5 +302,21 @@ if __name__ == "__main__":
     parser.add_argument("--repetition_penalty", type=float, default=1.0, help="Repetition penalty")
     parser.add_argument("--length_penalty", type=float, default=1.0, help="Length penalty")
     parser.add_argument("--output_extension", type=str, default="flamcap", help="output extension to save caps with")
+    parser.add_argument("--batch_size", type=int, default=1, help="number of query images captioned per generate call")
+    parser.add_argument("--no_prefix_cache", action="store_true",
+                        help="re-encode the few-shot examples for every image instead of caching them once per run")
+    parser.add_argument("--weights_cache_dir", type=str, default=None,
+                        help="Directory to keep safetensors copies of the checkpoints in, converted once to the run's "
+                             "dtype, so later runs memory-map them and start faster with less memory.")
+    add_inference_args(parser)
+    add_prefetch_args(parser)
+    add_manifest_args(parser)
+    add_stream_args(parser)
+    add_daemon_args(parser)
+    add_caption_store_args(parser)
+    add_scan_args(parser)
+    add_shard_args(parser)
+    add_trace_args(parser)
+    add_dedup_args(parser)
     args = parser.parse_args()
     main(args)
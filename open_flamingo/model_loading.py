@@ -0,0 +1,251 @@
+# Low-memory loading of the Open Flamingo models.
+#
+# open_flamingo's create_model_and_transforms builds the language model in float32 from its own checkpoint,
+# then the whole Flamingo checkpoint is read into host memory and everything is cast at the end, so the peak
+# is several times the final model and most of the startup goes into random initialization that is thrown
+# away. Here the language model and the Flamingo layers are created on the meta device, without memory or
+# initialization, and every checkpoint tensor is read on its own, converted to the target dtype and put
+# straight on the target device. safetensors checkpoints are memory-mapped; pickled ones are too where
+# torch supports it (2.1 and later) and are otherwise read one file at a time. The CLIP vision encoder is
+# small next to the language model and is still loaded by open_clip.
+#
+# With --weights_cache_dir every pickled checkpoint is converted once to a safetensors copy in the target
+# dtype, which later runs memory-map and load without any conversion.
+import os
+import json
+import time
+import hashlib
+import inspect
+import zipfile
+from contextlib import contextmanager
+
+import torch
+import open_clip
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+from transformers.utils import cached_file
+from huggingface_hub import hf_hub_download
+from open_flamingo.src.flamingo import Flamingo
+from open_flamingo.src.flamingo_lm import FlamingoLMMixin
+from open_flamingo.src.utils import extend_instance
+
+from common.trace import peak_rss_mb
+
+# model: (vision encoder, its pretrained weights, language model, its decoder layers, cross attention every n layers)
+MODELS = {
+    'openflamingo/OpenFlamingo-9B-vitl-mpt7b': ('ViT-L-14', 'openai', 'anas-awadalla/mpt-7b', 'transformer.blocks', 4),
+    'openflamingo/OpenFlamingo-3B-vitl-mpt1b': ('ViT-L-14', 'openai', 'anas-awadalla/mpt-1b-redpajama-200b',
+                                                'transformer.blocks', 1),
+    'openflamingo/OpenFlamingo-4B-vitl-rpj3b': ('ViT-L-14', 'openai', 'togethercomputer/RedPajama-INCITE-Base-3B-v1',
+                                                'gpt_neox.layers', 2),
+}
+# a language model's weights, in the order transformers looks for them
+LM_WEIGHT_FILES = ['model.safetensors.index.json', 'model.safetensors', 'pytorch_model.bin.index.json', 'pytorch_model.bin']
+TORCH_LOAD_MMAP = 'mmap' in inspect.signature(torch.load).parameters
+
+
+def model_config(model):
+    for name, config in MODELS.items():
+        if name in model:
+            return config
+    raise ValueError(f"Unknown Open Flamingo model {model}, expected one of {', '.join(MODELS)}")
+
+
+@contextmanager
+def empty_parameters():
+    """
+    Create the parameters of the modules built inside on the meta device, so they take no memory and their
+    initialization costs nothing. Buffers are still created as usual, since models compute some of them in
+    __init__ and don't save them.
+    """
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, parameter):
+        register_parameter(module, name, parameter)
+        if parameter is not None:
+            module._parameters[name] = torch.nn.Parameter(parameter.to('meta'), requires_grad=False)
+
+    torch.nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def _convert(tensor, dtype):
+    return tensor.to(dtype) if tensor.is_floating_point() else tensor
+
+
+def _read_pickled(path, dtype):
+    if TORCH_LOAD_MMAP and zipfile.is_zipfile(path):
+        state_dict = torch.load(path, map_location='cpu', mmap=True)
+    else:
+        state_dict = torch.load(path, map_location='cpu')
+    # popping each tensor as it's converted frees the original before the next one is read
+    for name in list(state_dict):
+        yield name, _convert(state_dict.pop(name), dtype)
+
+
+def _cache_path(cache_dir, path, dtype):
+    # huggingface keeps every downloaded file under its own content hash, so the resolved path, size and
+    # mtime change whenever the checkpoint does
+    stat = os.stat(path)
+    key = repr((os.path.realpath(path), stat.st_size, stat.st_mtime_ns, str(dtype)))
+    name = os.path.basename(path).split('.')[0]
+    return os.path.join(cache_dir, f"{name}-{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}.safetensors")
+
+
+def convert_checkpoint(path, cache_path, dtype):
+    """Save the pickled checkpoint at path as safetensors in dtype"""
+    tensors = {}
+    storages = set()
+    for name, tensor in _read_pickled(path, dtype):
+        # safetensors refuses tensors that share memory, as tied weights do in pickled checkpoints
+        if tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        tensors[name] = tensor.contiguous()
+    # several runs may convert the same checkpoint at the same time
+    tmp_path = f"{cache_path[:-len('.safetensors')]}.{os.getpid()}.tmp.safetensors"
+    save_file(tensors, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+
+def read_tensors(path, device, dtype, cache_dir=None):
+    """Yield (name, tensor) for every tensor of the checkpoint at path, one at a time, in dtype on device"""
+    if cache_dir is not None and not path.endswith('.safetensors'):
+        cache_path = _cache_path(cache_dir, path, dtype)
+        if not os.path.isfile(cache_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            start_time = time.time()
+            convert_checkpoint(path, cache_path, dtype)
+            print(f"Converted {path} to {cache_path} in {time.time() - start_time:.1f} seconds")
+        path = cache_path
+
+    if path.endswith('.safetensors'):
+        with safe_open(path, framework='pt') as f:
+            for name in f.keys():
+                yield name, _convert(f.get_tensor(name).to(device), dtype)
+    else:
+        for name, tensor in _read_pickled(path, dtype):
+            yield name, tensor.to(device)
+
+
+def assign_tensor(model, name, tensor):
+    """Put tensor in place of the parameter or buffer called name; False if model has no such tensor"""
+    module_name, _, attribute = name.rpartition('.')
+    try:
+        module = model.get_submodule(module_name)
+    except AttributeError:
+        return False
+    if attribute in module._parameters:
+        current = module._parameters[attribute]
+    elif attribute in module._buffers:
+        current = module._buffers[attribute]
+    else:
+        return False
+    if current is not None and current.shape != tensor.shape:
+        raise ValueError(f"{name} has shape {tuple(tensor.shape)} in the checkpoint but {tuple(current.shape)} in the model")
+    if attribute in module._parameters:
+        module._parameters[attribute] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[attribute] = tensor
+    return True
+
+
+def load_tensors(model, paths, device, dtype, cache_dir=None):
+    """Load the checkpoints at paths into model tensor by tensor; returns the names model has no tensor for"""
+    unexpected = []
+    for path in paths:
+        for name, tensor in read_tensors(path, device, dtype, cache_dir):
+            if not assign_tensor(model, name, tensor):
+                unexpected.append(name)
+    return unexpected
+
+
+def _check_loaded(model, checkpoint):
+    missing = [name for name, parameter in model.named_parameters() if parameter.is_meta]
+    if missing:
+        raise RuntimeError(f"{checkpoint} has no weights for {len(missing)} parameter(s) of the model, "
+                           f"e.g. {', '.join(missing[:3])}")
+
+
+def lm_weight_files(lm_path):
+    for filename in LM_WEIGHT_FILES:
+        path = cached_file(lm_path, filename, _raise_exceptions_for_missing_entries=False)
+        if path is None:
+            continue
+        if not filename.endswith('.index.json'):
+            return [path]
+        with open(path, 'r') as f:
+            shards = sorted(set(json.load(f)['weight_map'].values()))
+        return [cached_file(lm_path, shard) for shard in shards]
+    raise FileNotFoundError(f"Found no weights for {lm_path}")
+
+
+def load_flamingo(model, device, dtype, cache_dir=None):
+    """
+    The same model, image processor and tokenizer as open_flamingo's create_model_and_transforms followed by
+    loading the model's checkpoint, in eval mode on device in dtype
+    """
+    start_time = time.time()
+    clip_path, clip_pretrained, lm_path, decoder_layers, cross_attn_every_n_layers = model_config(model)
+
+    vision_encoder, _, image_processor = open_clip.create_model_and_transforms(clip_path, pretrained=clip_pretrained)
+    # Flamingo only keeps the visual half, the text tower is freed when this returns
+    vision_encoder.visual.output_tokens = True
+    vision_encoder.visual.to(device, dtype=dtype)
+
+    tokenizer = AutoTokenizer.from_pretrained(lm_path, trust_remote_code=True)
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<|endofchunk|>", "<image>"]})
+    if tokenizer.pad_token is None:
+        tokenizer.add_special_tokens({"pad_token": "<PAD>"})
+
+    config = AutoConfig.from_pretrained(lm_path, trust_remote_code=True)
+    with empty_parameters():
+        lang_encoder = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+    lm_paths = lm_weight_files(lm_path)
+    load_tensors(lang_encoder, lm_paths, device, dtype, cache_dir)
+    lang_encoder.tie_weights()
+    _check_loaded(lang_encoder, lm_path)
+
+    # MPT-1B has no get_input_embeddings, which resize_token_embeddings needs
+    if "mpt-1b-redpajama-200b" in lm_path:
+        class EmbeddingFnMixin:
+            def get_input_embeddings(self):
+                return self.transformer.wte
+
+            def set_input_embeddings(self, new_embeddings):
+                self.transformer.wte = new_embeddings
+
+        extend_instance(lang_encoder, EmbeddingFnMixin)
+    extend_instance(lang_encoder, FlamingoLMMixin)
+    lang_encoder.set_decoder_layers_attr_name(decoder_layers)
+    lang_encoder.resize_token_embeddings(len(tokenizer))
+
+    # the perceiver and the gated cross attention layers only exist in the Flamingo checkpoint
+    with empty_parameters():
+        flamingo = Flamingo(vision_encoder, lang_encoder, tokenizer.encode("<|endofchunk|>")[-1],
+                            tokenizer.encode("<image>")[-1],
+                            vis_dim=open_clip.get_model_config(clip_path)["vision_cfg"]["width"],
+                            cross_attn_every_n_layers=cross_attn_every_n_layers)
+    del vision_encoder
+    checkpoint_path = hf_hub_download(model, "checkpoint.pt")
+    load_tensors(flamingo, [checkpoint_path], device, dtype, cache_dir)
+    lang_encoder.tie_weights()
+    _check_loaded(flamingo, checkpoint_path)
+
+    # moves the buffers the models created in __init__, the parameters are already in place
+    flamingo.to(device, dtype=dtype)
+    flamingo.requires_grad_(False)
+    flamingo.eval()
+
+    memory = []
+    peak_rss = peak_rss_mb()
+    if peak_rss is not None:
+        memory.append(f"peak RSS {peak_rss:.0f}MB")
+    if torch.device(device).type == 'cuda':
+        memory.append(f"peak GPU memory {torch.cuda.max_memory_allocated() / 2**20:.0f}MB")
+    print(f"Loaded {model} in {time.time() - start_time:.1f} seconds" + (f", {', '.join(memory)}" if memory else ""))
+    return flamingo, image_processor, tokenizer
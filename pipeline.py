@@ -0,0 +1,268 @@
+# Streaming orchestrator: runs every enabled stage at the same time as a long-lived worker (see
+# common/stream.py) instead of one full pass per stage. Images are fed to the captioning stages in
+# small batches, and each image is handed to the summarizer as soon as all of its captions are written,
+# so summaries start appearing while the captioners are still working through the directory. The directory
+# scan itself is only read as fast as the stages take images, so the first batches go out before it is done.
+#
+# Every stage keeps its own venv and working directory, exactly like run.sh, and loads its model once.
+# A stage never has more than --max_in_flight images sent but not yet finished, so a slow stage holds
+# back only its own queue. Only uses the standard library.
+import os
+import sys
+import json
+import time
+import queue
+import shlex
+import argparse
+import threading
+import subprocess
+from collections import deque
+
+from common.scan import add_scan_args, scan_images
+from common.dedup import add_dedup_args, dedup_from_args
+
+# name: (stage directory, venv directory, script)
+CAPTION_STAGES = {
+    'blip2': ('blip2', 'venv_blip2', 'caption_blip2.py'),
+    'open_flamingo': ('open_flamingo', 'venv_open_flamingo', 'caption_flamingo.py'),
+    'wd14': ('wd14', 'venv_wd14', 'caption_wd14.py'),
+}
+SUMMARIZE_STAGES = {
+    'summarize_gpt': ('summarize', 'venv_summarize', 'summarize_with_gpt.py'),
+    'summarize_llama': ('summarize', 'venv_summarize', 'summarize_with_llama.py'),
+}
+
+
+def venv_python(stage_directory, venv):
+    if os.name == 'nt':
+        python = os.path.join(stage_directory, venv, 'Scripts', 'python.exe')
+    else:
+        python = os.path.join(stage_directory, venv, 'bin', 'python')
+    if not os.path.exists(python):
+        print(f"{python} not found, running {os.path.basename(stage_directory)} with {sys.executable}")
+        python = sys.executable
+    return python
+
+
+class Stage:
+    def __init__(self, name, base_directory, stage_directory, venv, script, options, events):
+        self.name = name
+        stage_directory = os.path.join(base_directory, stage_directory)
+        command = [venv_python(stage_directory, venv), '-u', script, '--stream'] + shlex.split(options)
+        # stderr is left alone so the stage's own output shows up as usual; stdout carries the protocol
+        self.process = subprocess.Popen(command, cwd=stage_directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, bufsize=1)
+        self.events = events
+        self.pending = deque()
+        self.in_flight = set()
+        self.closed = False
+        self.exited = False
+        self.finished = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.first_done = None
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                message = None
+            if isinstance(message, dict) and 'done' in message:
+                self.events.put((self, message['done']))
+            else:
+                # anything printed before the stage switched its stdout over
+                sys.stderr.write(f"[{self.name}] {line}")
+        self.process.wait()
+        self.events.put((self, None))
+
+    def send(self, max_in_flight, batch_size):
+        while self.pending and not self.exited and len(self.in_flight) < max_in_flight:
+            count = min(batch_size, max_in_flight - len(self.in_flight), len(self.pending))
+            images = [self.pending.popleft() for _ in range(count)]
+            self.in_flight.update(images)
+            try:
+                self.process.stdin.write(json.dumps({'images': images}) + '\n')
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError):
+                # the reader thread reports the exit and fails everything still in flight
+                break
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+
+class Pipeline:
+    def __init__(self, images, caption_stages, summarize_stages, max_in_flight, batch_size):
+        # images are taken from the scan only as fast as the stages work through them; None once it is exhausted
+        self.images = iter(images)
+        self.found = 0
+        self.caption_stages = caption_stages
+        self.summarize_stages = summarize_stages
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        # caption stages every image is still waiting on, and the ones that failed it
+        self.waiting = {}
+        self.caption_failures = {}
+        self.incomplete = []
+
+    def run(self, events):
+        start = time.time()
+        running = self.caption_stages + self.summarize_stages
+        while any(not stage.exited for stage in running):
+            self._scan()
+            self._feed()
+            stage, results = events.get()
+            if results is None:
+                self._exited(stage)
+                continue
+
+            for result in results:
+                image = result['image']
+                stage.in_flight.discard(image)
+                stage.finished += 1
+                if stage.first_done is None:
+                    stage.first_done = time.time() - start
+                if result['ok']:
+                    stage.succeeded += 1
+                else:
+                    stage.failed += 1
+                    print(f"{stage.name} failed {image}")
+                if stage in self.caption_stages:
+                    if not result['ok']:
+                        self.caption_failures[image].append(stage.name)
+                    self._caption_done(stage.name, image)
+            print(f"{stage.name}: {stage.finished}/{self.found}{'' if self.images is None else '+'} image(s) done")
+
+        self._report(time.time() - start)
+
+    def _scan(self):
+        # keep every stage that is still running one batch ahead of what it may have in flight; once every
+        # caption stage is gone the rest of the scan is taken at once and fails straight away
+        stages = [stage for stage in self.caption_stages or self.summarize_stages if not stage.exited]
+        while self.images is not None and (not stages or any(
+                len(stage.pending) + len(stage.in_flight) < self.max_in_flight + self.batch_size for stage in stages)):
+            image = next(self.images, None)
+            if image is None:
+                self.images = None
+                print(f"Found {self.found} image(s)")
+                return
+            self.found += 1
+            self.caption_failures[image] = []
+            if not self.caption_stages:
+                self._captioned(image)
+                continue
+            self.waiting[image] = {stage.name for stage in self.caption_stages}
+            for stage in self.caption_stages:
+                if stage.exited:
+                    stage.failed += 1
+                    self.caption_failures[image].append(stage.name)
+                    self._caption_done(stage.name, image)
+                else:
+                    stage.pending.append(image)
+
+    def _feed(self):
+        for stage in self.caption_stages + self.summarize_stages:
+            stage.send(self.max_in_flight, self.batch_size)
+        if self.images is not None:
+            return
+        for stage in self.caption_stages:
+            if not stage.pending:
+                stage.close()
+        # summarizers only get more work while some image is still being captioned
+        if not any(self.waiting.values()):
+            for stage in self.summarize_stages:
+                if not stage.pending:
+                    stage.close()
+
+    def _caption_done(self, name, image):
+        self.waiting[image].discard(name)
+        if not self.waiting[image]:
+            del self.waiting[image]
+            self._captioned(image)
+
+    def _captioned(self, image):
+        failures = self.caption_failures.pop(image)
+        if failures:
+            # summarizing a partial caption set would silently produce a different summary
+            self.incomplete.append((image, failures))
+            return
+        for stage in self.summarize_stages:
+            stage.pending.append(image)
+
+    def _exited(self, stage):
+        stage.exited = True
+        code = stage.process.returncode
+        lost = list(stage.in_flight) + list(stage.pending)
+        if code != 0 or lost:
+            print(f"{stage.name} exited with code {code}, {len(lost)} image(s) unfinished")
+        stage.in_flight.clear()
+        stage.pending.clear()
+        stage.failed += len(lost)
+        if stage in self.caption_stages:
+            for image in lost:
+                self.caption_failures[image].append(stage.name)
+                self._caption_done(stage.name, image)
+
+    def _report(self, elapsed):
+        print(f"Finished {self.found} image(s) in {elapsed:.1f}s")
+        for stage in self.caption_stages + self.summarize_stages:
+            first = f", first result after {stage.first_done:.1f}s" if stage.first_done is not None else ""
+            print(f"  {stage.name}: {stage.succeeded} done, {stage.failed} failed{first}")
+        if self.summarize_stages and self.incomplete:
+            print(f"{len(self.incomplete)} image(s) were not summarized because a caption stage failed:")
+            for image, failures in self.incomplete:
+                print(f"  {image} ({', '.join(failures)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the captioning and summarization stages concurrently, streaming "
+                                                 "every image to the summarizer as soon as its captions are done.")
+    parser.add_argument("--input_directory", required=True, help="Directory of images to caption")
+    parser.add_argument("--batch_size", type=int, default=4, help="Images sent to a stage at a time")
+    parser.add_argument("--max_in_flight", type=int, default=16,
+                        help="Max images a stage may have been sent but not yet finished")
+    for name in list(CAPTION_STAGES) + list(SUMMARIZE_STAGES):
+        parser.add_argument(f"--{name}", metavar="OPTIONS",
+                            help=f"Run the {name} stage with these command line options")
+    add_scan_args(parser)
+    add_dedup_args(parser)
+    args = parser.parse_args()
+
+    base_directory = os.path.dirname(os.path.abspath(__file__))
+    images = scan_images(args.input_directory, args.scan_index)
+    dedup = dedup_from_args(args)
+    if dedup is not None:
+        images = dedup.representatives(images)
+
+    events = queue.Queue()
+    stages = {'caption': [], 'summarize': []}
+    try:
+        for kind, table in (('caption', CAPTION_STAGES), ('summarize', SUMMARIZE_STAGES)):
+            for name, (stage_directory, venv, script) in table.items():
+                options = getattr(args, name)
+                if options is not None:
+                    stages[kind].append(Stage(name, base_directory, stage_directory, venv, script, options, events))
+        if not stages['caption'] and not stages['summarize']:
+            print("No stages enabled. Exiting.")
+            return
+
+        Pipeline(images, stages['caption'], stages['summarize'], args.max_in_flight, args.batch_size).run(events)
+    finally:
+        for stage in stages['caption'] + stages['summarize']:
+            stage.close()
+            if stage.process.poll() is None:
+                stage.process.terminate()
+            stage.process.wait()
+        if dedup is not None:
+            dedup.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -50,12 +50,34 @@ while ($args.Length -gt 0) {
             Write-Host "--summarize_with_llama: use a llama derived local model for combining/summarizing your caption files"        
             Write-Host "--input_directory: absolute path to the directory containing the image files you wish to caption"
             Write-Host "--output_directory: output directory for saving caption files. If not set, defaults to value passed to --input_directory"
+            Write-Host "--dedup_index: absolute path to a duplicate index. Every image is hashed before the stages run, only one image of every group of duplicates goes through the models and summarizers, and its captions are copied to the others afterwards. Hashes are cached in the index, so later runs only hash new images."
+            Write-Host "--dedup_threshold: max Hamming distance, out of 64 bits, between the perceptual hashes of two images that count as duplicates. 0 only groups images that look identical, -1 only exact copies. Default: 4"
+            Write-Host "--trace: absolute path of a file every stage appends per-image timing spans and periodic throughput/latency summaries to, as JSON lines."
+            Write-Host "--quiet: do not print every caption and summary, which slows down large runs. Progress, errors and trace summaries are still shown."
+            Write-Host "--num_shards: split the images into this many fixed shards by path hash, for running on several machines. Use with --shard_index."
+            Write-Host "--shard_index: the shard this machine processes, from 0 to --num_shards - 1."
+            Write-Host "--lease_dir: absolute path to a shared directory through which several machines claim chunks of images as they go."
+            Write-Host "--scan_index: absolute path to a shared directory index. Later scans only list the directories that changed since the last one, which saves most of the walk over large or network-mounted datasets."
+            Write-Host "--caption_store: absolute path to a shared caption database. Every stage writes its captions and summaries there instead of one small file per image and stage, which is much faster on network filesystems."
+            Write-Host "--manifest: absolute path to a shared manifest database. Every stage skips images it already processed with the same settings, so reruns only handle new or changed images and resume after a crash."
+            Write-Host "--streaming: run all enabled stages at the same time and summarize every image as soon as its captions are written, instead of one full pass per stage. GPU stages running side by side need enough VRAM for all their models at once."
+            Write-Host "--streaming_batch_size: number of images handed to a stage at a time when streaming. Default: 4"
+            Write-Host "--streaming_max_in_flight: max images a stage may have queued but not yet finished when streaming. Default: 16"
             #wd14 options help
             Write-Host "--wd14_stack_models: runs three wd14 models and takes the mean of their values Default: ['SmilingWolf/wd-v1-4-convnext-tagger-v2', 'SmilingWolf/wd-v1-4-vit-tagger-v2', 'SmilingWolf/wd-v1-4-swinv2-tagger-v2'] "
             Write-Host "--wd14_model: if not stacking, which wd14 model to run Default: SmilingWolf/wd-v1-4-swinv2-tagger-v2"
             Write-Host "--wd14_threshold: min confidence threshold for wd14 captions. If wd14_stack_models is passed, the threshold is applied before stacking. Default: .45  "
             Write-Host "--wd14_filter: tags to filter out when running wd14 tagger"
             Write-Host "--wd14_output_extension: file extension that wd14 captions will be saved with Default: wd14cap"
+            Write-Host "--wd14_batch_size: Number of images to run through each wd14 model at once. Use 1 for byte-identical captions."
+            Write-Host "--wd14_num_threads: Total CPU threads for wd14 inference, split evenly between the loaded models. Defaults to all cores."
+            Write-Host "--wd14_fast_preprocess: decode JPEGs at reduced size and resize before padding. Output matches the default preprocessing within resampling error."
+            Write-Host "--wd14_loader_workers: number of background workers decoding images ahead of the wd14 model. 0 loads images inline."
+            Write-Host "--wd14_score_cache_dir: directory storing raw wd14 scores per image content hash. Cached images skip inference."
+            Write-Host "--wd14_rerender: rebuild wd14 caption files from --wd14_score_cache_dir with the current threshold/filter/stacking settings without running any model."
+            Write-Host "--wd14_ort_preset: onnxruntime session options: throughput for batch runs, latency for small batches with --serve, default for onnxruntime's own."
+            Write-Host "--wd14_ort_cache_dir: directory to keep the optimized (and quantized) wd14 models in, so later runs start faster."
+            Write-Host "--wd14_quantize: run dynamically quantized copies of the wd14 models, e.g. int8. Needs --wd14_ort_cache_dir. Check the tag agreement first with caption_wd14.py --check_quantize."
             #blip2 options help
             Write-Host "--blip2_model: blip2 model to use for generating captions Default: blip2_opt/caption_coco_opt6.7b"
             Write-Host "--blip2_use_nucleus_sampling: whether to use nucleus sampling when generating blip2 captions Default: False"
@@ -64,6 +86,13 @@ while ($args.Length -gt 0) {
             Write-Host "--blip2_min_tokens: min_tokens value to be passed to blip2 model Default: 20"
             Write-Host "--blip2_top_p: top_p value to be passed to blip2 model Default: 1"
             Write-Host "--blip2_output_extension: file extension that blip2 captions will be saved with Default: b2cap"
+            Write-Host "--blip2_loader_workers: number of background workers decoding images ahead of the blip2 model. 0 loads images inline."
+            Write-Host "--blip2_batch_size: number of images captioned per blip2 generate call."
+            Write-Host "--blip2_device: torch device for blip2, e.g. cuda or cpu. Defaults to cuda when available, otherwise cpu."
+            Write-Host "--blip2_num_threads: number of torch CPU threads for blip2 when running on cpu."
+            Write-Host "--blip2_interop_threads: number of torch inter-op threads for blip2 when running on cpu."
+            Write-Host "--blip2_bf16: bfloat16 autocast for blip2 on cpu: auto, on or off. auto uses it when the CPU supports bf16."
+            Write-Host "--blip2_quantize: run the blip2 language model with dynamically quantized Linear layers, e.g. int8. CPU only."
             #open flamingo options help
             Write-Host "--flamingo_example_img_dir: path to open flamingo example image/caption pairs"
             Write-Host "--flamingo_model: open_flamingo model to be used for captioning. Default: openflamingo/OpenFlamingo-9B-vitl-mpt7b"
@@ -77,11 +106,25 @@ while ($args.Length -gt 0) {
             Write-Host "--flamingo_repetition_penalty: repitition penalty  value to be passed to open flamingo model Default: 1"
             Write-Host "--flamingo_length_penalty: length penalty value to be passed to open flamingo model"
             Write-Host "--flamingo_output_extension: file extension that open flamingo captions will be saved with Default: flamcap"
+            Write-Host "--flamingo_loader_workers: number of background workers decoding images ahead of the Open Flamingo model. 0 loads images inline."
+            Write-Host "--flamingo_no_prefix_cache: re-encode the few-shot examples for every image instead of computing their vision features and prompt state once per run."
+            Write-Host "--flamingo_batch_size: number of query images captioned per Open Flamingo generate call."
+            Write-Host "--flamingo_weights_cache_dir: directory to keep safetensors copies of the Open Flamingo checkpoints in, converted once to the run's dtype, so later runs memory-map them and start faster with less memory."
+            Write-Host "--flamingo_device: torch device for open flamingo, e.g. cuda or cpu. Defaults to cuda when available, otherwise cpu."
+            Write-Host "--flamingo_num_threads: number of torch CPU threads for open flamingo when running on cpu."
+            Write-Host "--flamingo_interop_threads: number of torch inter-op threads for open flamingo when running on cpu."
+            Write-Host "--flamingo_bf16: bfloat16 weights and autocast for open flamingo on cpu: auto, on or off. auto uses them when the CPU supports bf16."
+            Write-Host "--flamingo_quantize: run the open flamingo language model with dynamically quantized Linear layers, e.g. int8. CPU only."
             #summarize options help
             Write-Host "--summarize_gpt_model: OpenAI model to use for summarization Default: gpt-3.5-turbo"
             Write-Host "--summarize_gpt_max_tokens: max tokens for GPT Default: 75"
             Write-Host "--summarize_gpt_temperature: temperature to be set for GPT Default: 1.0"
             Write-Host "--summarize_gpt_prompt_file_path: file path to a txt file containing the system prompt to be passed to gpt for summarizing your captions"
+            Write-Host "--summarize_gpt_concurrency: max number of GPT requests in flight at once."
+            Write-Host "--summarize_gpt_requests_per_minute: GPT request rate limit. If not set, follows the API rate limit headers."
+            Write-Host "--summarize_gpt_tokens_per_minute: GPT token rate limit. If not set, follows the API rate limit headers."
+            Write-Host "--summarize_gpt_max_retries: retries per GPT request on rate limits and server errors, with exponential backoff."
+            Write-Host "--summarize_gpt_prompt_budget: max prompt tokens per image for GPT, system prompt included. The least confident tags are dropped first, then the captions are shortened. If not set, prompts are not trimmed."
             # Write-Host "--summarize_file_extensions: The file extensions/captions you want to be passed to your summarize model. Defaults to values of flamingo, blip2, and wd14 output extensions, e.g. ['wd14cap','flamcap','b2cap']"
             Write-Host "--summarize_openai_api_key: value of a valid open ai api key. Not needed if the OPENAI_API_KEY env variable is set"
             Write-Host "--summarize_llama_model_repo_id: Huggingface Repository ID or name of the llama model to use for summarization."
@@ -96,6 +139,10 @@ while ($args.Length -gt 0) {
             Write-Host "--summarize_llama_top_p : top_p value to run llama model with Default: 1.0"
             Write-Host "--summarize_llama_frequency_penalty : frequency penalty value to run llama model with Default: 0"
             Write-Host "--summarize_llama_top_p : presence penalty value to run llama model with Default: 0"
+            Write-Host "--summarize_llama_no_prompt_cache: don't evaluate and keep the llama system prompt state up front."
+            Write-Host "--summarize_llama_prompt_cache_dir: directory to persist the evaluated llama system prompt state in, so later runs skip evaluating it."
+            Write-Host "--summarize_llama_num_workers: number of llama processes to run. --summarize_llama_n_threads is split between them and the mmapped model weights are shared."
+            Write-Host "--summarize_llama_prompt_budget: max prompt tokens per image for llama, system prompt included. Prompts are always trimmed to fit the 1024 token context next to --summarize_llama_max_tokens; this sets a lower limit."
         }
         '--use_blip2' {
             $use_blip2 = $true
@@ -142,6 +189,84 @@ while ($args.Length -gt 0) {
             $args = $args[2..($args.Count - 1)]
             continue
         }
+        '--dedup_index' {
+            $options,$value,$args = $args
+            $dedup_index = $value
+            $user_args = '{0} --dedup_index "{1}"' -f $user_args, $value
+            continue
+        }
+        '--dedup_threshold' {
+            $options,$value,$args = $args
+            $dedup_threshold = $value
+            $user_args = '{0} --dedup_threshold "{1}"' -f $user_args, $value
+            continue
+        }
+        '--trace' {
+            $options,$value,$args = $args
+            $trace = $value
+            $user_args = '{0} --trace "{1}"' -f $user_args, $value
+            continue
+        }
+        '--quiet' {
+            $quiet = $true
+            $user_args = '{0} --quiet' -f $user_args
+            $options,$args = $args
+            continue
+        }
+        '--lease_dir' {
+            $options,$value,$args = $args
+            $lease_dir = $value
+            $user_args = '{0} --lease_dir "{1}"' -f $user_args, $value
+            continue
+        }
+        '--shard_index' {
+            $options,$value,$args = $args
+            $shard_index = $value
+            $user_args = '{0} --shard_index "{1}"' -f $user_args, $value
+            continue
+        }
+        '--num_shards' {
+            $options,$value,$args = $args
+            $num_shards = $value
+            $user_args = '{0} --num_shards "{1}"' -f $user_args, $value
+            continue
+        }
+        '--scan_index' {
+            $options,$value,$args = $args
+            $scan_index = $value
+            $user_args = '{0} --scan_index "{1}"' -f $user_args, $value
+            continue
+        }
+        '--caption_store' {
+            $options,$value,$args = $args
+            $caption_store = $value
+            $user_args = '{0} --caption_store "{1}"' -f $user_args, $value
+            continue
+        }
+        '--manifest' {
+            $options,$value,$args = $args
+            $manifest = $value
+            $user_args = '{0} --manifest "{1}"' -f $user_args, $value
+            continue
+        }
+        '--streaming' {
+            $streaming = $true
+            $user_args = '{0} --streaming' -f $user_args
+            $options,$args = $args
+            continue
+        }
+        '--streaming_batch_size' {
+            $options,$value,$args = $args
+            $streaming_batch_size = $value
+            $user_args = '{0} --streaming_batch_size "{1}"' -f $user_args, $value
+            continue
+        }
+        '--streaming_max_in_flight' {
+            $options,$value,$args = $args
+            $streaming_max_in_flight = $value
+            $user_args = '{0} --streaming_max_in_flight "{1}"' -f $user_args, $value
+            continue
+        }
         '--wd14_stack_models' {
             $wd14_stack_models = $true
             $user_args = '{0} --wd14_stack_models' -f $user_args
@@ -173,6 +298,60 @@ while ($args.Length -gt 0) {
             $user_args = '{0} --wd14_output_extension "{1}"' -f $user_args, $value
             continue
         }
+        '--wd14_batch_size' {
+            $options,$value,$args = $args
+            $wd14_batch_size = $value
+            $user_args = '{0} --wd14_batch_size "{1}"' -f $user_args, $value
+            continue
+        }
+        '--wd14_num_threads' {
+            $options,$value,$args = $args
+            $wd14_num_threads = $value
+            $user_args = '{0} --wd14_num_threads "{1}"' -f $user_args, $value
+            continue
+        }
+        '--wd14_fast_preprocess' {
+            $wd14_fast_preprocess = $true
+            $user_args = '{0} --wd14_fast_preprocess' -f $user_args
+            $options,$args = $args
+            continue
+        }
+        '--wd14_loader_workers' {
+            $options,$value,$args = $args
+            $wd14_loader_workers = $value
+            $user_args = '{0} --wd14_loader_workers "{1}"' -f $user_args, $value
+            continue
+        }
+        '--wd14_score_cache_dir' {
+            $options,$value,$args = $args
+            $wd14_score_cache_dir = $value
+            $user_args = '{0} --wd14_score_cache_dir "{1}"' -f $user_args, $value
+            continue
+        }
+        '--wd14_rerender' {
+            $wd14_rerender = $true
+            $user_args = '{0} --wd14_rerender' -f $user_args
+            $options,$args = $args
+            continue
+        }
+        '--wd14_ort_preset' {
+            $options,$value,$args = $args
+            $wd14_ort_preset = $value
+            $user_args = '{0} --wd14_ort_preset "{1}"' -f $user_args, $value
+            continue
+        }
+        '--wd14_ort_cache_dir' {
+            $options,$value,$args = $args
+            $wd14_ort_cache_dir = $value
+            $user_args = '{0} --wd14_ort_cache_dir "{1}"' -f $user_args, $value
+            continue
+        }
+        '--wd14_quantize' {
+            $options,$value,$args = $args
+            $wd14_quantize = $value
+            $user_args = '{0} --wd14_quantize "{1}"' -f $user_args, $value
+            continue
+        }
         '--blip2_model'{
             $options,$value,$args = $args
             $blip2_model=$value
@@ -216,6 +395,48 @@ while ($args.Length -gt 0) {
             $user_args = '{0} --blip2_output_extension "{1}"' -f $user_args, $value
             continue
         }
+        '--blip2_loader_workers' {
+            $options,$value,$args = $args
+            $blip2_loader_workers = $value
+            $user_args = '{0} --blip2_loader_workers "{1}"' -f $user_args, $value
+            continue
+        }
+        '--blip2_batch_size' {
+            $options,$value,$args = $args
+            $blip2_batch_size = $value
+            $user_args = '{0} --blip2_batch_size "{1}"' -f $user_args, $value
+            continue
+        }
+        '--blip2_device' {
+            $options,$value,$args = $args
+            $blip2_device = $value
+            $user_args = '{0} --blip2_device "{1}"' -f $user_args, $value
+            continue
+        }
+        '--blip2_num_threads' {
+            $options,$value,$args = $args
+            $blip2_num_threads = $value
+            $user_args = '{0} --blip2_num_threads "{1}"' -f $user_args, $value
+            continue
+        }
+        '--blip2_interop_threads' {
+            $options,$value,$args = $args
+            $blip2_interop_threads = $value
+            $user_args = '{0} --blip2_interop_threads "{1}"' -f $user_args, $value
+            continue
+        }
+        '--blip2_bf16' {
+            $options,$value,$args = $args
+            $blip2_bf16 = $value
+            $user_args = '{0} --blip2_bf16 "{1}"' -f $user_args, $value
+            continue
+        }
+        '--blip2_quantize' {
+            $options,$value,$args = $args
+            $blip2_quantize = $value
+            $user_args = '{0} --blip2_quantize "{1}"' -f $user_args, $value
+            continue
+        }
         '--flamingo_example_img_dir'{
             $options,$value,$args = $args
             $flamingo_example_img_dir=$value
@@ -289,6 +510,60 @@ while ($args.Length -gt 0) {
             $user_args = '{0} --flamingo_output_extension "{1}"' -f $user_args, $value
             continue
         }
+        '--flamingo_loader_workers' {
+            $options,$value,$args = $args
+            $flamingo_loader_workers = $value
+            $user_args = '{0} --flamingo_loader_workers "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_no_prefix_cache' {
+            $flamingo_no_prefix_cache = $true
+            $user_args = '{0} --flamingo_no_prefix_cache' -f $user_args
+            $options,$args = $args
+            continue
+        }
+        '--flamingo_batch_size' {
+            $options,$value,$args = $args
+            $flamingo_batch_size = $value
+            $user_args = '{0} --flamingo_batch_size "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_weights_cache_dir' {
+            $options,$value,$args = $args
+            $flamingo_weights_cache_dir = $value
+            $user_args = '{0} --flamingo_weights_cache_dir "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_device' {
+            $options,$value,$args = $args
+            $flamingo_device = $value
+            $user_args = '{0} --flamingo_device "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_num_threads' {
+            $options,$value,$args = $args
+            $flamingo_num_threads = $value
+            $user_args = '{0} --flamingo_num_threads "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_interop_threads' {
+            $options,$value,$args = $args
+            $flamingo_interop_threads = $value
+            $user_args = '{0} --flamingo_interop_threads "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_bf16' {
+            $options,$value,$args = $args
+            $flamingo_bf16 = $value
+            $user_args = '{0} --flamingo_bf16 "{1}"' -f $user_args, $value
+            continue
+        }
+        '--flamingo_quantize' {
+            $options,$value,$args = $args
+            $flamingo_quantize = $value
+            $user_args = '{0} --flamingo_quantize "{1}"' -f $user_args, $value
+            continue
+        }
         '--summarize_gpt_model'{
             $options,$value,$args = $args
             $summarize_gpt_model=$value
@@ -313,6 +588,36 @@ while ($args.Length -gt 0) {
             $user_args = '{0} --summarize_gpt_prompt_file_path "{1}"' -f $user_args, $value
             continue
         }
+        '--summarize_gpt_concurrency' {
+            $options,$value,$args = $args
+            $summarize_gpt_concurrency = $value
+            $user_args = '{0} --summarize_gpt_concurrency "{1}"' -f $user_args, $value
+            continue
+        }
+        '--summarize_gpt_requests_per_minute' {
+            $options,$value,$args = $args
+            $summarize_gpt_requests_per_minute = $value
+            $user_args = '{0} --summarize_gpt_requests_per_minute "{1}"' -f $user_args, $value
+            continue
+        }
+        '--summarize_gpt_tokens_per_minute' {
+            $options,$value,$args = $args
+            $summarize_gpt_tokens_per_minute = $value
+            $user_args = '{0} --summarize_gpt_tokens_per_minute "{1}"' -f $user_args, $value
+            continue
+        }
+        '--summarize_gpt_max_retries' {
+            $options,$value,$args = $args
+            $summarize_gpt_max_retries = $value
+            $user_args = '{0} --summarize_gpt_max_retries "{1}"' -f $user_args, $value
+            continue
+        }
+        '--summarize_gpt_prompt_budget' {
+            $options,$value,$args = $args
+            $summarize_gpt_prompt_budget = $value
+            $user_args = '{0} --summarize_gpt_prompt_budget "{1}"' -f $user_args, $value
+            continue
+        }
         # '--summarize_file_extensions'{
         #     $options,$value,$args = $args
         #     $summarize_file_extensions=$value
@@ -397,6 +702,30 @@ while ($args.Length -gt 0) {
             $user_args = '{0} --summarize_llama_presence_penalty "{1}"' -f $user_args, $value
             continue
         }
+        '--summarize_llama_no_prompt_cache' {
+            $summarize_llama_no_prompt_cache = $true
+            $user_args = '{0} --summarize_llama_no_prompt_cache' -f $user_args
+            $options,$args = $args
+            continue
+        }
+        '--summarize_llama_prompt_cache_dir' {
+            $options,$value,$args = $args
+            $summarize_llama_prompt_cache_dir = $value
+            $user_args = '{0} --summarize_llama_prompt_cache_dir "{1}"' -f $user_args, $value
+            continue
+        }
+        '--summarize_llama_num_workers' {
+            $options,$value,$args = $args
+            $summarize_llama_num_workers = $value
+            $user_args = '{0} --summarize_llama_num_workers "{1}"' -f $user_args, $value
+            continue
+        }
+        '--summarize_llama_prompt_budget' {
+            $options,$value,$args = $args
+            $summarize_llama_prompt_budget = $value
+            $user_args = '{0} --summarize_llama_prompt_budget "{1}"' -f $user_args, $value
+            continue
+        }
         default {
             Write-Host "Unknown parameter passed: $($args[0])"
             exit 1
@@ -436,6 +765,25 @@ if ([string]::IsNullOrEmpty($output_directory)) {
 Write-Host "User Arguments:"
 Write-Host "$user_args"
 
+# Hashing the images and grouping the duplicates if set, with the first captioning venv that is installed
+if (-not [string]::IsNullOrEmpty($dedup_index)) {
+    $dedup_python = "python"
+    foreach ($venv in @("wd14/venv_wd14", "blip2/venv_blip2", "open_flamingo/venv_open_flamingo")) {
+        $venvPython = Join-Path $base_directory "$venv/Scripts/python.exe"
+        if (Test-Path $venvPython) {
+            $dedup_python = $venvPython
+            break
+        }
+    }
+    $dedup_args = @("index", $input_directory, "--dedup_index=$dedup_index")
+    if (-not [string]::IsNullOrEmpty($dedup_threshold)) { $dedup_args += "--threshold=$dedup_threshold" }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $dedup_args += "--scan_index=$scan_index" }
+
+    Set-Location $base_directory
+    & $dedup_python -m common.dedup @dedup_args
+    if ($LASTEXITCODE -ne 0) { exit 1 }
+}
+
 function generate_blip2_options {
     param(
         $options = ""
@@ -449,12 +797,28 @@ function generate_blip2_options {
     if (-not [string]::IsNullOrEmpty($blip2_min_length)) { $options = "{0} --min_length {1}" -f $options,$blip2_min_length }
     if (-not [string]::IsNullOrEmpty($blip2_top_p)) { $options = "{0} --top_p {1}" -f $options,$blip2_top_p }
     if (-not [string]::IsNullOrEmpty($blip2_output_extension)) { $options = "{0} --output_file_extension {1}" -f $options,$blip2_output_extension }
+    if (-not [string]::IsNullOrEmpty($blip2_loader_workers)) { $options = "{0} --loader_workers {1}" -f $options,$blip2_loader_workers }
+    if (-not [string]::IsNullOrEmpty($manifest)) { $options = "{0} --manifest {1}" -f $options,$manifest }
+    if (-not [string]::IsNullOrEmpty($blip2_batch_size)) { $options = "{0} --batch_size {1}" -f $options,$blip2_batch_size }
+    if (-not [string]::IsNullOrEmpty($blip2_device)) { $options = "{0} --device {1}" -f $options,$blip2_device }
+    if (-not [string]::IsNullOrEmpty($blip2_num_threads)) { $options = "{0} --num_threads {1}" -f $options,$blip2_num_threads }
+    if (-not [string]::IsNullOrEmpty($caption_store)) { $options = "{0} --caption_store {1}" -f $options,$caption_store }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $options = "{0} --scan_index {1}" -f $options,$scan_index }
+    if (-not [string]::IsNullOrEmpty($num_shards)) { $options = "{0} --num_shards {1}" -f $options,$num_shards }
+    if (-not [string]::IsNullOrEmpty($shard_index)) { $options = "{0} --shard_index {1}" -f $options,$shard_index }
+    if (-not [string]::IsNullOrEmpty($lease_dir)) { $options = "{0} --lease_dir {1}" -f $options,$lease_dir }
+    if (-not [string]::IsNullOrEmpty($quiet)) { $options = "{0} --quiet" -f $options }
+    if (-not [string]::IsNullOrEmpty($trace)) { $options = "{0} --trace {1}" -f $options,$trace }
+    if (-not [string]::IsNullOrEmpty($blip2_interop_threads)) { $options = "{0} --interop_threads {1}" -f $options,$blip2_interop_threads }
+    if (-not [string]::IsNullOrEmpty($blip2_bf16)) { $options = "{0} --bf16 {1}" -f $options,$blip2_bf16 }
+    if (-not [string]::IsNullOrEmpty($blip2_quantize)) { $options = "{0} --quantize {1}" -f $options,$blip2_quantize }
+    if (-not [string]::IsNullOrEmpty($dedup_index)) { $options = "{0} --dedup_index {1}" -f $options,$dedup_index }
     
     return $options.Remove(0,1) 
 }
 
 # Running blip2 if set
-if ($use_blip2 -eq "true") {
+if ($use_blip2 -eq "true" -and -not $streaming) {
     $blip2ScriptPath = Join-Path $base_directory "blip2/venv_blip2/Scripts/activate.ps1"
     $blip2Directory = Join-Path $base_directory "blip2"
     
@@ -485,12 +849,30 @@ function generate_open_flamingo_options {
     if (-not [string]::IsNullOrEmpty($flamingo_repetition_penalty)){ $options = "{0} --repetition_penalty {1}" -f $options,$flamingo_repetition_penalty }
     if (-not [string]::IsNullOrEmpty($flamingo_length_penalty)){ $options = "{0} --length_penalty {1}" -f $options,$flamingo_length_penalty }
     if (-not [string]::IsNullOrEmpty($flamingo_output_extension)){ $options = "{0} --output_extension {1}" -f $options,$flamingo_output_extension }
+    if (-not [string]::IsNullOrEmpty($flamingo_loader_workers)) { $options = "{0} --loader_workers {1}" -f $options,$flamingo_loader_workers }
+    if (-not [string]::IsNullOrEmpty($manifest)) { $options = "{0} --manifest {1}" -f $options,$manifest }
+    if (-not [string]::IsNullOrEmpty($flamingo_no_prefix_cache)) { $options = "{0} --no_prefix_cache" -f $options }
+    if (-not [string]::IsNullOrEmpty($flamingo_batch_size)) { $options = "{0} --batch_size {1}" -f $options,$flamingo_batch_size }
+    if (-not [string]::IsNullOrEmpty($caption_store)) { $options = "{0} --caption_store {1}" -f $options,$caption_store }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $options = "{0} --scan_index {1}" -f $options,$scan_index }
+    if (-not [string]::IsNullOrEmpty($num_shards)) { $options = "{0} --num_shards {1}" -f $options,$num_shards }
+    if (-not [string]::IsNullOrEmpty($shard_index)) { $options = "{0} --shard_index {1}" -f $options,$shard_index }
+    if (-not [string]::IsNullOrEmpty($lease_dir)) { $options = "{0} --lease_dir {1}" -f $options,$lease_dir }
+    if (-not [string]::IsNullOrEmpty($quiet)) { $options = "{0} --quiet" -f $options }
+    if (-not [string]::IsNullOrEmpty($trace)) { $options = "{0} --trace {1}" -f $options,$trace }
+    if (-not [string]::IsNullOrEmpty($flamingo_weights_cache_dir)) { $options = "{0} --weights_cache_dir {1}" -f $options,$flamingo_weights_cache_dir }
+    if (-not [string]::IsNullOrEmpty($flamingo_device)) { $options = "{0} --device {1}" -f $options,$flamingo_device }
+    if (-not [string]::IsNullOrEmpty($flamingo_num_threads)) { $options = "{0} --num_threads {1}" -f $options,$flamingo_num_threads }
+    if (-not [string]::IsNullOrEmpty($flamingo_interop_threads)) { $options = "{0} --interop_threads {1}" -f $options,$flamingo_interop_threads }
+    if (-not [string]::IsNullOrEmpty($flamingo_bf16)) { $options = "{0} --bf16 {1}" -f $options,$flamingo_bf16 }
+    if (-not [string]::IsNullOrEmpty($flamingo_quantize)) { $options = "{0} --quantize {1}" -f $options,$flamingo_quantize }
+    if (-not [string]::IsNullOrEmpty($dedup_index)) { $options = "{0} --dedup_index {1}" -f $options,$dedup_index }
     
     return $options.Remove(0,1) 
 }
 
 # Running blip2 if set
-if ($use_open_flamingo -eq "true") {
+if ($use_open_flamingo -eq "true" -and -not $streaming) {
     $flamingoScriptPath = Join-Path $base_directory "open_flamingo/venv_open_flamingo/Scripts/activate.ps1"
     $flamingoDirectory = Join-Path $base_directory "open_flamingo"
     
@@ -515,12 +897,30 @@ function generate_wd14_options {
     if (-not [string]::IsNullOrEmpty($wd14_filter)) { $options = "{0} --filter {1}" -f $options,$wd14_filter }
     if (-not [string]::IsNullOrEmpty($wd14_output_extension)) { $options = "{0} --output_extension {1}" -f $options,$wd14_output_extension }
     if (-not [string]::IsNullOrEmpty($wd14_stack_models)) { $options = "{0} --stack_models" -f $options }
+    if (-not [string]::IsNullOrEmpty($wd14_batch_size)) { $options = "{0} --batch_size {1}" -f $options,$wd14_batch_size }
+    if (-not [string]::IsNullOrEmpty($wd14_num_threads)) { $options = "{0} --num_threads {1}" -f $options,$wd14_num_threads }
+    if (-not [string]::IsNullOrEmpty($wd14_fast_preprocess)) { $options = "{0} --fast_preprocess" -f $options }
+    if (-not [string]::IsNullOrEmpty($wd14_loader_workers)) { $options = "{0} --loader_workers {1}" -f $options,$wd14_loader_workers }
+    if (-not [string]::IsNullOrEmpty($wd14_score_cache_dir)) { $options = "{0} --score_cache_dir {1}" -f $options,$wd14_score_cache_dir }
+    if (-not [string]::IsNullOrEmpty($wd14_rerender)) { $options = "{0} --rerender" -f $options }
+    if (-not [string]::IsNullOrEmpty($manifest)) { $options = "{0} --manifest {1}" -f $options,$manifest }
+    if (-not [string]::IsNullOrEmpty($caption_store)) { $options = "{0} --caption_store {1}" -f $options,$caption_store }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $options = "{0} --scan_index {1}" -f $options,$scan_index }
+    if (-not [string]::IsNullOrEmpty($num_shards)) { $options = "{0} --num_shards {1}" -f $options,$num_shards }
+    if (-not [string]::IsNullOrEmpty($shard_index)) { $options = "{0} --shard_index {1}" -f $options,$shard_index }
+    if (-not [string]::IsNullOrEmpty($lease_dir)) { $options = "{0} --lease_dir {1}" -f $options,$lease_dir }
+    if (-not [string]::IsNullOrEmpty($quiet)) { $options = "{0} --quiet" -f $options }
+    if (-not [string]::IsNullOrEmpty($trace)) { $options = "{0} --trace {1}" -f $options,$trace }
+    if (-not [string]::IsNullOrEmpty($wd14_ort_preset)) { $options = "{0} --ort_preset {1}" -f $options,$wd14_ort_preset }
+    if (-not [string]::IsNullOrEmpty($wd14_ort_cache_dir)) { $options = "{0} --ort_cache_dir {1}" -f $options,$wd14_ort_cache_dir }
+    if (-not [string]::IsNullOrEmpty($wd14_quantize)) { $options = "{0} --quantize {1}" -f $options,$wd14_quantize }
+    if (-not [string]::IsNullOrEmpty($dedup_index)) { $options = "{0} --dedup_index {1}" -f $options,$dedup_index }
 
     return $options.Remove(0,1) 
 }
 
 # Running wd14 if set
-if ($use_wd14 -eq "true") {
+if ($use_wd14 -eq "true" -and -not $streaming) {
     $wd14ScriptPath = Join-Path $base_directory "wd14/venv_wd14/Scripts/activate.ps1"
     $wd14Directory = Join-Path $base_directory "wd14"
 
@@ -547,12 +947,26 @@ function generate_summarize_with_gpt_options {
     if (-not [string]::IsNullOrEmpty($summarize_openai_api_key)) { $options = "{0} --api_key {1}" -f $options,$summarize_openai_api_key }
     # if (-not [string]::IsNullOrEmpty($summarize_file_extensions)) { $options = "{0} --caption_exts {1}" -f $options,$summarize_file_extensions }
     if (-not [string]::IsNullOrEmpty($output_directory)) { $options = "{0} --output_dir {1}" -f $options,$output_directory }
+    if (-not [string]::IsNullOrEmpty($manifest)) { $options = "{0} --manifest {1}" -f $options,$manifest }
+    if (-not [string]::IsNullOrEmpty($summarize_gpt_concurrency)) { $options = "{0} --concurrency {1}" -f $options,$summarize_gpt_concurrency }
+    if (-not [string]::IsNullOrEmpty($summarize_gpt_requests_per_minute)) { $options = "{0} --requests_per_minute {1}" -f $options,$summarize_gpt_requests_per_minute }
+    if (-not [string]::IsNullOrEmpty($summarize_gpt_tokens_per_minute)) { $options = "{0} --tokens_per_minute {1}" -f $options,$summarize_gpt_tokens_per_minute }
+    if (-not [string]::IsNullOrEmpty($summarize_gpt_max_retries)) { $options = "{0} --max_retries {1}" -f $options,$summarize_gpt_max_retries }
+    if (-not [string]::IsNullOrEmpty($caption_store)) { $options = "{0} --caption_store {1}" -f $options,$caption_store }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $options = "{0} --scan_index {1}" -f $options,$scan_index }
+    if (-not [string]::IsNullOrEmpty($num_shards)) { $options = "{0} --num_shards {1}" -f $options,$num_shards }
+    if (-not [string]::IsNullOrEmpty($shard_index)) { $options = "{0} --shard_index {1}" -f $options,$shard_index }
+    if (-not [string]::IsNullOrEmpty($lease_dir)) { $options = "{0} --lease_dir {1}" -f $options,$lease_dir }
+    if (-not [string]::IsNullOrEmpty($quiet)) { $options = "{0} --quiet" -f $options }
+    if (-not [string]::IsNullOrEmpty($trace)) { $options = "{0} --trace {1}" -f $options,$trace }
+    if (-not [string]::IsNullOrEmpty($dedup_index)) { $options = "{0} --dedup_index {1}" -f $options,$dedup_index }
+    if (-not [string]::IsNullOrEmpty($summarize_gpt_prompt_budget)) { $options = "{0} --prompt_budget {1}" -f $options,$summarize_gpt_prompt_budget }
 
     return $options.Remove(0,1) 
 }
 
 # Running summarize_with_gpt if set
-if ($summarize_with_gpt -eq "true") {
+if ($summarize_with_gpt -eq "true" -and -not $streaming) {
     $summarizeScriptPath = Join-Path $base_directory "summarize/venv_summarize/Scripts/activate.ps1"
     $summarizeDirectory = Join-Path $base_directory "summarize"
 
@@ -587,12 +1001,25 @@ function generate_summarize_with_llama_options {
     if (-not [string]::IsNullOrEmpty($summarize_llama_top_p)) { $options = "{0} --top_p {1}" -f $options,$summarize_llama_top_p }
     if (-not [string]::IsNullOrEmpty($summarize_llama_frequency_penalty)) { $options = "{0} --frequency_penalty {1}" -f $options,$summarize_llama_frequency_penalty }
     if (-not [string]::IsNullOrEmpty($summarize_llama_presence_penalty)) { $options = "{0} --presence_penalty {1}" -f $options,$summarize_llama_presence_penalty }
+    if (-not [string]::IsNullOrEmpty($manifest)) { $options = "{0} --manifest {1}" -f $options,$manifest }
+    if (-not [string]::IsNullOrEmpty($summarize_llama_no_prompt_cache)) { $options = "{0} --no_prompt_cache" -f $options }
+    if (-not [string]::IsNullOrEmpty($summarize_llama_prompt_cache_dir)) { $options = "{0} --prompt_cache_dir {1}" -f $options,$summarize_llama_prompt_cache_dir }
+    if (-not [string]::IsNullOrEmpty($summarize_llama_num_workers)) { $options = "{0} --num_workers {1}" -f $options,$summarize_llama_num_workers }
+    if (-not [string]::IsNullOrEmpty($caption_store)) { $options = "{0} --caption_store {1}" -f $options,$caption_store }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $options = "{0} --scan_index {1}" -f $options,$scan_index }
+    if (-not [string]::IsNullOrEmpty($num_shards)) { $options = "{0} --num_shards {1}" -f $options,$num_shards }
+    if (-not [string]::IsNullOrEmpty($shard_index)) { $options = "{0} --shard_index {1}" -f $options,$shard_index }
+    if (-not [string]::IsNullOrEmpty($lease_dir)) { $options = "{0} --lease_dir {1}" -f $options,$lease_dir }
+    if (-not [string]::IsNullOrEmpty($quiet)) { $options = "{0} --quiet" -f $options }
+    if (-not [string]::IsNullOrEmpty($trace)) { $options = "{0} --trace {1}" -f $options,$trace }
+    if (-not [string]::IsNullOrEmpty($dedup_index)) { $options = "{0} --dedup_index {1}" -f $options,$dedup_index }
+    if (-not [string]::IsNullOrEmpty($summarize_llama_prompt_budget)) { $options = "{0} --prompt_budget {1}" -f $options,$summarize_llama_prompt_budget }
     
     return $options.Remove(0,1) 
 }
 
 # Running summarize_with_llama if set
-if ($summarize_with_llama -eq "true") {
+if ($summarize_with_llama -eq "true" -and -not $streaming) {
     $summarizeScriptPath = Join-Path $base_directory "summarize/venv_summarize/Scripts/activate.ps1"
     $summarizeDirectory = Join-Path $base_directory "summarize"
 
@@ -605,3 +1032,29 @@ if ($summarize_with_llama -eq "true") {
     deactivate
     Set-Location $base_directory
 }
+
+# Running every enabled stage at once through the streaming pipeline if set
+if ($streaming) {
+    $pipeline_args = @("--input_directory=$input_directory")
+    if ($use_blip2 -eq "true") { $pipeline_args += "--blip2=$(generate_blip2_options)" }
+    if ($use_open_flamingo -eq "true") { $pipeline_args += "--open_flamingo=$(generate_open_flamingo_options)" }
+    if ($use_wd14 -eq "true") { $pipeline_args += "--wd14=$(generate_wd14_options)" }
+    if ($summarize_with_gpt -eq "true") { $pipeline_args += "--summarize_gpt=$(generate_summarize_with_gpt_options)" }
+    if ($summarize_with_llama -eq "true") { $pipeline_args += "--summarize_llama=$(generate_summarize_with_llama_options)" }
+    if (-not [string]::IsNullOrEmpty($streaming_batch_size)) { $pipeline_args += "--batch_size=$streaming_batch_size" }
+    if (-not [string]::IsNullOrEmpty($streaming_max_in_flight)) { $pipeline_args += "--max_in_flight=$streaming_max_in_flight" }
+    if (-not [string]::IsNullOrEmpty($scan_index)) { $pipeline_args += "--scan_index=$scan_index" }
+    if (-not [string]::IsNullOrEmpty($dedup_index)) { $pipeline_args += "--dedup_index=$dedup_index" }
+
+    Set-Location $base_directory
+    & python pipeline.py @pipeline_args
+}
+
+# Copying the captions and summaries of every representative image to its duplicates if set
+if (-not [string]::IsNullOrEmpty($dedup_index)) {
+    $copy_args = @("copy", "--dedup_index=$dedup_index", "--ext", $wd14_output_extension, $blip2_output_extension, $flamingo_output_extension, "txt")
+    if (-not [string]::IsNullOrEmpty($caption_store)) { $copy_args += "--caption_store=$caption_store" }
+
+    Set-Location $base_directory
+    & python -m common.dedup @copy_args
+}
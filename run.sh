@@ -56,12 +56,34 @@ while [[ "$#" -gt 0 ]]; do
         echo "--summarize_with_llama: use a llama derived local model for combining/summarizing your caption files"        
         echo "--input_directory: absolute path to the directory containing the image files you wish to caption"
         echo "--output_directory: output directory for saving caption files. If not set, defaults to value passed to --input_directory"
+        echo "--dedup_index: absolute path to a duplicate index. Every image is hashed before the stages run, only one image of every group of duplicates goes through the models and summarizers, and its captions are copied to the others afterwards. Hashes are cached in the index, so later runs only hash new images."
+        echo "--dedup_threshold: max Hamming distance, out of 64 bits, between the perceptual hashes of two images that count as duplicates. 0 only groups images that look identical, -1 only exact copies. Default: 4"
+        echo "--trace: absolute path of a file every stage appends per-image timing spans and periodic throughput/latency summaries to, as JSON lines."
+        echo "--quiet: do not print every caption and summary, which slows down large runs. Progress, errors and trace summaries are still shown."
+        echo "--num_shards: split the images into this many fixed shards by path hash, for running on several machines. Use with --shard_index."
+        echo "--shard_index: the shard this machine processes, from 0 to --num_shards - 1."
+        echo "--lease_dir: absolute path to a shared directory through which several machines claim chunks of images as they go."
+        echo "--scan_index: absolute path to a shared directory index. Later scans only list the directories that changed since the last one, which saves most of the walk over large or network-mounted datasets."
+        echo "--caption_store: absolute path to a shared caption database. Every stage writes its captions and summaries there instead of one small file per image and stage, which is much faster on network filesystems."
+        echo "--manifest: absolute path to a shared manifest database. Every stage skips images it already processed with the same settings, so reruns only handle new or changed images and resume after a crash."
+        echo "--streaming: run all enabled stages at the same time and summarize every image as soon as its captions are written, instead of one full pass per stage. GPU stages running side by side need enough VRAM for all their models at once."
+        echo "--streaming_batch_size: number of images handed to a stage at a time when streaming. Default: 4"
+        echo "--streaming_max_in_flight: max images a stage may have queued but not yet finished when streaming. Default: 16"
 #wd14 options help
         echo "--wd14_stack_models: runs three wd14 models and takes the mean of their values Default: ['SmilingWolf/wd-v1-4-convnext-tagger-v2', 'SmilingWolf/wd-v1-4-vit-tagger-v2', 'SmilingWolf/wd-v1-4-swinv2-tagger-v2'] "
         echo "--wd14_model: if not stacking, which wd14 model to run Default: SmilingWolf/wd-v1-4-swinv2-tagger-v2"
         echo "--wd14_threshold: min confidence threshold for wd14 captions. If wd14_stack_models is passed, the threshold is applied before stacking. Default: .45  "
         echo "--wd14_filter: tags to filter out when running wd14 tagger"
         echo "--wd14_output_extension: file extension that wd14 captions will be saved with Default: wd14cap"
+        echo "--wd14_batch_size: Number of images to run through each wd14 model at once. Use 1 for byte-identical captions."
+        echo "--wd14_num_threads: Total CPU threads for wd14 inference, split evenly between the loaded models. Defaults to all cores."
+        echo "--wd14_fast_preprocess: decode JPEGs at reduced size and resize before padding. Output matches the default preprocessing within resampling error."
+        echo "--wd14_loader_workers: number of background workers decoding images ahead of the wd14 model. 0 loads images inline."
+        echo "--wd14_score_cache_dir: directory storing raw wd14 scores per image content hash. Cached images skip inference."
+        echo "--wd14_rerender: rebuild wd14 caption files from --wd14_score_cache_dir with the current threshold/filter/stacking settings without running any model."
+        echo "--wd14_ort_preset: onnxruntime session options: throughput for batch runs, latency for small batches with --serve, default for onnxruntime's own."
+        echo "--wd14_ort_cache_dir: directory to keep the optimized (and quantized) wd14 models in, so later runs start faster."
+        echo "--wd14_quantize: run dynamically quantized copies of the wd14 models, e.g. int8. Needs --wd14_ort_cache_dir. Check the tag agreement first with caption_wd14.py --check_quantize."
 #blip2 options help
         echo "--blip2_model: blip2 model to use for generating captions Default: blip2_opt/caption_coco_opt6.7b"
         echo "--blip2_use_nucleus_sampling: whether to use nucleus sampling when generating blip2 captions Default: False"
@@ -70,6 +92,13 @@ while [[ "$#" -gt 0 ]]; do
         echo "--blip2_min_tokens: min_tokens value to be passed to blip2 model Default: 20"
         echo "--blip2_top_p: top_p value to be passed to blip2 model Default: 1"
         echo "--blip2_output_extension: file extension that blip2 captions will be saved with Default: b2cap"
+        echo "--blip2_loader_workers: number of background workers decoding images ahead of the blip2 model. 0 loads images inline."
+        echo "--blip2_batch_size: number of images captioned per blip2 generate call."
+        echo "--blip2_device: torch device for blip2, e.g. cuda or cpu. Defaults to cuda when available, otherwise cpu."
+        echo "--blip2_num_threads: number of torch CPU threads for blip2 when running on cpu."
+        echo "--blip2_interop_threads: number of torch inter-op threads for blip2 when running on cpu."
+        echo "--blip2_bf16: bfloat16 autocast for blip2 on cpu: auto, on or off. auto uses it when the CPU supports bf16."
+        echo "--blip2_quantize: run the blip2 language model with dynamically quantized Linear layers, e.g. int8. CPU only."
 #open flamingo options help
         echo "--flamingo_example_img_dir: path to open flamingo example image/caption pairs"
         echo "--flamingo_model: open_flamingo model to be used for captioning. Default: openflamingo/OpenFlamingo-9B-vitl-mpt7b"
@@ -83,11 +112,25 @@ while [[ "$#" -gt 0 ]]; do
         echo "--flamingo_repetition_penalty: repitition penalty  value to be passed to open flamingo model Default: 1"
         echo "--flamingo_length_penalty: length penalty value to be passed to open flamingo model"
         echo "--flamingo_output_extension: file extension that open flamingo captions will be saved with Default: flamcap"
+        echo "--flamingo_loader_workers: number of background workers decoding images ahead of the Open Flamingo model. 0 loads images inline."
+        echo "--flamingo_no_prefix_cache: re-encode the few-shot examples for every image instead of computing their vision features and prompt state once per run."
+        echo "--flamingo_batch_size: number of query images captioned per Open Flamingo generate call."
+        echo "--flamingo_weights_cache_dir: directory to keep safetensors copies of the Open Flamingo checkpoints in, converted once to the run's dtype, so later runs memory-map them and start faster with less memory."
+        echo "--flamingo_device: torch device for open flamingo, e.g. cuda or cpu. Defaults to cuda when available, otherwise cpu."
+        echo "--flamingo_num_threads: number of torch CPU threads for open flamingo when running on cpu."
+        echo "--flamingo_interop_threads: number of torch inter-op threads for open flamingo when running on cpu."
+        echo "--flamingo_bf16: bfloat16 weights and autocast for open flamingo on cpu: auto, on or off. auto uses them when the CPU supports bf16."
+        echo "--flamingo_quantize: run the open flamingo language model with dynamically quantized Linear layers, e.g. int8. CPU only."
 #summarize options help
         echo "--summarize_gpt_model: OpenAI model to use for summarization Default: gpt-3.5-turbo"
         echo "--summarize_gpt_max_tokens: max tokens for GPT Default: 75"
         echo "--summarize_gpt_temperature: temperature to be set for GPT Default: 1.0"
         echo "--summarize_gpt_prompt_file_path: file path to a txt file containing the system prompt to be passed to gpt for summarizing your captions"
+        echo "--summarize_gpt_concurrency: max number of GPT requests in flight at once."
+        echo "--summarize_gpt_requests_per_minute: GPT request rate limit. If not set, follows the API rate limit headers."
+        echo "--summarize_gpt_tokens_per_minute: GPT token rate limit. If not set, follows the API rate limit headers."
+        echo "--summarize_gpt_max_retries: retries per GPT request on rate limits and server errors, with exponential backoff."
+        echo "--summarize_gpt_prompt_budget: max prompt tokens per image for GPT, system prompt included. The least confident tags are dropped first, then the captions are shortened. If not set, prompts are not trimmed."
         echo "--summarize_file_extensions: The file extensions/captions you want to be passed to your summarize model. Defaults to values of flamingo, blip2, and wd14 output extensions, e.g. ['wd14cap','flamcap','b2cap']"
         echo "--summarize_openai_api_key: value of a valid open ai api key. Not needed if the OPENAI_API_KEY env variable is set"
         echo "--summarize_llama_model_repo_id: Huggingface Repository ID or name of the llama model to use for summarization."
@@ -102,6 +145,10 @@ while [[ "$#" -gt 0 ]]; do
         echo "--summarize_llama_top_p : top_p value to run llama model with Default: 1.0"
         echo "--summarize_llama_frequency_penalty : frequency penalty value to run llama model with Default: 0"
         echo "--summarize_llama_top_p : presence penalty value to run llama model with Default: 0"
+        echo "--summarize_llama_no_prompt_cache: don't evaluate and keep the llama system prompt state up front."
+        echo "--summarize_llama_prompt_cache_dir: directory to persist the evaluated llama system prompt state in, so later runs skip evaluating it."
+        echo "--summarize_llama_num_workers: number of llama processes to run. --summarize_llama_n_threads is split between them and the mmapped model weights are shared."
+        echo "--summarize_llama_prompt_budget: max prompt tokens per image for llama, system prompt included. Prompts are always trimmed to fit the 1024 token context next to --summarize_llama_max_tokens; this sets a lower limit."
         exit 0
         ;;
         --use_blip2) use_blip2=true; user_args="${user_args} --use_blip2" ;;
@@ -111,11 +158,33 @@ while [[ "$#" -gt 0 ]]; do
         --summarize_with_llama) summarize_with_llama=true; user_args="${user_args} --summarize_with_llama" ;;
         --input_directory) input_directory="$2"; flamingo_img_dir="$2"; blip2_dir="$2"; user_args="${user_args} --input_directory=$2"; shift ;;
         --output_directory) output_directory="$2"; user_args="${user_args} --output_directory=$2"; shift ;;
+        --dedup_index) dedup_index="$2"; user_args="${user_args} --dedup_index=$2"; shift ;;
+        --dedup_threshold) dedup_threshold="$2"; user_args="${user_args} --dedup_threshold=$2"; shift ;;
+        --trace) trace="$2"; user_args="${user_args} --trace=$2"; shift ;;
+        --quiet) quiet=true; user_args="${user_args} --quiet" ;;
+        --lease_dir) lease_dir="$2"; user_args="${user_args} --lease_dir=$2"; shift ;;
+        --shard_index) shard_index="$2"; user_args="${user_args} --shard_index=$2"; shift ;;
+        --num_shards) num_shards="$2"; user_args="${user_args} --num_shards=$2"; shift ;;
+        --scan_index) scan_index="$2"; user_args="${user_args} --scan_index=$2"; shift ;;
+        --caption_store) caption_store="$2"; user_args="${user_args} --caption_store=$2"; shift ;;
+        --manifest) manifest="$2"; user_args="${user_args} --manifest=$2"; shift ;;
+        --streaming) streaming=true; user_args="${user_args} --streaming" ;;
+        --streaming_batch_size) streaming_batch_size="$2"; user_args="${user_args} --streaming_batch_size=$2"; shift ;;
+        --streaming_max_in_flight) streaming_max_in_flight="$2"; user_args="${user_args} --streaming_max_in_flight=$2"; shift ;;
         --wd14_stack_models) wd14_stack_models=true; user_args="${user_args} --wd14_stack_models" ;;
         --wd14_model) wd14_model="$2"; user_args="${user_args} --wd14_model=$2"; shift ;;
         --wd14_threshold) wd14_threshold="$2"; user_args="${user_args} --wd14_threshold=$2"; shift ;;
         --wd14_filter) wd14_filter="$2"; user_args="${user_args} --wd14_filter=$2"; shift ;;
         --wd14_output_extension) wd14_output_extension="$2"; summarize_file_extensions="${wd14_output_extension},${flamingo_output_extension},${blip2_output_extension}"; user_args="${user_args} --wd14_output_extension=$2"; shift ;;
+        --wd14_batch_size) wd14_batch_size="$2"; user_args="${user_args} --wd14_batch_size=$2"; shift ;;
+        --wd14_num_threads) wd14_num_threads="$2"; user_args="${user_args} --wd14_num_threads=$2"; shift ;;
+        --wd14_fast_preprocess) wd14_fast_preprocess=true; user_args="${user_args} --wd14_fast_preprocess" ;;
+        --wd14_loader_workers) wd14_loader_workers="$2"; user_args="${user_args} --wd14_loader_workers=$2"; shift ;;
+        --wd14_score_cache_dir) wd14_score_cache_dir="$2"; user_args="${user_args} --wd14_score_cache_dir=$2"; shift ;;
+        --wd14_rerender) wd14_rerender=true; user_args="${user_args} --wd14_rerender" ;;
+        --wd14_ort_preset) wd14_ort_preset="$2"; user_args="${user_args} --wd14_ort_preset=$2"; shift ;;
+        --wd14_ort_cache_dir) wd14_ort_cache_dir="$2"; user_args="${user_args} --wd14_ort_cache_dir=$2"; shift ;;
+        --wd14_quantize) wd14_quantize="$2"; user_args="${user_args} --wd14_quantize=$2"; shift ;;
         --blip2_model) blip2_model="$2"; user_args="${user_args} --blip2_model=$2"; shift ;;\
         --blip2_beams) blip2_beams="$2"; user_args="${user_args} --blip2_beams=$2"; shift ;;
         --blip2_use_nucleus_sampling) blip2_use_nucleus_sampling="$2"; user_args="${user_args} --blip2_use_nucleus_sampling=$2"; shift ;;
@@ -123,6 +192,13 @@ while [[ "$#" -gt 0 ]]; do
         --blip2_min_length) blip2_min_length="$2"; user_args="${user_args} --blip2_min_length=$2"; shift ;;
         --blip2_top_p) blip2_top_p="$2"; user_args="${user_args} --blip2_top_p=$2"; shift ;;
         --blip2_output_extension) blip2_output_extension="$2"; summarize_file_extensions="${wd14_output_extension},${flamingo_output_extension},${blip2_output_extension}"; user_args="${user_args} --blip2_output_extension=$2"; shift ;;
+        --blip2_loader_workers) blip2_loader_workers="$2"; user_args="${user_args} --blip2_loader_workers=$2"; shift ;;
+        --blip2_batch_size) blip2_batch_size="$2"; user_args="${user_args} --blip2_batch_size=$2"; shift ;;
+        --blip2_device) blip2_device="$2"; user_args="${user_args} --blip2_device=$2"; shift ;;
+        --blip2_num_threads) blip2_num_threads="$2"; user_args="${user_args} --blip2_num_threads=$2"; shift ;;
+        --blip2_interop_threads) blip2_interop_threads="$2"; user_args="${user_args} --blip2_interop_threads=$2"; shift ;;
+        --blip2_bf16) blip2_bf16="$2"; user_args="${user_args} --blip2_bf16=$2"; shift ;;
+        --blip2_quantize) blip2_quantize="$2"; user_args="${user_args} --blip2_quantize=$2"; shift ;;
         --flamingo_example_img_dir) flamingo_example_img_dir="$2"; user_args="${user_args} --flamingo_example_img_dir=$2"; shift ;;
         --flamingo_model) flamingo_model="$2"; user_args="${user_args} --flamingo_model=$2"; shift ;;
         --flamingo_min_new_tokens) flamingo_min_new_tokens="$2"; user_args="${user_args} --flamingo_min_new_tokens=$2"; shift ;;
@@ -135,10 +211,24 @@ while [[ "$#" -gt 0 ]]; do
         --flamingo_repetition_penalty) flamingo_repetition_penalty="$2"; user_args="${user_args} --flamingo_repetition_penalty=$2"; shift ;;
         --flamingo_length_penalty) flamingo_length_penalty="$2"; user_args="${user_args} --flamingo_length_penalty=$2"; shift ;;
         --flamingo_output_extension) flamingo_output_extension="$2"; summarize_file_extensions="${wd14_output_extension},${flamingo_output_extension},${blip2_output_extension}"; user_args="${user_args} --flamingo_output_extension=$2"; shift ;;
+        --flamingo_loader_workers) flamingo_loader_workers="$2"; user_args="${user_args} --flamingo_loader_workers=$2"; shift ;;
+        --flamingo_no_prefix_cache) flamingo_no_prefix_cache=true; user_args="${user_args} --flamingo_no_prefix_cache" ;;
+        --flamingo_batch_size) flamingo_batch_size="$2"; user_args="${user_args} --flamingo_batch_size=$2"; shift ;;
+        --flamingo_weights_cache_dir) flamingo_weights_cache_dir="$2"; user_args="${user_args} --flamingo_weights_cache_dir=$2"; shift ;;
+        --flamingo_device) flamingo_device="$2"; user_args="${user_args} --flamingo_device=$2"; shift ;;
+        --flamingo_num_threads) flamingo_num_threads="$2"; user_args="${user_args} --flamingo_num_threads=$2"; shift ;;
+        --flamingo_interop_threads) flamingo_interop_threads="$2"; user_args="${user_args} --flamingo_interop_threads=$2"; shift ;;
+        --flamingo_bf16) flamingo_bf16="$2"; user_args="${user_args} --flamingo_bf16=$2"; shift ;;
+        --flamingo_quantize) flamingo_quantize="$2"; user_args="${user_args} --flamingo_quantize=$2"; shift ;;
         --summarize_gpt_model) summarize_gpt_model="$2"; user_args="${user_args} --summarize_gpt_model=$2"; shift ;;
         --summarize_gpt_max_tokens) summarize_gpt_max_tokens="$2"; user_args="${user_args} --summarize_gpt_max_tokens=$2"; shift ;;
         --summarize_gpt_temperature) summarize_gpt_temperature="$2"; user_args="${user_args} --summarize_gpt_temperature=$2"; shift ;;
         --summarize_gpt_prompt_file_path) summarize_gpt_prompt_file_path="$2"; user_args="${user_args} --summarize_gpt_prompt_file_path=$2"; shift ;;
+        --summarize_gpt_concurrency) summarize_gpt_concurrency="$2"; user_args="${user_args} --summarize_gpt_concurrency=$2"; shift ;;
+        --summarize_gpt_requests_per_minute) summarize_gpt_requests_per_minute="$2"; user_args="${user_args} --summarize_gpt_requests_per_minute=$2"; shift ;;
+        --summarize_gpt_tokens_per_minute) summarize_gpt_tokens_per_minute="$2"; user_args="${user_args} --summarize_gpt_tokens_per_minute=$2"; shift ;;
+        --summarize_gpt_max_retries) summarize_gpt_max_retries="$2"; user_args="${user_args} --summarize_gpt_max_retries=$2"; shift ;;
+        --summarize_gpt_prompt_budget) summarize_gpt_prompt_budget="$2"; user_args="${user_args} --summarize_gpt_prompt_budget=$2"; shift ;;
         --summarize_file_extensions) summarize_file_extensions="$2"; user_args="${user_args} --summarize_file_extensions=$2"; shift ;;
         --summarize_openai_api_key) summarize_openai_api_key="$2"; user_args="${user_args} --summarize_openai_api_key=$2"; shift ;;
         --summarize_llama_model_repo_id) summarize_llama_model_repo_id="$2"; user_args="${user_args} --summarize_llama_model_repo_id=$2"; shift ;;
@@ -153,6 +243,10 @@ while [[ "$#" -gt 0 ]]; do
         --summarize_llama_top_p) summarize_llama_top_p="$2"; user_args="${user_args} --summarize_llama_top_p=$2"; shift ;;
         --summarize_llama_frequency_penalty) summarize_llama_frequency_penalty="$2"; user_args="${user_args} --summarize_llama_frequency_penalty=$2"; shift ;;
         --summarize_llama_presence_penalty) summarize_llama_presence_penalty="$2"; user_args="${user_args} --summarize_llama_presence_penalty=$2"; shift ;;                 
+        --summarize_llama_no_prompt_cache) summarize_llama_no_prompt_cache=true; user_args="${user_args} --summarize_llama_no_prompt_cache" ;;
+        --summarize_llama_prompt_cache_dir) summarize_llama_prompt_cache_dir="$2"; user_args="${user_args} --summarize_llama_prompt_cache_dir=$2"; shift ;;
+        --summarize_llama_num_workers) summarize_llama_num_workers="$2"; user_args="${user_args} --summarize_llama_num_workers=$2"; shift ;;
+        --summarize_llama_prompt_budget) summarize_llama_prompt_budget="$2"; user_args="${user_args} --summarize_llama_prompt_budget=$2"; shift ;;
         *) echo "Unknown parameter passed: $1"; exit 1 ;;
     esac
     shift
@@ -191,6 +285,22 @@ fi
 echo "User Arguments:"
 echo "$user_args"
 
+# Hashing the images and grouping the duplicates if set, with the first captioning venv that is installed
+if [[ -n "$dedup_index" ]]; then
+    for venv in wd14/venv_wd14 blip2/venv_blip2 open_flamingo/venv_open_flamingo; do
+        if [[ -x "$base_directory/$venv/bin/python" ]]; then
+            dedup_python="$base_directory/$venv/bin/python"
+            break
+        fi
+    done
+    dedup_args=(index "$input_directory" --dedup_index="$dedup_index")
+    [ -n "$dedup_threshold" ] && dedup_args+=(--threshold="$dedup_threshold")
+    [ -n "$scan_index" ] && dedup_args+=(--scan_index="$scan_index")
+
+    cd "$base_directory"
+    "${dedup_python:-python3}" -m common.dedup "${dedup_args[@]}" || exit 1
+fi
+
 
 generate_blip2_options() {
     local options=""
@@ -203,12 +313,28 @@ generate_blip2_options() {
     [ -n "$blip2_min_length" ] && options+=" --min_length=$blip2_min_length"
     [ -n "$blip2_top_p" ] && options+=" --top_p=$blip2_top_p"
     [ -n "$blip2_output_extension" ] && options+=" --output_file_extension=$blip2_output_extension"
+    [ -n "$blip2_loader_workers" ] && options+=" --loader_workers=$blip2_loader_workers"
+    [ -n "$manifest" ] && options+=" --manifest=$manifest"
+    [ -n "$blip2_batch_size" ] && options+=" --batch_size=$blip2_batch_size"
+    [ -n "$blip2_device" ] && options+=" --device=$blip2_device"
+    [ -n "$blip2_num_threads" ] && options+=" --num_threads=$blip2_num_threads"
+    [ -n "$caption_store" ] && options+=" --caption_store=$caption_store"
+    [ -n "$scan_index" ] && options+=" --scan_index=$scan_index"
+    [ -n "$num_shards" ] && options+=" --num_shards=$num_shards"
+    [ -n "$shard_index" ] && options+=" --shard_index=$shard_index"
+    [ -n "$lease_dir" ] && options+=" --lease_dir=$lease_dir"
+    [ -n "$quiet" ] && options+=" --quiet"
+    [ -n "$trace" ] && options+=" --trace=$trace"
+    [ -n "$blip2_interop_threads" ] && options+=" --interop_threads=$blip2_interop_threads"
+    [ -n "$blip2_bf16" ] && options+=" --bf16=$blip2_bf16"
+    [ -n "$blip2_quantize" ] && options+=" --quantize=$blip2_quantize"
+    [ -n "$dedup_index" ] && options+=" --dedup_index=$dedup_index"
     
     echo "$options"
 }
 
 # Running blip2 if set
-if [[ "$use_blip2" == "true" ]]; then
+if [[ "$use_blip2" == "true" && -z "$streaming" ]]; then
     source "$base_directory/blip2/venv_blip2/bin/activate"
     cd "$base_directory/blip2"
     
@@ -235,12 +361,30 @@ generate_open_flamingo_options() {
     [ -n "$flamingo_repetition_penalty" ] && options+=" --repetition_penalty=$flamingo_repetition_penalty"
     [ -n "$flamingo_length_penalty" ] && options+=" --length_penalty=$flamingo_length_penalty"
     [ -n "$flamingo_output_extension" ] && options+=" --output_extension=$flamingo_output_extension"
+    [ -n "$flamingo_loader_workers" ] && options+=" --loader_workers=$flamingo_loader_workers"
+    [ -n "$manifest" ] && options+=" --manifest=$manifest"
+    [ -n "$flamingo_no_prefix_cache" ] && options+=" --no_prefix_cache"
+    [ -n "$flamingo_batch_size" ] && options+=" --batch_size=$flamingo_batch_size"
+    [ -n "$caption_store" ] && options+=" --caption_store=$caption_store"
+    [ -n "$scan_index" ] && options+=" --scan_index=$scan_index"
+    [ -n "$num_shards" ] && options+=" --num_shards=$num_shards"
+    [ -n "$shard_index" ] && options+=" --shard_index=$shard_index"
+    [ -n "$lease_dir" ] && options+=" --lease_dir=$lease_dir"
+    [ -n "$quiet" ] && options+=" --quiet"
+    [ -n "$trace" ] && options+=" --trace=$trace"
+    [ -n "$flamingo_weights_cache_dir" ] && options+=" --weights_cache_dir=$flamingo_weights_cache_dir"
+    [ -n "$flamingo_device" ] && options+=" --device=$flamingo_device"
+    [ -n "$flamingo_num_threads" ] && options+=" --num_threads=$flamingo_num_threads"
+    [ -n "$flamingo_interop_threads" ] && options+=" --interop_threads=$flamingo_interop_threads"
+    [ -n "$flamingo_bf16" ] && options+=" --bf16=$flamingo_bf16"
+    [ -n "$flamingo_quantize" ] && options+=" --quantize=$flamingo_quantize"
+    [ -n "$dedup_index" ] && options+=" --dedup_index=$dedup_index"
     
     echo "$options"
 }
 
 # Running open_flamingo if set
-if [[ "$use_open_flamingo" == "true" ]]; then
+if [[ "$use_open_flamingo" == "true" && -z "$streaming" ]]; then
     source "$base_directory/open_flamingo/venv_open_flamingo/bin/activate"
     cd "$base_directory/open_flamingo"
     
@@ -260,12 +404,30 @@ generate_wd14_options() {
     [ -n "$wd14_filter" ] && options+=" --filter=$wd14_filter"
     [ -n "$wd14_output_extension" ] && options+=" --output_extension=$wd14_output_extension"
     [ -n "$wd14_stack_models" ] && options+=" --stack_models"
+    [ -n "$wd14_batch_size" ] && options+=" --batch_size=$wd14_batch_size"
+    [ -n "$wd14_num_threads" ] && options+=" --num_threads=$wd14_num_threads"
+    [ -n "$wd14_fast_preprocess" ] && options+=" --fast_preprocess"
+    [ -n "$wd14_loader_workers" ] && options+=" --loader_workers=$wd14_loader_workers"
+    [ -n "$wd14_score_cache_dir" ] && options+=" --score_cache_dir=$wd14_score_cache_dir"
+    [ -n "$wd14_rerender" ] && options+=" --rerender"
+    [ -n "$manifest" ] && options+=" --manifest=$manifest"
+    [ -n "$caption_store" ] && options+=" --caption_store=$caption_store"
+    [ -n "$scan_index" ] && options+=" --scan_index=$scan_index"
+    [ -n "$num_shards" ] && options+=" --num_shards=$num_shards"
+    [ -n "$shard_index" ] && options+=" --shard_index=$shard_index"
+    [ -n "$lease_dir" ] && options+=" --lease_dir=$lease_dir"
+    [ -n "$quiet" ] && options+=" --quiet"
+    [ -n "$trace" ] && options+=" --trace=$trace"
+    [ -n "$wd14_ort_preset" ] && options+=" --ort_preset=$wd14_ort_preset"
+    [ -n "$wd14_ort_cache_dir" ] && options+=" --ort_cache_dir=$wd14_ort_cache_dir"
+    [ -n "$wd14_quantize" ] && options+=" --quantize=$wd14_quantize"
+    [ -n "$dedup_index" ] && options+=" --dedup_index=$dedup_index"
 
     echo "$options"
 }
 
 # Running wd14 if set
-if [[ "$use_wd14" == "true" ]]; then
+if [[ "$use_wd14" == "true" && -z "$streaming" ]]; then
     source "$base_directory/wd14/venv_wd14/bin/activate"
     cd "$base_directory/wd14"
     
@@ -288,12 +450,26 @@ generate_summarize_with_gpt_options() {
     [ -n "$summarize_openai_api_key" ] && options+=" --api_key=$summarize_openai_api_key"
     [ -n "$summarize_file_extensions" ] && options+=" --caption_exts=$summarize_file_extensions"
     [ -n "$output_directory" ] && options+=" --output_dir=$output_directory"
+    [ -n "$manifest" ] && options+=" --manifest=$manifest"
+    [ -n "$summarize_gpt_concurrency" ] && options+=" --concurrency=$summarize_gpt_concurrency"
+    [ -n "$summarize_gpt_requests_per_minute" ] && options+=" --requests_per_minute=$summarize_gpt_requests_per_minute"
+    [ -n "$summarize_gpt_tokens_per_minute" ] && options+=" --tokens_per_minute=$summarize_gpt_tokens_per_minute"
+    [ -n "$summarize_gpt_max_retries" ] && options+=" --max_retries=$summarize_gpt_max_retries"
+    [ -n "$caption_store" ] && options+=" --caption_store=$caption_store"
+    [ -n "$scan_index" ] && options+=" --scan_index=$scan_index"
+    [ -n "$num_shards" ] && options+=" --num_shards=$num_shards"
+    [ -n "$shard_index" ] && options+=" --shard_index=$shard_index"
+    [ -n "$lease_dir" ] && options+=" --lease_dir=$lease_dir"
+    [ -n "$quiet" ] && options+=" --quiet"
+    [ -n "$trace" ] && options+=" --trace=$trace"
+    [ -n "$dedup_index" ] && options+=" --dedup_index=$dedup_index"
+    [ -n "$summarize_gpt_prompt_budget" ] && options+=" --prompt_budget=$summarize_gpt_prompt_budget"
     
     echo "$options"
 }
 
 # Running summarize_with_gpt if set
-if [[ "$summarize_with_gpt" == "true" ]]; then
+if [[ "$summarize_with_gpt" == "true" && -z "$streaming" ]]; then
     source "$base_directory/summarize/venv_summarize/bin/activate"
     cd "$base_directory/summarize"
     
@@ -321,11 +497,24 @@ generate_summarize_with_llama_options() {
     [ -n "$summarize_llama_top_p" ] && options+=" --top_p=$summarize_llama_top_p"
     [ -n "$summarize_llama_frequency_penalty" ] && options+=" --frequency_penalty=$summarize_llama_frequency_penalty"
     [ -n "$summarize_llama_presence_penalty" ] && options+=" --presence_penalty=$summarize_llama_presence_penalty"
+    [ -n "$manifest" ] && options+=" --manifest=$manifest"
+    [ -n "$summarize_llama_no_prompt_cache" ] && options+=" --no_prompt_cache"
+    [ -n "$summarize_llama_prompt_cache_dir" ] && options+=" --prompt_cache_dir=$summarize_llama_prompt_cache_dir"
+    [ -n "$summarize_llama_num_workers" ] && options+=" --num_workers=$summarize_llama_num_workers"
+    [ -n "$caption_store" ] && options+=" --caption_store=$caption_store"
+    [ -n "$scan_index" ] && options+=" --scan_index=$scan_index"
+    [ -n "$num_shards" ] && options+=" --num_shards=$num_shards"
+    [ -n "$shard_index" ] && options+=" --shard_index=$shard_index"
+    [ -n "$lease_dir" ] && options+=" --lease_dir=$lease_dir"
+    [ -n "$quiet" ] && options+=" --quiet"
+    [ -n "$trace" ] && options+=" --trace=$trace"
+    [ -n "$dedup_index" ] && options+=" --dedup_index=$dedup_index"
+    [ -n "$summarize_llama_prompt_budget" ] && options+=" --prompt_budget=$summarize_llama_prompt_budget"
     echo "$options"
 }
 
 # Running summarize_with_llama if set
-if [[ "$summarize_with_llama" == "true" ]]; then
+if [[ "$summarize_with_llama" == "true" && -z "$streaming" ]]; then
     source "$base_directory/summarize/venv_summarize/bin/activate"
     cd "$base_directory/summarize"
     options=$(generate_summarize_with_llama_options)
@@ -335,3 +524,28 @@ if [[ "$summarize_with_llama" == "true" ]]; then
     cd "$base_directory"
 fi
 
+# Running every enabled stage at once through the streaming pipeline if set
+if [[ -n "$streaming" ]]; then
+    pipeline_args=(--input_directory="$input_directory")
+    [[ "$use_blip2" == "true" ]] && pipeline_args+=(--blip2="$(generate_blip2_options)")
+    [[ "$use_open_flamingo" == "true" ]] && pipeline_args+=(--open_flamingo="$(generate_open_flamingo_options)")
+    [[ "$use_wd14" == "true" ]] && pipeline_args+=(--wd14="$(generate_wd14_options)")
+    [[ "$summarize_with_gpt" == "true" ]] && pipeline_args+=(--summarize_gpt="$(generate_summarize_with_gpt_options)")
+    [[ "$summarize_with_llama" == "true" ]] && pipeline_args+=(--summarize_llama="$(generate_summarize_with_llama_options)")
+    [ -n "$streaming_batch_size" ] && pipeline_args+=(--batch_size="$streaming_batch_size")
+    [ -n "$streaming_max_in_flight" ] && pipeline_args+=(--max_in_flight="$streaming_max_in_flight")
+    [ -n "$scan_index" ] && pipeline_args+=(--scan_index="$scan_index")
+    [ -n "$dedup_index" ] && pipeline_args+=(--dedup_index="$dedup_index")
+
+    cd "$base_directory"
+    python3 pipeline.py "${pipeline_args[@]}"
+fi
+
+# Copying the captions and summaries of every representative image to its duplicates if set
+if [[ -n "$dedup_index" ]]; then
+    copy_args=(copy --dedup_index="$dedup_index" --ext "$wd14_output_extension" "$blip2_output_extension" "$flamingo_output_extension" txt)
+    [ -n "$caption_store" ] && copy_args+=(--caption_store="$caption_store")
+
+    cd "$base_directory"
+    python3 -m common.dedup "${copy_args[@]}"
+fi
@@ -0,0 +1,183 @@
+# Compact caption prompts, shared by summarize_with_gpt.py and summarize_with_llama.py.
+#
+# Every caption goes into the prompt on a line of its own, "Caption 1: ..." or "Tags: ...". WD14 writes
+# its tags as `[long_hair: 0.93], `, where the brackets and scores take more tokens than the tag names,
+# so the tags are sent as a plain list, most confident first. Tags one of the captions already says
+# ("long hair" next to "a woman with long hair") are dropped, and so are captions that repeat another.
+#
+# Each prompt is then fitted into a token budget, counted with the model's own tokenizer: for llama the
+# context left after the summary's max_tokens, and --prompt_budget when it is lower. The least confident
+# tags go first, then all captions are cut to the same number of words. The summarizers print the prompt
+# tokens of every image next to what the captions as written would have taken, and the totals at the end.
+import re
+from collections import namedtuple
+
+TAGS_LABEL = "Tags: "
+TAG_PATTERN = re.compile(r'\[([^\[\]]+?): ([0-9.]+)\]')
+WD14_FORMAT = re.compile(r'(?:\[[^\[\]]+?: [0-9.]+\],? ?)+')
+
+Section = namedtuple('Section', ['label', 'items', 'separator'])
+
+
+def add_prompt_args(parser):
+    parser.add_argument("--prompt_budget", type=int, default=None,
+                        help="Max prompt tokens per image, system prompt included. The least confident tags are "
+                             "dropped first, then the captions are shortened")
+
+
+def parse_tags(text, plain=False):
+    """
+    (tag, score) for every tag of a WD14 caption, most confident first, or None when text isn't one.
+    With plain, a comma separated list without scores is taken as tags too, in its own order.
+    """
+    if WD14_FORMAT.fullmatch(text):
+        tags = [(name.strip(), float(score)) for name, score in TAG_PATTERN.findall(text)]
+    elif plain:
+        tags = [(name.strip(), 1.0) for name in text.split(',') if name.strip()]
+    else:
+        return None
+    # kaomoji like ^_^ or o_o keep their underscores
+    tags = [(name.replace('_', ' ') if re.search('[a-zA-Z]{2}', name) else name, score) for name, score in tags]
+    return sorted(tags, key=lambda tag: -tag[1])
+
+
+def _words(text):
+    # lower case and without a plural s, so "red eyes" matches "a red eye"
+    return [word[:-1] if len(word) > 3 and word.endswith('s') else word for word in re.findall('[a-z0-9]+', text.lower())]
+
+
+def _raw_body(captions):
+    """The caption part of the prompt with the captions as written, to measure the savings against"""
+    lines = []
+    caption_number = 1
+    for extension, text in captions:
+        if extension == 'wd14cap':
+            lines.append(TAGS_LABEL + text.strip())
+        else:
+            lines.append(f"Caption {caption_number}: {text.strip()}")
+            caption_number += 1
+    return "\n".join(lines)
+
+
+def compact_sections(captions):
+    """
+    The sections of the prompt for (extension, text) captions: every distinct caption as a list of words,
+    and all tags in one list, without the ones the captions already cover. Returns them with the number of
+    tags dropped.
+    """
+    sections = []
+    tags = []
+    tags_index = None
+    seen = set()
+    for extension, text in captions:
+        text = ' '.join(text.split())
+        parsed = parse_tags(text, plain=extension == 'wd14cap')
+        if parsed is not None:
+            # the tags keep the place of the first tag caption
+            if tags_index is None:
+                tags_index = len(sections)
+            tags.extend(parsed)
+        elif text and tuple(_words(text)) not in seen:
+            seen.add(tuple(_words(text)))
+            sections.append(Section(f"Caption {len(sections) + 1}: ", text.split(' '), ' '))
+
+    said = [f" {' '.join(words)} " for words in seen]
+    kept = []
+    kept_keys = set()
+    covered = 0
+    for name, _ in sorted(tags, key=lambda tag: -tag[1]):
+        words = ' '.join(_words(name))
+        if (words or name) in kept_keys:
+            continue
+        if words and any(f" {words} " in caption for caption in said):
+            covered += 1
+            continue
+        kept_keys.add(words or name)
+        kept.append(name)
+    if tags_index is not None:
+        sections.insert(tags_index, Section(TAGS_LABEL, kept, ', '))
+    return sections, covered
+
+
+def render(sections, max_tags=None, max_words=None):
+    """The caption part of a prompt, with at most max_tags tags and max_words words per caption"""
+    lines = []
+    for section in sections:
+        items = section.items[:max_tags] if section.label == TAGS_LABEL else section.items[:max_words]
+        if items:
+            lines.append(section.label + section.separator.join(items))
+    return "\n".join(lines)
+
+
+def _largest(fits, high):
+    """The largest n in 0..high for which fits(n), or None"""
+    low, best = 0, None
+    while low <= high:
+        middle = (low + high) // 2
+        if fits(middle):
+            best, low = middle, middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+class PromptBuilder:
+    """
+    Builds the caption part of every prompt. count_tokens(body) is the number of tokens of the whole prompt
+    around body, and budget the most it may have, or None for no limit.
+    """
+
+    def __init__(self, count_tokens, budget=None):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.pending = {}
+        self.totals = {'images': 0, 'original': 0, 'tokens': 0, 'covered': 0, 'trimmed': 0}
+
+    def check(self):
+        """Raise ValueError when the prompt without any captions already exceeds the budget"""
+        fixed = self.count_tokens("")
+        if self.budget is not None and fixed > self.budget:
+            raise ValueError(f"The prompt takes {fixed} tokens without any captions, more than the budget of {self.budget}")
+
+    def build(self, image_file, captions):
+        """The caption part of the prompt for image_file, from its (extension, text) captions"""
+        sections, covered = compact_sections(captions)
+        body = render(sections)
+        tokens = self.count_tokens(body)
+        trimmed = self.budget is not None and tokens > self.budget
+        if trimmed:
+            def fits(max_tags, max_words=None):
+                return self.count_tokens(render(sections, max_tags, max_words)) <= self.budget
+
+            tag_count = sum(len(section.items) for section in sections if section.label == TAGS_LABEL)
+            max_tags = _largest(fits, tag_count)
+            if max_tags is not None:
+                body = render(sections, max_tags)
+            else:
+                word_count = max((len(section.items) for section in sections), default=0)
+                body = render(sections, 0, _largest(lambda n: fits(0, n), word_count) or 0)
+            tokens = self.count_tokens(body)
+        self.pending[image_file] = (self.count_tokens(_raw_body(captions)), tokens, covered, trimmed)
+        return body
+
+    def done(self, image_file, failed=False, quiet=False):
+        """Add the prompt of image_file to the totals and print its token counts unless quiet or failed"""
+        original, tokens, covered, trimmed = self.pending.pop(image_file)
+        if failed:
+            return
+        for key, value in (('images', 1), ('original', original), ('tokens', tokens), ('covered', covered),
+                           ('trimmed', trimmed)):
+            self.totals[key] += value
+        if not quiet:
+            print(f"Prompt tokens: {tokens} instead of {original}" +
+                  (f", trimmed to the budget of {self.budget}" if trimmed else ""))
+
+    def report(self):
+        totals = self.totals
+        if not totals['images']:
+            return
+        saved = totals['original'] - totals['tokens']
+        print(f"Prompt tokens: {totals['tokens']} instead of {totals['original']} for {totals['images']} image(s), "
+              f"{saved} ({saved / max(totals['original'], 1):.1%}) saved, "
+              f"{saved / totals['images']:.1f} per image. {totals['covered']} tag(s) dropped as already in a caption"
+              + (f", {totals['trimmed']} prompt(s) trimmed to the budget of {self.budget}" if totals['trimmed'] else ""))
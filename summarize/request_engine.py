@@ -0,0 +1,229 @@
+import asyncio
+import random
+import re
+import time
+
+import aiohttp
+
+from common.trace import span
+
+DEFAULT_API_BASE = 'https://api.openai.com/v1'
+
+# statuses worth retrying; anything else is returned to the caller as a failure straight away
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RequestFailed(Exception):
+    pass
+
+
+def parse_duration(value):
+    """Parse rate limit reset values such as '20ms', '1.5s' or '6m0s' into seconds"""
+    if value is None:
+        return None
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+def header_int(headers, name):
+    try:
+        return int(float(headers[name]))
+    except (KeyError, ValueError):
+        return None
+
+
+def estimate_tokens(payload):
+    # roughly 4 characters per token plus the per-message overhead of the chat format,
+    # corrected against the reported usage once the response arrives
+    prompt = sum(len(message['content']) // 4 + 4 for message in payload['messages'])
+    return prompt + (payload.get('max_tokens') or 0)
+
+
+class TokenBucket:
+    """
+    Per-minute budget that refills continuously. A capacity of None means no limit is known yet;
+    sync() adopts the server's limit from its rate limit headers, never raising a configured limit.
+    """
+
+    def __init__(self, per_minute=None):
+        self.configured = per_minute
+        self.capacity = per_minute
+        self.level = per_minute or 0
+        self.updated = time.monotonic()
+        self.lock = None
+
+    def bind(self):
+        """Create the lock in the running event loop; a bucket that outlives its loop needs a new one"""
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    async def acquire(self, amount):
+        if self.lock is None:
+            self.bind()
+        async with self.lock:
+            while self.capacity:
+                self._refill()
+                # a single request larger than the whole bucket only has to wait for a full bucket
+                needed = min(amount, self.capacity)
+                if self.level >= needed:
+                    self.level -= needed
+                    return
+                await asyncio.sleep((needed - self.level) * 60 / self.capacity)
+
+    def refund(self, amount):
+        """Return an overestimate to the bucket, or charge an underestimate when amount is negative"""
+        self._refill()
+        if self.capacity:
+            self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit, remaining):
+        self._refill()
+        if limit:
+            limit = min(limit, self.configured or limit)
+            if not self.capacity:
+                self.level = limit
+            self.capacity = limit
+        if remaining is not None and self.capacity:
+            self.level = min(self.level, remaining)
+
+    def pause(self, seconds):
+        """Hold back every waiter for roughly `seconds`"""
+        self._refill()
+        if self.capacity:
+            self.level = min(self.level, -seconds * self.capacity / 60)
+
+
+class ChatCompletionEngine:
+    """
+    Concurrent chat completion client sharing one keep-alive connection pool.
+
+    Requests are admitted by two token buckets, requests and tokens per minute, which follow the
+    x-ratelimit-* headers of every response. Throttled and failed requests are retried with capped
+    exponential backoff and full jitter, honouring Retry-After when the server sends it.
+    """
+
+    def __init__(self, api_key, api_base=DEFAULT_API_BASE, concurrency=8, requests_per_minute=None,
+                 tokens_per_minute=None, max_retries=6, timeout=120, max_backoff=60):
+        self.api_key = api_key
+        self.url = f"{api_base.rstrip('/')}/chat/completions"
+        self.concurrency = concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.session = None
+        self.semaphore = None
+        self.retries = 0
+
+    async def __aenter__(self):
+        # asyncio primitives belong to the loop they were first waited on in, and sharded runs enter the
+        # engine once per chunk, each time in a new loop; the buckets' levels carry over, their locks don't
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.requests.bind()
+        self.tokens.bind()
+        self.session = aiohttp.ClientSession(
+            headers={'Authorization': f'Bearer {self.api_key}'},
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def _sync(self, headers):
+        self.requests.sync(header_int(headers, 'x-ratelimit-limit-requests'),
+                           header_int(headers, 'x-ratelimit-remaining-requests'))
+        self.tokens.sync(header_int(headers, 'x-ratelimit-limit-tokens'),
+                         header_int(headers, 'x-ratelimit-remaining-tokens'))
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, 2 ** attempt))
+
+    async def complete(self, payload):
+        estimate = estimate_tokens(payload)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimate)
+            status, body, headers = None, None, {}
+            async with self.semaphore:
+                try:
+                    # one HTTP round trip; rate limit waits and retry backoff are not part of it
+                    with span('api'):
+                        async with self.session.post(self.url, json=payload) as response:
+                            status, headers = response.status, response.headers
+                            body = await response.json(content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    error = f"{type(e).__name__}: {e}"
+            self._sync(headers)
+
+            if status == 200:
+                usage = body.get('usage')
+                if usage:
+                    self.tokens.refund(estimate - usage['total_tokens'])
+                return body
+
+            if status is not None:
+                error = f"HTTP {status}: {body}"
+                # an exhausted quota does not recover by waiting
+                details = body.get('error') if isinstance(body, dict) else None
+                code = details.get('code') if isinstance(details, dict) else None
+                if status not in RETRY_STATUSES or code == 'insufficient_quota':
+                    raise RequestFailed(error)
+            if attempt == self.max_retries:
+                break
+
+            delay = parse_duration(headers.get('retry-after'))
+            if delay is None and status == 429:
+                # wait for whichever budget ran out to reset
+                resets = [parse_duration(headers.get(f'x-ratelimit-reset-{kind}')) for kind in ('requests', 'tokens')
+                          if header_int(headers, f'x-ratelimit-remaining-{kind}') == 0]
+                delay = max(filter(None, resets), default=None)
+            if delay is None:
+                delay = self._backoff(attempt)
+            if status == 429:
+                # the whole key is throttled, so hold back every pending request, not just this one
+                self.requests.pause(delay)
+                self.tokens.pause(delay)
+            self.retries += 1
+            print(f"Request failed ({error}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        raise RequestFailed(f"gave up after {self.max_retries} retries, last error {error}")
+
+    async def run(self, jobs, window=4):
+        """
+        Complete (key, payload) jobs concurrently, yielding (key, response, error) in completion order. Jobs are
+        taken from the iterable as requests finish, at most window * concurrency at a time, so payloads are
+        built while earlier requests are in flight instead of all up front
+        """
+        async def one(key, payload):
+            try:
+                return key, await self.complete(payload), None
+            except RequestFailed as e:
+                return key, None, e
+
+        jobs = iter(jobs)
+        pending = set()
+        while True:
+            for key, payload in jobs:
+                pending.add(asyncio.ensure_future(one(key, payload)))
+                if len(pending) >= window * self.concurrency:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
@@ -1,91 +1,214 @@
-import time
+import asyncio
 import os
-import glob
-import requests
 import argparse
+import sys
+from functools import partial
+from itertools import islice
 
-def ask_openai(comments, model, max_tokens, temperature, api_key):
-    data = {
-        'messages': comments
-    }
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {api_key}',
-    }
-    response = requests.post(
-        'https://api.openai.com/v1/chat/completions',
-        json={
-            'messages': data['messages'],
-            'model': model,
-            'max_tokens': max_tokens,
-            'n': 1,
-            'stop': None,
-            'temperature': temperature,
-        },
-        headers=headers,
-    )
-    if response.status_code == 429:
-        print("Rate limit exceeded. Waiting before retrying...")
-        time.sleep(10)  # wait for 10 seconds before retrying
-    return response.json()
-
-def process_images_and_captions(directory, model, max_tokens, temperature, api_key, prompt, caption_exts):
-    image_extensions = ["jpg", "jpeg", "png"]
-
-    image_files = [f for ext in image_extensions for f in glob.glob(f"{directory}/*.{ext}")]
+import tiktoken
 
-    total_cost = 0  # initialize total cost
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.manifest import add_manifest_args, manifest_from_args
+from common.stream import add_stream_args, stream_from_args
+from common.caption_store import (add_caption_store_args, caption_store_from_args, caption_exists, read_captions,
+                                  write_caption)
+from common.scan import add_scan_args, scan_images
+from common.shard import add_shard_args, sharding_from_args
+from common.trace import add_trace_args, tracer_from_args
+from common.dedup import add_dedup_args, dedup_from_args
+from request_engine import ChatCompletionEngine, DEFAULT_API_BASE
+from prompt_builder import PromptBuilder, add_prompt_args
+
+# every chat message costs its content plus 3 tokens, and the reply is primed with 3 more
+MESSAGE_TOKENS = 3
+REPLY_TOKENS = 3
+# images whose captions are read and turned into requests at a time
+JOB_CHUNK = 64
+
+def request_cost(model, usage):
+    prompt_tokens_used = usage['prompt_tokens']
+    completion_tokens_used = usage['completion_tokens']
+
+    if model == 'gpt-3.5-turbo':
+        prompt_cost = prompt_tokens_used * 0.0015 / 1000
+        completion_cost = completion_tokens_used * 0.002 / 1000
+    elif model == 'gpt-4':
+        prompt_cost = prompt_tokens_used * 0.03 / 1000
+        completion_cost = completion_tokens_used * 0.06 / 1000
+    else:
+        raise ValueError("Unknown model. Add the pricing for this model.")
+    return prompt_cost + completion_cost
+
+def caption_files(image_file, caption_exts):
+    base_name = os.path.splitext(image_file)[0]
+    return [f"{base_name}.{caption_ext}" for caption_ext in caption_exts]
+
+def summary_path(image_file):
+    return os.path.abspath(f"{os.path.splitext(image_file)[0]}.txt")
+
+def prompt_builder(model, prompt, prompt_budget=None):
+    """A PromptBuilder counting the tokens of the system prompt and captions messages with the model's tokenizer"""
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding('cl100k_base')
+    fixed = len(encoding.encode(prompt)) + 2 * MESSAGE_TOKENS + REPLY_TOKENS
+    builder = PromptBuilder(lambda body: fixed + len(encoding.encode(body)), prompt_budget)
+    builder.check()
+    return builder
 
-    for image_file in image_files:
-        base_name = os.path.splitext(image_file)[0]
+def build_comments(image_file, prompt, caption_exts, captions, builder):
+    base_name = os.path.splitext(image_file)[0]
+    comments = [
+        {
+            'role': 'system',
+            'content': prompt
+        }
+    ]
+    image_captions = [(caption_ext, captions[f"{base_name}.{caption_ext}"]) for caption_ext in caption_exts
+                      if f"{base_name}.{caption_ext}" in captions]
+    if image_captions:
+        # all captions go in one message, each further message would cost its own overhead
+        comments.append({
+            'role': 'user',
+            'content': builder.build(image_file, image_captions)
+        })
+    return comments
+
+def write_summary(image_file, response, error, model, caption_exts, manifest=None, store=None, quiet=False, builder=None):
+    """Write one response to its summary file, returning its cost, or None when the request failed"""
+    base_name = os.path.splitext(image_file)[0]
+    if error is not None:
+        if builder is not None:
+            builder.done(image_file, failed=True)
+        print(f"Failed to summarize {base_name}: {error}")
+        return None
+
+    cost = request_cost(model, response['usage']) if 'usage' in response else 0
+
+    if not quiet:
         print(base_name)
-        comments = [
-            {
-                'role': 'system',
-                'content': prompt
-            }
-        ]
-        caption_number = 1
-        for caption_ext in caption_exts:
-            caption_file = f"{base_name}.{caption_ext}"
-            if os.path.isfile(caption_file):
-                with open(caption_file, 'r') as f:
-                    caption_text = f.read()
-                    if caption_ext == "wd14cap":
-                        prepend_text = "Tags: "
-                    else:
-                        prepend_text = f"Caption {caption_number}: "
-                        caption_number += 1
-                    comments.append({
-                        'role': 'user',
-                        'content': prepend_text + caption_text
-                    })
-
-        if len(comments) > 1:
-            response = ask_openai(comments, model, max_tokens, temperature, api_key)
-
-            if 'usage' in response:
-                prompt_tokens_used = response['usage']['prompt_tokens']
-                completion_tokens_used = response['usage']['completion_tokens']
-
-                if model == 'gpt-3.5-turbo':
-                    prompt_cost = prompt_tokens_used * 0.0015 / 1000
-                    completion_cost = completion_tokens_used * 0.002 / 1000
-                elif model == 'gpt-4':
-                    prompt_cost = prompt_tokens_used * 0.03 / 1000
-                    completion_cost = completion_tokens_used * 0.06 / 1000
-                else:
-                    raise ValueError("Unknown model. Add the pricing for this model.")
-
-                total_cost += prompt_cost + completion_cost  # add cost used in this API call to the total
-
-                print(f"Response content: {response['choices'][0]['message']['content']}")
+        print(f"Response content: {response['choices'][0]['message']['content']}")
+    if builder is not None:
+        builder.done(image_file, quiet=quiet)
+
+    synth_file = f"{base_name}.txt"
+    write_caption(store, synth_file, response['choices'][0]['message']['content'])
+    if manifest is not None:
+        manifest.record(image_file, synth_file, caption_files(image_file, caption_exts))
+    return cost
+
+async def summarize_images(jobs, model, engine, caption_exts, manifest=None, store=None, quiet=False, builder=None):
+    total_cost = 0  # initialize total cost
+    summarized = failed = 0
+
+    async with engine:
+        # responses are written as soon as they arrive, in whatever order the requests finish
+        async for image_file, response, error in engine.run(jobs):
+            cost = write_summary(image_file, response, error, model, caption_exts, manifest, store, quiet, builder)
+            if cost is None:
+                failed += 1
+                continue
+            summarized += 1
+            total_cost += cost  # add cost used in this API call to the total
+            if not quiet:
                 print(f"Total cost so far: {total_cost}")
 
-                synth_file = f"{base_name}.txt"
-                with open(synth_file, 'w') as f:
-                    f.write(response['choices'][0]['message']['content'])
-                    print(response['choices'][0]['message']['content'])
+    print(f"Summarized {summarized} image(s), {failed} failed, {engine.retries} retried request(s)")
+
+async def stream_images(stream, build_jobs, model, engine, caption_exts, manifest=None, store=None, quiet=False,
+                        builder=None):
+    # batches from the pipeline are summarized concurrently through the one engine, so its rate limits
+    # and connection pool span the whole run; every batch is reported once all its images are written
+    loop = asyncio.get_running_loop()
+    batches = stream.batches()
+    totals = {'summarized': 0, 'failed': 0, 'cost': 0}
+
+    async def summarize_batch(image_files):
+        async for image_file, response, error in engine.run(build_jobs(image_files)):
+            cost = write_summary(image_file, response, error, model, caption_exts, manifest, store, quiet, builder)
+            if cost is None:
+                totals['failed'] += 1
+                continue
+            totals['summarized'] += 1
+            totals['cost'] += cost
+            if not quiet:
+                print(f"Total cost so far: {totals['cost']}")
+        if store is not None:
+            store.flush()
+        stream.done(image_files, summary_path, partial(caption_exists, store))
+
+    async with engine:
+        tasks = []
+        while True:
+            # stdin is read on a thread so requests keep flowing while waiting for the next batch
+            image_files = await loop.run_in_executor(None, next, batches, None)
+            if image_files is None:
+                break
+            tasks.append(asyncio.create_task(summarize_batch(image_files)))
+        await asyncio.gather(*tasks)
+
+    print(f"Summarized {totals['summarized']} image(s), {totals['failed']} failed, {engine.retries} retried request(s)")
+
+def build_jobs(image_files, model, max_tokens, temperature, prompt, caption_exts, builder, manifest=None, store=None):
+    """Yield (image_file, payload) for every image with captions, reading them JOB_CHUNK images at a time"""
+    image_files = iter(image_files)
+    while True:
+        chunk = list(islice(image_files, JOB_CHUNK))
+        if not chunk:
+            return
+        if store is not None:
+            # one bulk read per chunk, the manifest check below then hashes the captions from memory
+            store.preload([path for image_file in chunk for path in caption_files(image_file, caption_exts)])
+        if manifest is not None:
+            # a summary is stale when the image or any of its caption files changed
+            chunk = list(manifest.pending(chunk, inputs=lambda image_file: caption_files(image_file, caption_exts)))
+
+        captions = read_captions(store, [path for image_file in chunk for path in caption_files(image_file, caption_exts)])
+        for image_file in chunk:
+            comments = build_comments(image_file, prompt, caption_exts, captions, builder)
+            if len(comments) > 1:
+                yield image_file, {
+                    'messages': comments,
+                    'model': model,
+                    'max_tokens': max_tokens,
+                    'n': 1,
+                    'stop': None,
+                    'temperature': temperature,
+                }
+
+def process_images_and_captions(args, prompt, manifest=None, stream=None, store=None, dedup=None):
+    """Summarize the images of args.input_dir, or the batches of stream, with the settings parsed by main"""
+    engine = ChatCompletionEngine(args.api_key, args.api_base, args.concurrency, args.requests_per_minute,
+                                  args.tokens_per_minute, args.max_retries)
+    builder = prompt_builder(args.model, prompt, args.prompt_budget)
+    jobs_for = partial(build_jobs, model=args.model, max_tokens=args.max_tokens, temperature=args.temperature,
+                       prompt=prompt, caption_exts=args.caption_exts, builder=builder, manifest=manifest, store=store)
+
+    if stream is not None:
+        asyncio.run(stream_images(stream, jobs_for, args.model, engine, args.caption_exts, manifest, store, args.quiet,
+                                  builder))
+    else:
+        def summarize(image_files):
+            asyncio.run(summarize_images(jobs_for(image_files), args.model, engine, args.caption_exts, manifest, store,
+                                         args.quiet, builder))
+
+        image_files = scan_images(args.input_dir, args.scan_index)
+        if dedup is not None:
+            image_files = dedup.representatives(image_files)
+        sharding = sharding_from_args(args, args.input_dir, 'summarize_gpt')
+        if sharding is None:
+            summarize(image_files)
+        else:
+            sharding.run(summarize, image_files)
+    builder.report()
+
+    if manifest is not None:
+        manifest.close()
+    if store is not None:
+        store.close()
+    if dedup is not None:
+        dedup.close()
 
 def main():
     print('****STARTING GPT PASS****')
@@ -98,25 +221,39 @@ def main():
     parser.add_argument("--api_key", type=str,help="OpenAI API Key")
     parser.add_argument("--prompt_file_path", type=str,help="Path to txt file containing system prompt for the the model", default="gpt_system_prompt.txt")
     parser.add_argument("--caption_exts", nargs='+', help="Extensions for caption files", default=["b2cap", "flamcap", "wd14cap"])
+    parser.add_argument("--api_base", type=str, help="Base URL of the OpenAI compatible API", default=DEFAULT_API_BASE)
+    parser.add_argument("--concurrency", type=int, help="Max number of requests in flight at once", default=8)
+    parser.add_argument("--requests_per_minute", type=int, help="Request rate limit, otherwise taken from the API's rate limit headers")
+    parser.add_argument("--tokens_per_minute", type=int, help="Token rate limit, otherwise taken from the API's rate limit headers")
+    parser.add_argument("--max_retries", type=int, help="Retries per request on rate limits and server errors", default=6)
+
+    add_manifest_args(parser)
+    add_stream_args(parser)
+    add_caption_store_args(parser)
+    add_scan_args(parser)
+    add_shard_args(parser)
+    add_trace_args(parser)
+    add_dedup_args(parser)
+    add_prompt_args(parser)
 
     args = parser.parse_args()
+    stream = stream_from_args(args)
 
     input_directory = args.input_dir
     output_directory = args.output_dir
     model = args.model
     max_tokens = args.max_tokens
     temperature = args.temperature
-    api_key = args.api_key
     caption_exts = args.caption_exts
 
     #read in gpt sys prompt file
     with open(args.prompt_file_path, 'r') as prompt_file:
        prompt = prompt_file.read().strip()
 
-    if not api_key:
-        api_key = os.getenv("OPENAI_API_KEY")
+    if not args.api_key:
+        args.api_key = os.getenv("OPENAI_API_KEY")
 
-    if not api_key:
+    if not args.api_key:
         print("Please set OPENAI_API_KEY env variable.")
         return
     if not output_directory:
@@ -131,9 +268,20 @@ def main():
         print("Output directory does not exist.")
         return
 
+    store = caption_store_from_args(args, 'summarize_gpt')
+    manifest = manifest_from_args(args, 'summarize_gpt', {
+        'model': model, 'max_tokens': max_tokens, 'temperature': temperature, 'prompt': prompt, 'caption_exts': caption_exts,
+        **({'prompt_budget': args.prompt_budget} if args.prompt_budget else {})}, store)
+
+    args.scan_index = os.path.abspath(args.scan_index) if args.scan_index else None
+    tracer = tracer_from_args(args, 'summarize_gpt')
+    dedup = dedup_from_args(args)
+
     os.chdir(output_directory)  # Change current working directory to output directory
 
-    process_images_and_captions(input_directory, model, max_tokens, temperature, api_key, prompt, caption_exts)
+    process_images_and_captions(args, prompt, manifest, stream, store, dedup)
+    if tracer is not None:
+        tracer.close()
 
 if __name__ == "__main__":
     main()
@@ -1,60 +1,301 @@
 import time
 import os
-import glob
+import hashlib
+import pickle
 from huggingface_hub import hf_hub_download
 from llama_cpp import Llama
 import argparse
+import sys
+from functools import partial
+from itertools import chain, islice, tee
 
-def process_images_and_captions(directory, prompt, caption_exts,hf_repo_id, hf_filename, n_threads, n_batch, n_gpu_layers, n_gqa, max_tokens, temperature, top_p, frequency_penalty, presence_penalty):
-    image_extensions = ["jpg", "jpeg", "png"]
-    image_files = [f for ext in image_extensions for f in glob.glob(f"{directory}/*.{ext}")]
-    
-    model_path = hf_hub_download(repo_id=hf_repo_id, filename=hf_filename)
-    # Load the Llama model
-    lcpp_llm = Llama(
-        model_path=model_path,
-        n_threads=n_threads, 
-        n_batch=n_batch,  # Should be between 1 and n_ctx
-        n_gpu_layers=n_gpu_layers,  
-        n_gqa=n_gqa,
-        n_ctx=1024
-    )
-
-    for image_file in image_files:
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.manifest import add_manifest_args, manifest_from_args
+from common.stream import add_stream_args, stream_from_args
+from common.caption_store import (add_caption_store_args, caption_store_from_args, caption_exists, read_captions,
+                                  write_caption)
+from common.scan import add_scan_args, scan_images
+from common.shard import add_shard_args, sharding_from_args
+from common.trace import add_trace_args, tracer_from_args, span
+from common.dedup import add_dedup_args, dedup_from_args
+from worker_pool import WorkerPool
+from prompt_builder import PromptBuilder, add_prompt_args
+
+N_CTX = 1024
+# images whose captions are read from the store and turned into prompts at a time
+CHUNK = 64
+ASSISTANT_PREFIX = "\n\n### ASSISTANT: "
+
+def caption_files(image_file, caption_exts):
+    base_name = os.path.splitext(image_file)[0]
+    return [f"{base_name}.{caption_ext}" for caption_ext in caption_exts]
+
+def summary_path(image_file):
+    return os.path.abspath(f"{os.path.splitext(image_file)[0]}.txt")
+
+def prompt_tokens(lcpp_llm, text):
+    # same tokenization Llama.create_completion applies to the prompt
+    return lcpp_llm.tokenize(b" " + text.encode("utf-8"))
+
+def prime_system_prompt(lcpp_llm, model_path, system_prefix, cache_dir=None):
+    """
+    Evaluate the shared system prompt once and return the llama state holding it, and whether it had to be
+    evaluated. With cache_dir the state is also stored on disk, so later runs restore it instead.
+    """
+    tokens = prompt_tokens(lcpp_llm, system_prefix)
+    cache_file = None
+    if cache_dir:
+        stat = os.stat(model_path)
+        key = repr((os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns, lcpp_llm.n_ctx(), tokens))
+        cache_file = os.path.join(cache_dir, f"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.state")
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    state = pickle.load(f)
+                lcpp_llm.load_state(state)
+                print(f"Restored {len(tokens)} system prompt tokens from {cache_file}")
+                return state, False
+            except (OSError, pickle.UnpicklingError, RuntimeError) as e:
+                print(f"Ignoring unusable prompt cache {cache_file}: {e}")
+
+    start_time = time.time()
+    lcpp_llm.reset()
+    lcpp_llm.eval(tokens)
+    state = lcpp_llm.save_state()
+    print(f"Evaluated {len(tokens)} system prompt tokens in {time.time() - start_time:.2f} seconds")
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # pool workers may prime the same cache file at the same time
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    return state, True
+
+def build_prompt(image_file, system_prefix, caption_exts, captions, builder):
+    base_name = os.path.splitext(image_file)[0]
+    image_captions = [(caption_ext, captions[f"{base_name}.{caption_ext}"]) for caption_ext in caption_exts
+                      if f"{base_name}.{caption_ext}" in captions]
+    return system_prefix + builder.build(image_file, image_captions) + ASSISTANT_PREFIX
+
+def prompt_builder(model_path, system_prefix, max_tokens, prompt_budget=None):
+    """A PromptBuilder counting with the model's tokenizer, leaving max_tokens of the context for the summary"""
+    # only the vocabulary is loaded, pool workers load the model themselves
+    tokenizer = Llama(model_path=model_path, vocab_only=True, n_ctx=N_CTX, verbose=False)
+    budget = N_CTX - max_tokens if prompt_budget is None else min(prompt_budget, N_CTX - max_tokens)
+    builder = PromptBuilder(lambda body: len(prompt_tokens(tokenizer, system_prefix + body + ASSISTANT_PREFIX)), budget)
+    builder.check()
+    return builder
+
+class Summarizer:
+    """A llama context answering summarization prompts that all start with the same system prompt"""
+
+    def __init__(self, model_path, system_prefix, n_threads, n_batch, n_gpu_layers, n_gqa, generate_kwargs,
+                 prompt_cache=True, prompt_cache_dir=None):
+        # Load the Llama model. The weights are mmapped, so pool workers share one copy in the page cache
+        self.lcpp_llm = Llama(
+            model_path=model_path,
+            n_threads=n_threads,
+            n_batch=n_batch,  # Should be between 1 and n_ctx
+            n_gpu_layers=n_gpu_layers,
+            n_gqa=n_gqa,
+            n_ctx=N_CTX,
+            use_mmap=True
+        )
+        self.generate_kwargs = generate_kwargs
+        self.system_tokens = prompt_tokens(self.lcpp_llm, system_prefix)
+        self.system_state = None
+        self.primed_tokens = 0
+        if prompt_cache:
+            self.system_state, evaluated = prime_system_prompt(self.lcpp_llm, model_path, system_prefix, prompt_cache_dir)
+            if evaluated:
+                self.primed_tokens = len(self.system_tokens)
+
+    def summarize(self, prompt_string):
+        """Return the summary with the number of prompt tokens evaluated and reused, and completion tokens"""
+        lcpp_llm = self.lcpp_llm
+        if self.system_state is not None:
+            # the previous image normally leaves the system prompt in context, restore it when it does not
+            context = lcpp_llm.input_ids[:lcpp_llm.n_tokens].tolist()
+            if Llama.longest_token_prefix(context, self.system_tokens) < len(self.system_tokens) - 1:
+                lcpp_llm.load_state(self.system_state)
+        # llama-cpp only evaluates the part of a prompt that differs from the tokens already in its context
+        tokens = prompt_tokens(lcpp_llm, prompt_string)
+        reused = min(Llama.longest_token_prefix(lcpp_llm.input_ids[:lcpp_llm.n_tokens].tolist(), tokens[:-1]), len(tokens) - 1)
+        evaluated = len(tokens) - reused + self.primed_tokens
+        self.primed_tokens = 0
+
+        # Generate response using Llama model
+        with span('generate'):
+            response = lcpp_llm(prompt=prompt_string, **self.generate_kwargs)
+        return response['choices'][0]['text'], evaluated, reused, response['usage']['completion_tokens']
+
+# each pool worker process holds its own Summarizer
+_worker_summarizer = None
+
+def init_worker(*summarizer_args):
+    global _worker_summarizer
+    _worker_summarizer = Summarizer(*summarizer_args)
+
+def summarize_in_worker(prompt_string):
+    return _worker_summarizer.summarize(prompt_string)
+
+def write_summaries(image_files, results, caption_exts, manifest=None, totals=None, store=None, quiet=False, builder=None):
+    """Write the (prompt, result, error) of every image, adding its token counts to `totals`"""
+    if totals is None:
+        totals = {'evaluated': 0, 'reused': 0, 'completion': 0, 'failed': 0}
+    for number, (image_file, (_, result, error)) in enumerate(zip(image_files, results), start=1):
         base_name = os.path.splitext(image_file)[0]
-        print(base_name)
-        prompt_string = f"### SYSTEM: {prompt}\n\n### USER: "
-
-        caption_number = 1
-        for caption_ext in caption_exts:
-            caption_file = f"{base_name}.{caption_ext}"
-            if os.path.isfile(caption_file):
-                with open(caption_file, 'r') as f:
-                    caption_text = f.read().strip()
-                    if caption_ext == "wd14cap":
-                        prepend_text = "Tags: "
-                    else:
-                        prepend_text = f"Caption {caption_number}: "
-                        caption_number += 1
-                    prompt_string += prepend_text + caption_text + "\n"
-
-        prompt_string += "\n### ASSISTANT: "
-
-        if caption_number >= 1:
-            # Generate response using Llama model
-            response = lcpp_llm(
-                prompt=prompt_string,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                frequency_penalty=frequency_penalty,
-                presence_penalty=presence_penalty
-            )
-
-            synth_file = f"{base_name}.txt"
-            with open(synth_file, 'w') as f:
-                f.write(response['choices'][0]['text'])
-                print(response['choices'][0]['text'])
+        if not quiet:
+            print(f"[{number}] {base_name}")
+        if builder is not None:
+            builder.done(image_file, error is not None, quiet)
+        if error is not None:
+            totals['failed'] += 1
+            print(f"Failed to summarize {base_name}: {error}")
+            continue
+
+        text, evaluated, reused, completion = result
+        totals['evaluated'] += evaluated
+        totals['reused'] += reused
+        totals['completion'] += completion
+
+        synth_file = f"{base_name}.txt"
+        write_caption(store, synth_file, text)
+        if not quiet:
+            print(text)
+        if manifest is not None:
+            manifest.record(image_file, synth_file, caption_files(image_file, caption_exts))
+    if store is not None:
+        store.flush()
+    return totals
+
+def build_prompts(image_files, system_prefix, caption_exts, builder, store=None):
+    captions = read_captions(store, [path for image_file in image_files for path in caption_files(image_file, caption_exts)])
+    return [build_prompt(image_file, system_prefix, caption_exts, captions, builder) for image_file in image_files]
+
+def pending_images(image_files, caption_exts, manifest=None, store=None):
+    if store is not None:
+        # one bulk read for the whole batch, the manifest check and the prompts are then served from memory
+        store.preload([path for image_file in image_files for path in caption_files(image_file, caption_exts)])
+    if manifest is not None:
+        # a summary is stale when the image or any of its caption files changed
+        image_files = list(manifest.pending(image_files, inputs=lambda image_file: caption_files(image_file, caption_exts)))
+    return image_files
+
+def chunked(items, size=CHUNK):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def iter_pending_images(image_files, caption_exts, manifest=None, store=None):
+    """Lazy pending_images for a whole scan, the store is read CHUNK images at a time"""
+    def preloaded(image_files):
+        for chunk in chunked(image_files):
+            store.preload([path for image_file in chunk for path in caption_files(image_file, caption_exts)])
+            yield from chunk
+
+    if store is not None:
+        image_files = preloaded(image_files)
+    if manifest is not None:
+        image_files = manifest.pending(image_files, inputs=lambda image_file: caption_files(image_file, caption_exts))
+    return iter(image_files)
+
+def print_totals(totals, elapsed):
+    if totals['failed']:
+        print(f"{totals['failed']} image(s) failed")
+    if elapsed > 0 and totals['evaluated']:
+        print(f"Prompt tokens: {totals['evaluated']} evaluated, {totals['reused']} reused from context. "
+              f"Completion tokens: {totals['completion']}. "
+              f"{(totals['evaluated'] + totals['completion']) / elapsed:.2f} evaluated tokens/sec, "
+              f"{(totals['evaluated'] + totals['reused'] + totals['completion']) / elapsed:.2f} effective tokens/sec")
+
+def process_images_and_captions(args, prompt, manifest=None, stream=None, store=None, dedup=None):
+    """Summarize the images of args.input_dir, or the batches of stream, with the settings parsed by main"""
+    caption_exts, quiet = args.caption_exts, args.quiet
+    prompt_cache, prompt_cache_dir = not args.no_prompt_cache, args.prompt_cache_dir
+    n_threads, n_batch, n_gpu_layers, n_gqa = args.n_threads, args.n_batch, args.n_gpu_layers, args.n_gqa
+    sharding = None
+    if stream is None:
+        image_files = scan_images(args.input_dir, args.scan_index)
+        if dedup is not None:
+            image_files = dedup.representatives(image_files)
+        sharding = sharding_from_args(args, args.input_dir, 'summarize_llama')
+        if sharding is None:
+            image_files = iter_pending_images(image_files, caption_exts, manifest, store)
+            # the model is only downloaded and loaded once there is something to summarize
+            first = next(image_files, None)
+            if first is None:
+                return
+            image_files = chain([first], image_files)
+
+    model_path = hf_hub_download(repo_id=args.hf_repo_id, filename=args.hf_filename)
+    system_prefix = f"### SYSTEM: {prompt}\n\n### USER: "
+    builder = prompt_builder(model_path, system_prefix, args.max_tokens, args.prompt_budget)
+    generate_kwargs = {
+        'max_tokens': args.max_tokens,
+        'temperature': args.temperature,
+        'top_p': args.top_p,
+        'frequency_penalty': args.frequency_penalty,
+        'presence_penalty': args.presence_penalty,
+    }
+
+    start_time = time.time()
+
+    if stream is not None:
+        # the pipeline already runs the stages side by side, so a streaming llama stage keeps to one process
+        if args.num_workers > 1:
+            print("--num_workers is ignored with --stream, running one llama process")
+        summarizer = Summarizer(model_path, system_prefix, n_threads, n_batch, n_gpu_layers, n_gqa, generate_kwargs,
+                                prompt_cache, prompt_cache_dir)
+        totals = None
+        for images in stream.batches():
+            image_files = pending_images(images, caption_exts, manifest, store)
+            prompts = build_prompts(image_files, system_prefix, caption_exts, builder, store)
+            results = ((prompt_string, summarizer.summarize(prompt_string), None) for prompt_string in prompts)
+            totals = write_summaries(image_files, results, caption_exts, manifest, totals, store, quiet, builder)
+            stream.done(images, summary_path, partial(caption_exists, store))
+        if totals is not None:
+            print_totals(totals, time.time() - start_time)
+        builder.report()
+        return
+
+    if args.num_workers > 1:
+        # one llama.cpp context stops scaling past a handful of threads, so split them between the workers
+        worker_threads = max(1, n_threads // args.num_workers)
+        print(f"Starting {args.num_workers} llama workers with {worker_threads} threads each")
+        pool = WorkerPool(args.num_workers, init_worker, (model_path, system_prefix, worker_threads, n_batch, n_gpu_layers,
+                                                     n_gqa, generate_kwargs, prompt_cache, prompt_cache_dir),
+                          summarize_in_worker)
+        summarize = pool.run
+    else:
+        summarizer = Summarizer(model_path, system_prefix, n_threads, n_batch, n_gpu_layers, n_gqa, generate_kwargs,
+                                prompt_cache, prompt_cache_dir)
+        summarize = lambda prompts: ((prompt_string, summarizer.summarize(prompt_string), None) for prompt_string in prompts)
+
+    totals = None
+
+    def summarize_images(image_files):
+        nonlocal totals
+        # prompts are built a chunk at a time as the summarizer takes them, tee hands write_summaries the same images
+        image_files, prompted = tee(image_files)
+        prompts = (prompt_string for chunk in chunked(prompted)
+                   for prompt_string in build_prompts(chunk, system_prefix, caption_exts, builder, store))
+        totals = write_summaries(image_files, summarize(prompts), caption_exts, manifest, totals, store, quiet, builder)
+
+    if sharding is None:
+        summarize_images(image_files)
+    else:
+        # the worker pool is started again for every chunk, so keep --lease_chunks low with --num_workers
+        sharding.run(lambda images: summarize_images(iter_pending_images(images, caption_exts, manifest, store)),
+                     image_files)
+    if totals is not None:
+        print_totals(totals, time.time() - start_time)
+    builder.report()
 
 def main():
     print('****STARTING LLAMA PASS****')
@@ -75,20 +316,29 @@ def main():
     parser.add_argument("--top_p", type=float, default=1.0)
     parser.add_argument("--frequency_penalty", type=float, default=0)
     parser.add_argument("--presence_penalty", type=float, default=0)
+    parser.add_argument("--no_prompt_cache", action="store_true", help="don't evaluate and keep the system prompt state up front")
+    parser.add_argument("--prompt_cache_dir", type=str, help="directory to persist the evaluated system prompt state in across runs")
+    parser.add_argument("--num_workers", type=int, default=1, help="number of llama processes to split n_threads between")
     
     
 
+    add_manifest_args(parser)
+    add_stream_args(parser)
+    add_caption_store_args(parser)
+    add_scan_args(parser)
+    add_shard_args(parser)
+    add_trace_args(parser)
+    add_dedup_args(parser)
+    add_prompt_args(parser)
+
     args = parser.parse_args()
+    stream = stream_from_args(args)
 
     input_directory = args.input_dir
     output_directory = args.output_dir
     hf_repo_id = args.hf_repo_id
     hf_filename = args.hf_filename
     caption_exts = args.caption_exts
-    n_threads = args.n_threads
-    n_batch = args.n_batch
-    n_gpu_layers = args.n_gpu_layers
-    n_gqa = args.n_gqa
     max_tokens = args.max_tokens
     temperature = args.temperature
     top_p = args.top_p
@@ -113,9 +363,31 @@ def main():
         print("Output directory does not exist.")
         return
 
+    store = caption_store_from_args(args, 'summarize_llama')
+    manifest = manifest_from_args(args, 'summarize_llama', {
+        'hf_repo_id': hf_repo_id, 'hf_filename': hf_filename, 'prompt': prompt, 'caption_exts': caption_exts,
+        'max_tokens': max_tokens, 'temperature': temperature, 'top_p': top_p, 'frequency_penalty': frequency_penalty,
+        'presence_penalty': presence_penalty, **({'prompt_budget': args.prompt_budget} if args.prompt_budget else {})},
+        store)
+
+    # both are used after changing to the output directory
+    args.prompt_cache_dir = os.path.abspath(args.prompt_cache_dir) if args.prompt_cache_dir else None
+    args.scan_index = os.path.abspath(args.scan_index) if args.scan_index else None
+    tracer = tracer_from_args(args, 'summarize_llama')
+    dedup = dedup_from_args(args)
+
     os.chdir(output_directory)  # Change current working directory to output directory
 
-    process_images_and_captions(input_directory, prompt, caption_exts , hf_repo_id, hf_filename, n_threads, n_batch, n_gpu_layers, n_gqa, max_tokens, temperature, top_p, frequency_penalty, presence_penalty)
+    process_images_and_captions(args, prompt, manifest, stream, store, dedup)
+
+    if manifest is not None:
+        manifest.close()
+    if store is not None:
+        store.close()
+    if dedup is not None:
+        dedup.close()
+    if tracer is not None:
+        tracer.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+import multiprocessing
+import multiprocessing.connection
+
+_DONE = object()
+
+
+def _worker(worker_id, init, init_args, handle, tasks, conn):
+    # results go back over a pipe rather than a queue: a send is written out straight away,
+    # so nothing is lost when the worker crashes right after it
+    try:
+        init(*init_args)
+    except Exception as e:
+        conn.send(('init_failed', f"{type(e).__name__}: {e}"))
+        return
+
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        index, task = item
+        conn.send(('start', index))
+        try:
+            conn.send(('done', index, handle(task), None))
+        except Exception as e:
+            conn.send(('done', index, None, f"{type(e).__name__}: {e}"))
+    conn.send(('exit',))
+
+
+class WorkerPool:
+    """
+    Process pool for stateful workers, e.g. one model context per process.
+
+    Every worker runs init(*init_args) once and then handle(task) for tasks taken from a shared queue, so
+    fast workers simply take more of them. An exception in handle() only fails that task. A worker that dies
+    mid-task fails that task and is replaced, up to max_restarts times; a worker whose init() fails is not.
+    init and handle must be module level functions, workers are spawned rather than forked. Tasks are taken
+    from the iterable a few at a time as workers free up, so it can be a generator over a large directory.
+    """
+
+    def __init__(self, num_workers, init, init_args, handle, max_restarts=None):
+        self.num_workers = num_workers
+        self.init = init
+        self.init_args = init_args
+        self.handle = handle
+        self.max_restarts = num_workers if max_restarts is None else max_restarts
+
+    def run(self, tasks):
+        """Yield (task, result, error) for every task, in task order"""
+        tasks = iter(tasks)
+        ctx = multiprocessing.get_context('spawn')
+        task_queue = ctx.Queue()
+        # tasks queued but not yet yielded, and the task count once the iterable is exhausted
+        queued = {}
+        total = None
+
+        def feed(limit):
+            nonlocal total
+            while total is None and len(queued) < limit:
+                task = next(tasks, _DONE)
+                if task is _DONE:
+                    total = len(queued) + next_index
+                    for _ in range(self.num_workers):
+                        task_queue.put(None)
+                    return
+                index = next_index + len(queued)
+                queued[index] = task
+                task_queue.put((index, task))
+
+        workers = {}
+        connections = {}
+        in_flight = {}
+        exited = set()
+        restarts = 0
+
+        def start(worker_id):
+            reader, writer = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_worker, daemon=True, args=(
+                worker_id, self.init, self.init_args, self.handle, task_queue, writer))
+            process.start()
+            # only the worker holds the write end, so the pipe reports EOF once the worker is gone
+            writer.close()
+            workers[worker_id] = process
+            connections[reader] = worker_id
+
+        for worker_id in range(self.num_workers):
+            start(worker_id)
+        next_worker_id = self.num_workers
+
+        done = {}
+        next_index = 0
+        try:
+            feed(self.num_workers * 2)
+            while total is None or next_index < total:
+                ready = multiprocessing.connection.wait(list(connections)) if connections else []
+                if not connections:
+                    feed(float('inf'))
+                    for index in queued:
+                        done.setdefault(index, (None, "no workers left"))
+
+                for conn in ready:
+                    worker_id = connections[conn]
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        del connections[conn]
+                        process = workers.pop(worker_id)
+                        process.join()
+                        if worker_id in exited:
+                            continue
+                        print(f"Worker {worker_id} exited unexpectedly with code {process.exitcode}")
+                        if worker_id in in_flight:
+                            done[in_flight.pop(worker_id)] = (None, f"worker exited with code {process.exitcode}")
+                        if restarts < self.max_restarts:
+                            restarts += 1
+                            start(next_worker_id)
+                            next_worker_id += 1
+                        continue
+
+                    if message[0] == 'start':
+                        in_flight[worker_id] = message[1]
+                    elif message[0] == 'done':
+                        _, index, result, error = message
+                        in_flight.pop(worker_id, None)
+                        done[index] = (result, error)
+                    elif message[0] == 'init_failed':
+                        print(f"Worker {worker_id} failed to start: {message[1]}")
+                        exited.add(worker_id)
+                    elif message[0] == 'exit':
+                        exited.add(worker_id)
+
+                while next_index in done:
+                    result, error = done.pop(next_index)
+                    yield queued.pop(next_index), result, error
+                    next_index += 1
+                feed(self.num_workers * 2)
+        finally:
+            # tasks and stop markers left behind by failed workers must not block interpreter exit
+            task_queue.cancel_join_thread()
+            for process in workers.values():
+                if total is None or next_index < total:
+                    process.terminate()
+                process.join()
@@ -1,5 +1,7 @@
 import os
+import sys
 import csv
+import time
 import torch
 import numpy as np
 import pandas as pd
@@ -7,10 +9,30 @@ import onnxruntime
 from PIL import Image
 import cv2
 from pathlib import Path
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
 from onnxruntime.capi.onnxruntime_pybind11_state import RuntimeException
 from huggingface_hub import hf_hub_download,hf_hub_url
 from tqdm import tqdm
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.prefetch import add_prefetch_args, prefetcher_from_args
+from common.hashing import file_digest
+from common.manifest import add_manifest_args, manifest_from_args
+from common.stream import add_stream_args, stream_from_args
+from common.caption_store import add_caption_store_args, caption_store_from_args, caption_exists, write_caption
+from common.daemon import add_daemon_args, daemon_from_args
+from common.scan import add_scan_args, scan_images
+from common.shard import add_shard_args, sharding_from_args
+from common.trace import add_trace_args, tracer_from_args, span
+from common.dedup import add_dedup_args, dedup_from_args
+from score_cache import ScoreCache
+from ort_sessions import add_session_args, create_session, quantized_model, select_providers, session_options
+
+IMAGE_SIZE = 448
+STACKED_MODEL_REPO_IDS = ['SmilingWolf/wd-v1-4-convnext-tagger-v2', 'SmilingWolf/wd-v1-4-vit-tagger-v2',
+                          'SmilingWolf/wd-v1-4-swinv2-tagger-v2']
+
 def download_model_files(model_repo_id):
     # Define the URLs for the model and tags file
     model_url = hf_hub_url(repo_id=model_repo_id, filename='model.onnx')
@@ -35,77 +57,408 @@ def preprocess_image(image):
     pad_h = (size - h) // 2
     pad_w = (size - w) // 2
     image = np.pad(image, [(pad_h, pad_h), (pad_w, pad_w), (0, 0)], mode='constant', constant_values=255)
-    image = cv2.resize(image, (448, 448), interpolation=cv2.INTER_AREA)
+    image = cv2.resize(image, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_AREA)
     image = np.expand_dims(image, 0)
     return image.astype(np.float32)
 
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+def preprocess_image_fast(image, out=None):
+    # Same result as preprocess_image (within resampling error) but shrinks before padding and
+    # writes the BGR float32 pixels straight into `out`, e.g. one row of the batch buffer
+    if out is None:
+        out = np.empty((IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
+    if image.format == 'JPEG':
+        # let libjpeg decode at a reduced DCT scale that still covers the target size
+        image.draft('RGB', (IMAGE_SIZE, IMAGE_SIZE))
+    if has_alpha(image):
+        image = image.convert('RGBA')
+        bg = Image.new('RGBA', image.size, 'WHITE')
+        bg.paste(image, mask=image)
+        image = bg
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image = np.asarray(image)
+
+    # place the content where the padded square would have put it after the final resize
+    h, w = image.shape[:2]
+    size = max(h, w)
+    pad_h = (size - h) // 2
+    pad_w = (size - w) // 2
+    scale_h = IMAGE_SIZE / (h + 2 * pad_h)
+    scale_w = IMAGE_SIZE / (w + 2 * pad_w)
+    top, bottom = round(pad_h * scale_h), round((pad_h + h) * scale_h)
+    left, right = round(pad_w * scale_w), round((pad_w + w) * scale_w)
+    image = cv2.resize(image, (max(right - left, 1), max(bottom - top, 1)), interpolation=cv2.INTER_AREA)
+
+    out[...] = 255
+    out[top:top + image.shape[0], left:left + image.shape[1]] = image[..., ::-1]  # RGB -> BGR
+    return out
+
+def load_image(image_path, fast_preprocess=False):
+    with Image.open(image_path) as image:
+        if fast_preprocess:
+            # decoding is part of the fast path, it picks the reduced JPEG scale before the pixels are read
+            with span('preprocess'):
+                # uint8 keeps the prefetch queue small; the batch buffer does the float32 conversion
+                return preprocess_image_fast(image, out=np.empty((IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8))
+        with span('decode'):
+            image.load()
+        with span('preprocess'):
+            return preprocess_image(image)[0]
+
+def compare_preprocessing(image_paths, tolerance):
+    # check the fast path against preprocess_image; tolerance is the allowed mean absolute pixel difference
+    failures = []
+    diffs = []
+    for image_path in image_paths:
+        reference = preprocess_image(Image.open(image_path))[0]
+        fast = preprocess_image_fast(Image.open(image_path))
+        diff = np.abs(reference - fast)
+        diffs.append(diff.mean())
+        if diff.mean() > tolerance:
+            failures.append((image_path, diff.mean(), diff.max()))
+    print(f"Compared {len(diffs)} images: mean abs diff {np.mean(diffs) if diffs else 0:.3f}, worst {max(diffs, default=0):.3f}")
+    for image_path, mean_diff, max_diff in failures:
+        print(f"{image_path}: mean abs diff {mean_diff:.3f} (max {max_diff:.0f}) exceeds tolerance {tolerance}")
+    return not failures
+
+def captions_from_scores(names, scores, tag_threshold):
+    # the captions write_captions would write for one model's scores
+    captions = []
+    for row in scores:
+        picked = np.flatnonzero(row > tag_threshold)
+        picked = picked[sort_descending(row[picked])]
+        captions.append(format_tags(names[picked], row[picked]))
+    return captions
+
+def report_agreement(name, names, reference, scores, tag_threshold, speeds, min_agreement):
+    # how far the tags and captions of scores are from those of reference; False when below min_agreement
+    reference_tags, tags = reference > tag_threshold, scores > tag_threshold
+    union = (reference_tags | tags).sum(axis=1)
+    agreement = np.where(union > 0, (reference_tags & tags).sum(axis=1) / np.maximum(union, 1), 1.0)
+    identical = np.mean([a == b for a, b in zip(captions_from_scores(names, reference, tag_threshold),
+                                                 captions_from_scores(names, scores, tag_threshold))])
+    diff = np.abs(reference - scores)
+    print(f"{name}: tag agreement {agreement.mean():.3f} (worst {agreement.min():.3f}), same tags for "
+          f"{(reference_tags == tags).all(axis=1).mean():.0%} and identical captions for {identical:.0%} of "
+          f"{len(scores)} image(s), {(reference_tags & ~tags).sum()} tag(s) lost and {(~reference_tags & tags).sum()} "
+          f"gained, score diff mean {diff.mean():.2g} max {diff.max():.2g}, {speeds[0]:.2f} -> {speeds[1]:.2f} images/s")
+    if agreement.mean() < min_agreement:
+        print(f"{name}: tag agreement is below {min_agreement}")
+        return False
+    return True
+
+def compare_quantized(image_paths, model_repo_ids, tag_threshold, filter_tags, ort_cache_dir, options, batch_size,
+                      min_agreement):
+    # check the int8 models against the float32 ones on the same images; both run on the CPU so the speeds compare
+    images = np.stack([load_image(image_path) for image_path in image_paths])
+    passed = True
+    for model_repo_id in model_repo_ids:
+        model_path, tags_path = download_model_files(model_repo_id)
+        names, columns = load_tags(tags_path, tuple(filter_tags))
+        scores, speeds = [], []
+        for path in (model_path, quantized_model(model_path, ort_cache_dir, model_repo_id)):
+            session = create_session(path, options, ['CPUExecutionProvider'], ort_cache_dir, model_repo_id)
+            run_batch(session, images[:1], 1)
+            start_time = time.perf_counter()
+            scores.append(run_batch(session, images, batch_size)[:, columns])
+            speeds.append(len(images) / (time.perf_counter() - start_time))
+        passed &= report_agreement(model_repo_id, names, scores[0], scores[1], tag_threshold, speeds, min_agreement)
+    return passed
+
+def compare_batching(image_paths, model_repo_ids, tag_threshold, filter_tags, ort_cache_dir, options, batch_size,
+                     min_agreement):
+    # check --batch_size batches against one image per run on the CPU. Batched kernels sum in a different
+    # order, so scores drift by around 1e-5: near-tied tags can swap places and tags right at the threshold
+    # can flip, which makes captions tolerance-equal rather than byte-identical
+    images = np.stack([load_image(image_path) for image_path in image_paths])
+    passed = True
+    for model_repo_id in model_repo_ids:
+        model_path, tags_path = download_model_files(model_repo_id)
+        names, columns = load_tags(tags_path, tuple(filter_tags))
+        session = create_session(model_path, options, ['CPUExecutionProvider'], ort_cache_dir, model_repo_id)
+        run_batch(session, images[:1], 1)
+        scores, speeds = [], []
+        for size in (1, batch_size):
+            start_time = time.perf_counter()
+            scores.append(run_batch(session, images, size)[:, columns])
+            speeds.append(len(images) / (time.perf_counter() - start_time))
+        passed &= report_agreement(f"{model_repo_id} batch 1 vs {batch_size}", names, scores[0], scores[1],
+                                   tag_threshold, speeds, min_agreement)
+    return passed
+
+def get_batch_limit(session, batch_size):
+    # Some exports pin the batch axis (usually to 1), so never feed more than that at once
+    batch_dim = session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim > 0:
+        return min(batch_size, batch_dim), batch_dim
+    return batch_size, None
+
+def run_batch(session, images, batch_size):
+    input_name = session.get_inputs()[0].name
+    limit, fixed_batch = get_batch_limit(session, batch_size)
+    results = []
+    for start in range(0, len(images), limit):
+        chunk = images[start:start + limit]
+        count = len(chunk)
+        if fixed_batch is not None and count < fixed_batch:
+            # pad the final partial batch up to the fixed size and drop the extra rows afterwards
+            padding = np.zeros((fixed_batch - count,) + chunk.shape[1:], dtype=chunk.dtype)
+            chunk = np.concatenate([chunk, padding])
+        results.append(session.run(None, {input_name: chunk})[0][:count])
+    return np.concatenate(results)
+
+@lru_cache(maxsize=None)
+def load_tags(tags_path, filter_tags):
+    # read the vocabulary once per model and keep only the score columns that survive the filter
+    tags = pd.read_csv(tags_path)
+    keep = ~tags['name'].isin(filter_tags).to_numpy()
+    return tags['name'].to_numpy()[keep], np.flatnonzero(keep)
+
+def align_tags(tag_sets):
+    # same tag order pd.concat(..., join='outer') produced when the per-model frames were merged
+    frames = [pd.Series(np.zeros(len(names)), index=names) for names, _ in tag_sets]
+    vocab = pd.concat(frames, axis=1, join='outer').index
+    positions = [vocab.get_indexer(names) for names, _ in tag_sets]
+    return vocab.to_numpy(), positions
+
+def average_scores(batch_scores, tag_sets, positions, vocab_size):
+    # float32 sum / count in model order, matching DataFrame.mean(axis=1) over the outer join
+    total = np.zeros((len(batch_scores[0]), vocab_size), dtype=np.float32)
+    count = np.zeros(vocab_size, dtype=np.float32)
+    for scores, (_, columns), position in zip(batch_scores, tag_sets, positions):
+        total[:, position] += scores[:, columns]
+        count[position] += 1
+    return total / count
+
+def sort_descending(scores):
+    # mirrors sort_values(ascending=False) so tied scores keep the order pandas gave them
+    index = np.arange(len(scores))[::-1]
+    return index[scores[::-1].argsort(kind='quicksort')][::-1]
+
+def top_k(scores, k):
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+def format_tags(names, scores):
+    return "".join(f"[{name}: {score:.2f}], " for name, score in zip(names, scores))
+
+def scores_to_tags(scores, tags_path, filter_tags):
+    names, columns = load_tags(tags_path, tuple(filter_tags))
+    return pd.DataFrame({'name': names, 'Score': scores[columns]}, index=columns)
+
 def run_model(image_path, model_path, tags_path, session, tag_threshold, filter_tags):
     image = Image.open(image_path)
     processed_image = preprocess_image(image)
-    result = session.run(None, {session.get_inputs()[0].name: processed_image})[0]
-    tags = pd.read_csv(tags_path)
-    tags.reset_index(inplace=True)
-    result_df = pd.DataFrame(result[0], columns=['Score'])
-    result_with_tags = pd.concat([tags, result_df], axis=1)
-    tags_filtered = result_with_tags[['name', 'Score']]
-    tags_filtered = tags_filtered[~tags_filtered['name'].isin(filter_tags)]
-    return tags_filtered
-
-def main(image_folder, model_repo_ids, tag_threshold, filter_tags, stack_models):
+    result = run_batch(session, processed_image, 1)
+    return scores_to_tags(result[0], tags_path, filter_tags)
+
+def caption_path(image_path):
+    # next to the image, where the summarizers look for it, also for images in subdirectories
+    return f'{Path(image_path).parent / Path(image_path).stem}.wd14cap'
+
+def run_sessions(executor, sessions, batch, batch_size):
+    # every session reads the same preprocessed batch; onnxruntime drops the GIL inside run()
+    if executor is None:
+        return [run_batch(session, batch, batch_size) for session in sessions]
+    return list(executor.map(lambda session: run_batch(session, batch, batch_size), sessions))
+
+def main(args):
+    """Tag the images of args.input_directory, or the ones the stream or daemon hands over, as parse_args set up"""
+    model_repo_ids = STACKED_MODEL_REPO_IDS if args.stack_models else args.model_repo_id
+    tag_threshold, filter_tags, batch_size, quiet = args.threshold, args.filter, args.batch_size, args.quiet
+    quantize, ort_cache_dir = args.quantize, args.ort_cache_dir
     sessions = []
     tags_paths = []
 
-    if stack_models:
-        model_repo_ids = ['SmilingWolf/wd-v1-4-convnext-tagger-v2', 'SmilingWolf/wd-v1-4-vit-tagger-v2',
-                          'SmilingWolf/wd-v1-4-swinv2-tagger-v2']
+    if quantize and not ort_cache_dir:
+        print("--quantize needs --ort_cache_dir. Exiting.")
+        return
+    stream = stream_from_args(args)
+    sharding = sharding_from_args(args, args.input_directory, 'wd14') if not (args.stream or args.serve) else None
+    dedup = dedup_from_args(args)
 
-    for model_repo_id in model_repo_ids:
-        print('*****************')
-        print(model_repo_id)
-        # Download the model and tags file
-        model_path, tags_path = download_model_files(model_repo_id)
+    options = session_options(args.ort_preset, args.num_threads, len(model_repo_ids), args.graph_optimization,
+                              args.inter_op_threads, args.execution_mode)
+    score_cache = ScoreCache(args.score_cache_dir, np.dtype(args.score_cache_dtype)) if args.score_cache_dir else None
+    # quantized models score slightly differently, so their scores are cached apart
+    stores = [score_cache.model(f"{model_repo_id}-{quantize}" if quantize else model_repo_id)
+              for model_repo_id in model_repo_ids] if score_cache else [None] * len(model_repo_ids)
 
-        try:
-            session = onnxruntime.InferenceSession(model_path, providers=['CUDAExecutionProvider'])
-        except RuntimeException:
-            print("CUDA isn't available. Trying to run on CPU.")
+    if args.rerender:
+        # captions come only from cached scores, so no models are downloaded or loaded
+        if score_cache is None:
+            print("--rerender needs --score_cache_dir. Exiting.")
+            return
+        tags_paths = [store.tags_path for store in stores]
+        missing = [model_repo_id for model_repo_id, tags_path in zip(model_repo_ids, tags_paths) if not os.path.exists(tags_path)]
+        if missing:
+            print(f"No cached scores for {', '.join(missing)}. Exiting.")
+            return
+    else:
+        for model_repo_id, store in zip(model_repo_ids, stores):
+            print('*****************')
+            print(model_repo_id)
+            # Download the model and tags file
+            model_path, tags_path = download_model_files(model_repo_id)
+            if quantize:
+                model_path = quantized_model(model_path, ort_cache_dir, model_repo_id)
+
+            providers = select_providers(quantize)
             try:
-                session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+                session = create_session(model_path, options, providers, ort_cache_dir, model_repo_id)
             except RuntimeException:
-                print("Can't run the model. Exiting.")
-                return
+                if providers == ['CPUExecutionProvider']:
+                    print("Can't run the model. Exiting.")
+                    return
+                print("CUDA isn't available. Trying to run on CPU.")
+                try:
+                    session = create_session(model_path, options, ['CPUExecutionProvider'], ort_cache_dir, model_repo_id)
+                except RuntimeException:
+                    print("Can't run the model. Exiting.")
+                    return
+
+            sessions.append(session)
+            tags_paths.append(tags_path)
+            if score_cache is not None:
+                store.save_tags(tags_path)
+
+    tag_sets = [load_tags(tags_path, tuple(filter_tags)) for tags_path in tags_paths]
+    vocab, positions = align_tags(tag_sets)
+
+    store = caption_store_from_args(args, 'wd14')
+    params = {'models': model_repo_ids, 'threshold': tag_threshold, 'filter': sorted(filter_tags),
+              'stack_models': args.stack_models}
+    if quantize:
+        # only recorded when set, so the images of earlier float32 runs still count as done
+        params['quantize'] = quantize
+    manifest = manifest_from_args(args, 'wd14', params, store)
+    worker = stream or daemon_from_args(args, manifest)
+
+    executor = ThreadPoolExecutor(max_workers=len(sessions)) if len(sessions) > 1 else None
+    buffer = np.empty((batch_size, IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.float32)
+
+    prefetcher = prefetcher_from_args(args)
+    load = partial(load_image, fast_preprocess=args.fast_preprocess)
+
+    def tag_images(image_files):
+        if manifest is not None:
+            image_files = manifest.pending(image_files)
 
-        sessions.append(session)
-        tags_paths.append(tags_path)
+        def write_captions(batch_files, batch_scores):
+            with span('postprocess', images=len(batch_files)):
+                averaged_scores = average_scores(batch_scores, tag_sets, positions, len(vocab))
+                selected = averaged_scores > tag_threshold
 
-    image_files = list(Path(image_folder).rglob('*'))
-    image_files = [img for img in image_files if img.suffix in ['.jpg', '.jpeg', '.png']]
+            if not quiet:
+                # every model's top tags are only needed for the console
+                model_scores = [scores[:, columns] for scores, (_, columns) in zip(batch_scores, tag_sets)]
+                model_top = [top_k(scores, 10) for scores in model_scores]
 
-    for image_path in tqdm(image_files, desc="Processing images"):
-        tags_scores = []
-        for session, tags_path in zip(sessions, tags_paths):
-            print(tags_path)
-            tags_filtered = run_model(image_path, model_path, tags_path, session, tag_threshold, filter_tags)
-            tags_scores.append(tags_filtered.set_index('name'))
-            print(tags_filtered.sort_values('Score', ascending=False).head(10))
+            for index, image_path in enumerate(batch_files):
+                if not quiet:
+                    for (names, _), scores, top, tags_path in zip(tag_sets, model_scores, model_top, tags_paths):
+                        print(tags_path)
+                        print(format_tags(names[top[index]], scores[index, top[index]]))
 
-        if not stack_models and len(model_repo_ids) == 1:
-            averaged_tags_scores = tags_scores[0].reset_index()
+                picked = np.flatnonzero(selected[index])
+                picked = picked[sort_descending(averaged_scores[index, picked])]
+                caption = format_tags(vocab[picked], averaged_scores[index, picked])
+                if not quiet:
+                    print(caption)
+                output_path = caption_path(image_path)
+                write_caption(store, output_path, caption)
+                if manifest is not None:
+                    manifest.record(image_path, output_path)
+                progress.update(1)
+
+        def tag_batch(batch_files):
+            batch = buffer[:len(batch_files)]
+            with span('inference', images=len(batch_files)):
+                batch_scores = run_sessions(executor, sessions, batch, batch_size)
+            if score_cache is not None:
+                batch_digests = [digests.pop(image_path) for image_path in batch_files]
+                for store, scores in zip(stores, batch_scores):
+                    store.put_batch(batch_digests, scores)
+            write_captions(batch_files, batch_scores)
+
+        digests = {}
+        missing = []
+
+        def uncached(image_files):
+            # hash the images on the loaders as they come; images with scores cached for every model are written
+            # straight away and skip decoding and inference, the rest are passed on
+            cached_files = []
+            for image_path, digest in prefetcher.run(file_digest, image_files):
+                if all(digest in store for store in stores):
+                    cached_files.append((image_path, digest))
+                    if len(cached_files) == batch_size:
+                        write_cached(cached_files)
+                        cached_files = []
+                elif args.rerender:
+                    missing.append(image_path)
+                else:
+                    digests[image_path] = digest
+                    yield image_path
+            if cached_files:
+                write_cached(cached_files)
+
+        def write_cached(cached_files):
+            batch_digests = [digest for _, digest in cached_files]
+            write_captions([image_path for image_path, _ in cached_files], [store.get_batch(batch_digests) for store in stores])
+
+        if score_cache is not None:
+            image_files = uncached(image_files)
+
+        with tqdm(desc="Processing images") as progress:
+            # decode and preprocess on background workers while the sessions run on the previous batch
+            batch_files = []
+            for image_path, image in prefetcher.run(load, image_files):
+                buffer[len(batch_files)] = image
+                batch_files.append(image_path)
+                if len(batch_files) == batch_size:
+                    tag_batch(batch_files)
+                    batch_files = []
+            if batch_files:
+                tag_batch(batch_files)
+        if missing:
+            print(f"{len(missing)} image(s) have no cached scores for every model and were skipped:")
+            for image_path in missing:
+                print(f"  {image_path}")
+        if store is not None:
+            store.flush()
+
+    if worker is None:
+        images = scan_images(args.input_directory, args.scan_index)
+        if dedup is not None:
+            images = dedup.representatives(images)
+        if sharding is None:
+            tag_images(map(Path, images))
         else:
-            combined_tags_scores = pd.concat(tags_scores, axis=1, join='outer')
-            averaged_tags_scores = combined_tags_scores.mean(axis=1).reset_index()
+            sharding.run(lambda images: tag_images(map(Path, images)), images)
+    else:
+        worker.run(lambda images: tag_images(map(Path, images)), caption_path,
+                   partial(caption_exists, store))
 
-        averaged_tags_scores.columns = ['name', 'Score']  # rename columns
-        averaged_tags_scores = averaged_tags_scores[averaged_tags_scores['Score'] > tag_threshold]
-        averaged_tags_scores.sort_values('Score', ascending=False, inplace=True)
-        print(averaged_tags_scores)
-        with open(f'{Path(args.input_directory) / image_path.stem}.wd14cap', 'w') as fw:
-            for _, row in averaged_tags_scores.iterrows():
-                fw.write(f"[{row['name']}: {row['Score']:.2f}], ")
+    prefetcher.report()
+    if score_cache is not None:
+        score_cache.flush()
+    if manifest is not None:
+        manifest.close()
+    if store is not None:
+        store.close()
+    if executor is not None:
+        executor.shutdown()
+    if dedup is not None:
+        dedup.close()
 
 
 
-if __name__ == '__main__':
+def parse_args(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -116,6 +469,60 @@ if __name__ == '__main__':
     parser.add_argument("--output_extension", type=str, default="wd14cap", help="file extension to save caption with")
     parser.add_argument("--filter", nargs='*', default=['1girl','solo','questionable','realistic','general','sensitive'], help="List of tags to filter out.")
     parser.add_argument("--stack_models", action='store_true', help="Whether to stack models. If set, images will be processed with multiple models and their scores averaged.")
-    args = parser.parse_args()
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of images to run through each model at once. Batched scores differ from single-image ones by around 1e-5, so near-tied tags can swap places and tags right at the threshold can flip; use --check_batch to measure it on your data, and batch size 1 for captions byte-identical to single-image runs.")
+    parser.add_argument("--num_threads", type=int, default=None, help="Total intra-op CPU threads, split evenly between the loaded models. Defaults to all cores.")
+    parser.add_argument("--fast_preprocess", action='store_true', help="Decode JPEGs at reduced size and resize before padding. Output matches the default preprocessing within resampling error.")
+    parser.add_argument("--check_fast_preprocess", action='store_true', help="Compare --fast_preprocess against the default preprocessing on the input images and exit.")
+    parser.add_argument("--check_batch", action='store_true', help="Compare the tags and captions of --batch_size batches against one image at a time on a sample of the input images and exit.")
+    parser.add_argument("--check_batch_sample", type=int, default=64, help="Number of images --check_batch compares.")
+    parser.add_argument("--check_batch_agreement", type=float, default=0.99, help="Lowest mean tag agreement (intersection over union of the tags above the threshold) --check_batch accepts.")
+    parser.add_argument("--fast_preprocess_tolerance", type=float, default=2.0, help="Allowed mean absolute pixel difference (0-255) for --check_fast_preprocess.")
+    parser.add_argument("--score_cache_dir", type=str, default=None, help="Directory that stores every model's raw scores per image content hash. Cached images skip inference.")
+    parser.add_argument("--score_cache_dtype", choices=['float16', 'float32'], default='float16', help="Precision of cached scores. float16 halves the cache size; float32 re-renders byte-identical captions.")
+    parser.add_argument("--rerender", action='store_true', help="Rebuild caption files from --score_cache_dir with the current threshold/filter/stacking settings without running any model.")
+    add_prefetch_args(parser)
+    add_manifest_args(parser)
+    add_stream_args(parser)
+    add_daemon_args(parser)
+    add_caption_store_args(parser)
+    add_scan_args(parser)
+    add_shard_args(parser)
+    add_trace_args(parser)
+    add_session_args(parser)
+    add_dedup_args(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.check_fast_preprocess:
+        image_files = [Path(image) for image in scan_images(args.input_directory, args.scan_index)]
+        raise SystemExit(0 if compare_preprocessing(image_files, args.fast_preprocess_tolerance) else 1)
+
+    if args.check_batch:
+        image_files = list(scan_images(args.input_directory, args.scan_index))
+        sample = image_files[::max(1, len(image_files) // args.check_batch_sample)][:args.check_batch_sample]
+        options = session_options(args.ort_preset, args.num_threads, 1, args.graph_optimization, args.inter_op_threads,
+                                  args.execution_mode)
+        raise SystemExit(0 if compare_batching(sample, STACKED_MODEL_REPO_IDS if args.stack_models else args.model_repo_id,
+                                               args.threshold, args.filter, args.ort_cache_dir, options,
+                                               args.batch_size, args.check_batch_agreement) else 1)
+
+    if args.check_quantize:
+        if not args.ort_cache_dir:
+            raise SystemExit("--check_quantize needs --ort_cache_dir")
+        image_files = list(scan_images(args.input_directory, args.scan_index))
+        # spread the sample over the whole dataset
+        sample = image_files[::max(1, len(image_files) // args.check_quantize_sample)][:args.check_quantize_sample]
+        options = session_options(args.ort_preset, args.num_threads, 1, args.graph_optimization, args.inter_op_threads,
+                                  args.execution_mode)
+        raise SystemExit(0 if compare_quantized(sample, STACKED_MODEL_REPO_IDS if args.stack_models else args.model_repo_id,
+                                                args.threshold, args.filter, args.ort_cache_dir, options,
+                                                args.batch_size, args.check_quantize_agreement) else 1)
+
+    tracer = tracer_from_args(args, 'wd14')
 
-    main(args.input_directory, args.model_repo_id, args.threshold, args.filter, args.stack_models)
+    main(args)
+    if tracer is not None:
+        tracer.close()
@@ -0,0 +1,162 @@
+# onnxruntime session setup for the WD14 taggers.
+#
+# --ort_preset picks the session options. `throughput` (the default) suits batch captioning: the intra-op
+# threads are split between the stacked models, which run side by side, and don't spin while idle, so
+# the image loaders get the CPU between batches. `latency` gives every session all the threads and keeps
+# them spinning, for --serve with small batches. `default` keeps onnxruntime's own options apart from the
+# thread split. --graph_optimization, --inter_op_threads and --execution_mode override the preset.
+#
+# With --ort_cache_dir the graph onnxruntime optimized is saved there, and later runs load it instead of
+# optimizing the model again. The saved graph stops before the layout optimizations that depend on the
+# CPU, so one cache can be shared between machines; those are applied when it's loaded.
+#
+# --quantize int8 runs a dynamically quantized copy of every model, made once in --ort_cache_dir. Its
+# MatMul weights are stored as int8 and its activations quantized on the fly, which makes the
+# transformer taggers faster on CPUs with VNNI/DOT instructions and the models a quarter of the size.
+# --check_quantize reports how well the tags of the quantized models agree with the float32 ones.
+import os
+import time
+import hashlib
+
+import onnxruntime
+from onnxruntime.capi.onnxruntime_pybind11_state import Fail, InvalidGraph, InvalidProtobuf, RuntimeException
+
+GRAPH_OPTIMIZATION = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODE = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+PRESETS = {
+    'default': {'split_threads': True},
+    'throughput': {'split_threads': True, 'graph_optimization': 'all', 'execution_mode': 'sequential',
+                   'inter_op_threads': 1, 'spinning': False},
+    'latency': {'split_threads': False, 'graph_optimization': 'all', 'execution_mode': 'sequential',
+                'inter_op_threads': 1, 'spinning': True},
+}
+# the highest level whose output runs on any CPU; ORT_ENABLE_ALL adds layouts for the current CPU
+PORTABLE_OPTIMIZATION = 'extended'
+# MatMul carries almost all of the taggers' compute; quantizing their Conv layers costs accuracy for
+# little speed with dynamic quantization
+QUANTIZED_OPS = ['MatMul', 'Attention']
+CACHE_LOAD_ERRORS = (Fail, InvalidGraph, InvalidProtobuf, RuntimeException)
+
+
+def add_session_args(parser):
+    parser.add_argument("--ort_preset", choices=list(PRESETS), default='throughput',
+                        help="onnxruntime session options: throughput for batch runs, latency for --serve with small "
+                             "batches, default for onnxruntime's own.")
+    parser.add_argument("--graph_optimization", choices=list(GRAPH_OPTIMIZATION), default=None,
+                        help="onnxruntime graph optimization level, instead of the preset's.")
+    parser.add_argument("--inter_op_threads", type=int, default=None, help="onnxruntime inter-op threads, instead of the preset's.")
+    parser.add_argument("--execution_mode", choices=list(EXECUTION_MODE), default=None,
+                        help="onnxruntime execution mode, instead of the preset's. parallel only helps branching graphs.")
+    parser.add_argument("--ort_cache_dir", type=str, default=None,
+                        help="Directory to keep the optimized and quantized models in, so later runs start faster.")
+    parser.add_argument("--quantize", choices=['int8'], default=None,
+                        help="Run dynamically quantized copies of the models. Needs --ort_cache_dir.")
+    parser.add_argument("--check_quantize", action='store_true',
+                        help="Compare the tags of the --quantize models against the float32 models on a sample of the "
+                             "input images and exit.")
+    parser.add_argument("--check_quantize_sample", type=int, default=64, help="Number of images --check_quantize compares.")
+    parser.add_argument("--check_quantize_agreement", type=float, default=0.9,
+                        help="Lowest mean tag agreement (intersection over union of the tags above the threshold) "
+                             "--check_quantize accepts.")
+
+
+def session_options(preset='throughput', num_threads=None, num_models=1, graph_optimization=None,
+                    inter_op_threads=None, execution_mode=None):
+    settings = PRESETS[preset]
+    options = onnxruntime.SessionOptions()
+    threads = num_threads or os.cpu_count() or 1
+    # split the intra-op thread budget between the models so concurrent sessions don't oversubscribe the CPU
+    options.intra_op_num_threads = max(1, threads // num_models) if settings['split_threads'] else threads
+    graph_optimization = graph_optimization or settings.get('graph_optimization')
+    if graph_optimization:
+        options.graph_optimization_level = GRAPH_OPTIMIZATION[graph_optimization]
+    execution_mode = execution_mode or settings.get('execution_mode')
+    if execution_mode:
+        options.execution_mode = EXECUTION_MODE[execution_mode]
+    inter_op_threads = inter_op_threads or settings.get('inter_op_threads')
+    if inter_op_threads:
+        options.inter_op_num_threads = inter_op_threads
+    if 'spinning' in settings:
+        spinning = '1' if settings['spinning'] else '0'
+        options.add_session_config_entry('session.intra_op.allow_spinning', spinning)
+        options.add_session_config_entry('session.inter_op.allow_spinning', spinning)
+    return options
+
+
+def select_providers(quantize=None):
+    if quantize is None and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+        return ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    # the CUDA provider has no kernels for the integer ops, so quantized models run on the CPU anyway
+    return ['CPUExecutionProvider']
+
+
+def _cache_name(name, model_path, *extra):
+    # huggingface keeps every downloaded file under its own content hash, so the resolved path, size and
+    # mtime change whenever the model does
+    stat = os.stat(model_path)
+    key = repr((os.path.realpath(model_path), stat.st_size, stat.st_mtime_ns) + extra)
+    return f"{name.replace('/', '--')}-{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}"
+
+
+def create_session(model_path, options, providers, cache_dir=None, name='model'):
+    """Create an inference session, loading the optimized graph from cache_dir or saving it there"""
+    start_time = time.time()
+    if cache_dir is None:
+        session = onnxruntime.InferenceSession(model_path, sess_options=options, providers=providers)
+        print(f"Loaded {name} in {time.time() - start_time:.1f} seconds")
+        return session
+
+    levels = list(GRAPH_OPTIMIZATION.values())
+    level = levels[min(levels.index(options.graph_optimization_level), levels.index(GRAPH_OPTIMIZATION[PORTABLE_OPTIMIZATION]))]
+    optimized_path = os.path.join(cache_dir, _cache_name(name, model_path, onnxruntime.__version__, str(level),
+                                                         tuple(providers)) + '.optimized.onnx')
+    if os.path.isfile(optimized_path):
+        try:
+            session = onnxruntime.InferenceSession(optimized_path, sess_options=options, providers=providers)
+            print(f"Loaded the optimized {name} from {optimized_path} in {time.time() - start_time:.1f} seconds")
+            return session
+        except CACHE_LOAD_ERRORS as e:
+            print(f"Ignoring unusable optimized model {optimized_path}: {e}")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # several runs may optimize the same model at the same time
+    tmp_path = f"{optimized_path[:-len('.onnx')]}.{os.getpid()}.tmp.onnx"
+    save_options = session_options('default')
+    save_options.graph_optimization_level = level
+    save_options.optimized_model_filepath = tmp_path
+    onnxruntime.InferenceSession(model_path, sess_options=save_options, providers=providers)
+    os.replace(tmp_path, optimized_path)
+    session = onnxruntime.InferenceSession(optimized_path, sess_options=options, providers=providers)
+    print(f"Optimized {name} in {time.time() - start_time:.1f} seconds, saved to {optimized_path}")
+    return session
+
+
+def quantized_model(model_path, cache_dir, name='model'):
+    """Return the path of the int8 copy of the model in cache_dir, quantizing it the first time"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    quantized_path = os.path.join(cache_dir, _cache_name(name, model_path, 'int8', QUANTIZED_OPS) + '.int8.onnx')
+    if not os.path.isfile(quantized_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        start_time = time.time()
+        tmp_path = f"{quantized_path[:-len('.onnx')]}.{os.getpid()}.tmp.onnx"
+        prepared_path = f"{quantized_path[:-len('.onnx')]}.{os.getpid()}.prepared.onnx"
+        # shape inference and the basic fusions first, as onnxruntime recommends before quantizing
+        quant_pre_process(model_path, prepared_path, skip_symbolic_shape=True)
+        # signed weights with unsigned activations is the fast combination on x86-64 and arm64
+        quantize_dynamic(prepared_path, tmp_path, op_types_to_quantize=QUANTIZED_OPS, weight_type=QuantType.QInt8,
+                         extra_options={'MatMulConstBOnly': True})
+        os.remove(prepared_path)
+        os.replace(tmp_path, quantized_path)
+        print(f"Quantized {name} to int8 in {time.time() - start_time:.1f} seconds "
+              f"({os.path.getsize(model_path) / 2**20:.0f}MB -> {os.path.getsize(quantized_path) / 2**20:.0f}MB)")
+    return quantized_path
@@ -0,0 +1,108 @@
+# On-disk store of raw WD14 probability vectors, keyed by image content hash and model repo id, so
+# threshold/filter/stacking changes can be re-rendered without running the models again.
+#
+# Layout: <cache_dir>/<model repo id>/ holds a copy of the model's selected_tags.csv, float16 score
+# shards (shard-*.npy, one row per image) and index.jsonl mapping each content hash to a shard row.
+# Shards are written whole and only then appended to the index, so a crash loses at most the rows
+# that had not been flushed yet. Shard names are unique per writer, so several runs can share a cache.
+import os
+import json
+import time
+import shutil
+import numpy as np
+
+SHARD_SIZE = 4096
+
+
+class ModelScoreStore:
+    def __init__(self, directory, dtype=np.float16, shard_size=SHARD_SIZE):
+        self.directory = directory
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.index = {}
+        self.shards = {}
+        self.pending = {}
+        self.shard_count = 0
+        os.makedirs(directory, exist_ok=True)
+        self._read_index()
+
+    @property
+    def tags_path(self):
+        return os.path.join(self.directory, 'selected_tags.csv')
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.jsonl')
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn last line from an interrupted writer
+                self.index[entry['hash']] = (entry['shard'], entry['row'])
+
+    def save_tags(self, tags_path):
+        if not os.path.exists(self.tags_path):
+            shutil.copyfile(tags_path, self.tags_path)
+
+    def __contains__(self, digest):
+        return digest in self.index or digest in self.pending
+
+    def get(self, digest):
+        if digest in self.index:
+            shard, row = self.index[digest]
+            if shard not in self.shards:
+                self.shards[shard] = np.load(os.path.join(self.directory, shard), mmap_mode='r')
+            return self.shards[shard][row]
+        return self.pending.get(digest)
+
+    def get_batch(self, digests):
+        return np.stack([self.get(digest) for digest in digests]).astype(np.float32)
+
+    def put_batch(self, digests, scores):
+        for digest, row in zip(digests, scores.astype(self.dtype)):
+            self.pending[digest] = row
+        if len(self.pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.shard_count += 1
+        shard = f'shard-{int(time.time() * 1000)}-{os.getpid()}-{self.shard_count}.npy'
+        temp_path = os.path.join(self.directory, shard + '.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.stack(list(self.pending.values())))
+        os.replace(temp_path, os.path.join(self.directory, shard))
+
+        lines = [json.dumps({'hash': digest, 'shard': shard, 'row': row}) for row, digest in enumerate(self.pending)]
+        with open(self.index_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+        for row, digest in enumerate(self.pending):
+            self.index[digest] = (shard, row)
+        self.pending = {}
+
+
+class ScoreCache:
+    def __init__(self, cache_dir, dtype=np.float16, shard_size=SHARD_SIZE):
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.stores = {}
+
+    def model(self, model_repo_id):
+        if model_repo_id not in self.stores:
+            directory = os.path.join(self.cache_dir, *model_repo_id.split('/'))
+            self.stores[model_repo_id] = ModelScoreStore(directory, self.dtype, self.shard_size)
+        return self.stores[model_repo_id]
+
+    def flush(self):
+        for store in self.stores.values():
+            store.flush()